@@ -0,0 +1,476 @@
+"""
+قياس أداء bot.py بدون حسابات تيليجرام حقيقية وبدون قاعدة بيانات.
+
+يشغل المعالجات والمحركات الحقيقية من bot.py فوق:
+  - عميل تيليجرام وهمي (يسجل الإرسال مع تأخير و FloodWait قابلين للضبط)
+  - مجموعات Mongo في الذاكرة (تعد الاستعلامات لكل حدث)
+
+مثال:
+    python bench.py --accounts 20 --groups 50 --keywords 200 --rate 2000 --duration 10
+"""
+import os
+import sys
+import copy
+import time
+import random
+import asyncio
+import argparse
+import resource
+import statistics
+from types import SimpleNamespace
+from datetime import datetime, timezone
+
+# قيم وهمية قبل الاستيراد: bot.py يخرج إذا لم تكن موجودة، و motor لا يتصل فعلياً إلا عند أول استعلام
+for _name, _value in (("API_ID", "1"), ("API_HASH", "bench"), ("BOT_TOKEN", "0:bench"), ("MONGO_URI", "mongodb://127.0.0.1:1")):
+    os.environ.setdefault(_name, _value)
+
+import bot  # noqa: E402
+from pymongo.errors import PyMongoError  # noqa: E402
+from telethon.errors import FloodWaitError  # noqa: E402
+
+# ==============================================================================
+#                               1. Mongo في الذاكرة
+# ==============================================================================
+
+def _match_value(value, condition):
+    if isinstance(condition, dict) and any(k.startswith('$') for k in condition):
+        for op, arg in condition.items():
+            if op == "$in" and value not in arg: return False
+            if op == "$gt" and not (value is not None and value > arg): return False
+            if op == "$gte" and not (value is not None and value >= arg): return False
+            if op == "$lt" and not (value is not None and value < arg): return False
+            if op == "$lte" and not (value is not None and value <= arg): return False
+        return True
+    return value == condition
+
+def _matches(doc, query):
+    return all(_match_value(doc.get(k), v) for k, v in (query or {}).items())
+
+class InMemoryCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        self._docs.sort(key=lambda d: d.get(key), reverse=direction < 0)
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._docs:
+            yield doc
+
+class InMemoryCollection:
+    """ بديل بسيط لمجموعة motor: يكفي لما يستخدمه bot.py ويعد كل استدعاء """
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = []
+        self.calls = 0
+        self._next_id = 1
+
+    def _new_id(self):
+        self._next_id += 1
+        return f"{self.name}-{self._next_id}"
+
+    def find(self, query=None, projection=None):
+        self.calls += 1
+        return InMemoryCursor([copy.copy(d) for d in self.docs if _matches(d, query)])
+
+    async def find_one(self, query=None, projection=None):
+        self.calls += 1
+        for doc in self.docs:
+            if _matches(doc, query): return copy.copy(doc)
+        return None
+
+    def _apply_update(self, doc, update):
+        for key, value in update.get("$set", {}).items(): doc[key] = value
+        for key, value in update.get("$inc", {}).items(): doc[key] = doc.get(key, 0) + value
+        for key, value in update.get("$addToSet", {}).items():
+            items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+            target = doc.setdefault(key, [])
+            target.extend(i for i in items if i not in target)
+
+    def _update(self, query, update, upsert):
+        for doc in self.docs:
+            if _matches(doc, query):
+                self._apply_update(doc, update); return
+        if upsert:
+            doc = {k: v for k, v in query.items() if not isinstance(v, dict)}
+            doc.setdefault("_id", self._new_id())
+            self._apply_update(doc, update)
+            self.docs.append(doc)
+
+    def _delete(self, query, many=False):
+        kept = []; deleted = 0
+        for doc in self.docs:
+            if _matches(doc, query) and (many or not deleted): deleted += 1
+            else: kept.append(doc)
+        self.docs = kept
+        return SimpleNamespace(deleted_count=deleted)
+
+    async def update_one(self, query, update, upsert=False):
+        self.calls += 1
+        self._update(query, update, upsert)
+
+    async def replace_one(self, query, document, upsert=False):
+        self.calls += 1
+        self._delete(query)
+        self.docs.append(dict(document))
+
+    async def insert_one(self, document):
+        self.calls += 1
+        document.setdefault("_id", self._new_id())
+        self.docs.append(document)
+
+    async def insert_many(self, documents, ordered=True):
+        self.calls += 1
+        for document in documents:
+            document.setdefault("_id", self._new_id())
+            self.docs.append(document)
+
+    async def delete_one(self, query):
+        self.calls += 1
+        return self._delete(query)
+
+    async def delete_many(self, query):
+        self.calls += 1
+        return self._delete(query, many=True)
+
+    async def count_documents(self, query):
+        self.calls += 1
+        return sum(1 for d in self.docs if _matches(d, query))
+
+    async def bulk_write(self, operations, ordered=True):
+        self.calls += 1
+        for op in operations:
+            if type(op).__name__ == "DeleteOne": self._delete(op._filter)
+            else: self._update(op._filter, op._doc, op._upsert)
+
+    async def create_index(self, keys, **kwargs):
+        self.calls += 1
+
+    def watch(self, *args, **kwargs):
+        raise PyMongoError("change streams are not available in the benchmark")
+
+def install_in_memory_collections():
+    """ استبدال كل *_collection في bot.py بنسخة في الذاكرة (ومعها مخازن الكتابة المجمعة) """
+    collections = {}
+    for name in list(vars(bot)):
+        if name.endswith("_collection"):
+            collections[name] = InMemoryCollection(name[:-len("_collection")])
+            setattr(bot, name, collections[name])
+    for buffer in bot.WRITE_BUFFERS:
+        buffer.collection = next(c for c in collections.values() if c.name == buffer.collection.name)
+    return collections
+
+# ==============================================================================
+#                               2. تيليجرام وهمي
+# ==============================================================================
+
+class FakeTelegramConfig:
+    def __init__(self, latency=0.02, flood_rate=0.0, flood_seconds=5):
+        self.latency = latency          # زمن كل طلب إرسال (ثواني)
+        self.flood_rate = flood_rate    # احتمال FloodWait لكل إرسال
+        self.flood_seconds = flood_seconds
+
+class FakeTelegramClient:
+    """ يحاكي ما يستخدمه bot.py من TelegramClient ويسجل كل إرسال """
+
+    def __init__(self, owner_id, config, groups):
+        self.owner_id = owner_id
+        self.my_id = owner_id
+        self.config = config
+        self.groups = groups
+        self.sent = []
+        self.flood_waits = 0
+        self._message_id = 0
+
+    async def _network(self):
+        await asyncio.sleep(self.config.latency)
+        if self.config.flood_rate and random.random() < self.config.flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.config.flood_seconds)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._network()
+        self._message_id += 1
+        message = SimpleNamespace(id=self._message_id, chat_id=chat_id, text=text, media=None)
+        message.edit = lambda new_text: self.edit_message(chat_id, message.id, new_text)
+        self.sent.append((time.perf_counter(), chat_id, text))
+        return message
+
+    async def send_file(self, chat_id, file, caption="", **kwargs):
+        return await self.send_message(chat_id, caption, file=file)
+
+    async def edit_message(self, chat_id, message_id, text):
+        await self._network()
+
+    async def delete_messages(self, chat_id, ids):
+        await self._network()
+
+    async def get_me(self):
+        return SimpleNamespace(id=self.my_id)
+
+    async def get_entity(self, target):
+        return SimpleNamespace(id=abs(hash(target)) % 10**9, status=None, title=str(target))
+
+    async def get_input_entity(self, entity):
+        return entity
+
+    async def get_permissions(self, chat_id, user):
+        return SimpleNamespace(is_admin=False, is_creator=False)
+
+    async def get_dialogs(self, limit=None):
+        return [d async for d in self.iter_dialogs(limit=limit)]
+
+    async def iter_dialogs(self, limit=None):
+        for index, chat_id in enumerate(self.groups):
+            if limit and index >= limit: break
+            yield SimpleNamespace(id=chat_id, name=f"group {chat_id}", title=f"group {chat_id}", is_group=True,
+                                  is_user=False, is_channel=False, entity=SimpleNamespace(bot=False))
+
+    async def iter_messages(self, entity, search=None, limit=None, **kwargs):
+        return
+        yield
+
+    async def upload_file(self, data, file_name=None):
+        await self._network()
+        return SimpleNamespace(name=file_name)
+
+    def action(self, chat_id, action):
+        return _NullAsyncContext()
+
+    async def __call__(self, request):
+        await self._network()
+        return []
+
+    async def disconnect(self):
+        pass
+
+class _NullAsyncContext:
+    async def __aenter__(self): return self
+    async def __aexit__(self, *exc): return False
+
+class FakeNewMessage:
+    """ حدث NewMessage اصطناعي بالخصائص التي يقرأها الموزع والمعالجات """
+
+    def __init__(self, client, chat_id, sender_id, text, is_private=False, is_reply=False, out=False, mentioned=False):
+        self.client = client
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.raw_text = self.text = text
+        self.is_private = is_private
+        self.is_group = not is_private
+        self.is_reply = is_reply
+        self.mentioned = mentioned
+        self.out = out
+        self.id = random.randint(1, 10**9)
+        self.created = time.perf_counter()
+        self.date = datetime.now(timezone.utc)
+        self.message = SimpleNamespace(buttons=None, id=self.id)
+        # الكيان غير متوفر للمحادثات الخاصة (مثل رسالة من مستخدم غير مخزن)
+        self.chat = None if is_private else SimpleNamespace(title=f"chat {chat_id}")
+
+    async def reply(self, text):
+        return await self.client.send_message(self.chat_id, text, reply_to=self.id)
+
+    async def get_reply_message(self):
+        await self.client._network()
+        return SimpleNamespace(sender_id=self.client.my_id if random.random() < 0.5 else self.sender_id + 1)
+
+    async def get_sender(self):
+        return SimpleNamespace(id=self.sender_id)
+
+    async def get_input_sender(self):
+        return SimpleNamespace(user_id=self.sender_id)
+
+class FakeCallbackQuery:
+    """ ضغطة زر اصطناعية للوحة التحكم """
+
+    def __init__(self, chat_id, data):
+        self.chat_id = chat_id
+        self.data = data
+        self.responses = []
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def respond(self, text, **kwargs):
+        self.responses.append(text)
+        return SimpleNamespace(id=len(self.responses), chat_id=self.chat_id, edit=self._noop)
+
+    async def _noop(self, *args, **kwargs):
+        pass
+
+class FakeAICompletions:
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="رد تجريبي"))])
+
+# ==============================================================================
+#                               3. السيناريو والتقرير
+# ==============================================================================
+
+def percentile(values, q):
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def run_scenario(args):
+    random.seed(args.seed)
+    collections = install_in_memory_collections()
+    bot.ai_client = SimpleNamespace(chat=SimpleNamespace(completions=FakeAICompletions(args.ai_latency))) if args.ai_latency else False
+    telegram = FakeTelegramConfig(args.send_latency, args.flood_rate, args.flood_seconds)
+    bot.MESSAGE_INDEX_DIR = args.message_index
+
+    # تجهيز الحسابات والجروبات والكلمات
+    keywords = [f"كلمة{i}" for i in range(args.keywords)]
+    clients = []
+    for a in range(args.accounts):
+        owner_id = 1000 + a
+        groups = [-(10**12) - a * 10_000 - g for g in range(args.groups)]
+        client = FakeTelegramClient(owner_id, telegram, groups)
+        client.sender = bot.SendScheduler(owner_id, rate=args.send_rate, burst=args.send_burst, chat_interval=args.chat_interval)
+        client.inbox = bot.EventQueue(owner_id, max_size=args.queue_size, workers=args.workers, policy=args.shed_policy)
+        client.presence = bot.AdminPresenceIndex(client, owner_id)
+        client.leaver = bot.LeaveScheduler(client, owner_id)
+        client.joiner = bot.JoinQueue(client, owner_id)
+        client.media = bot.MediaCache(client)
+        client.dialogs = bot.DialogIndex(client, owner_id)
+        for chat_id in groups:
+            client.dialogs._entries[chat_id] = bot.DialogEntry(chat_id, bot.DIALOG_GROUP, f"group {chat_id}", 100)
+        client.dialogs.ready.set()
+        client.messages = await bot.open_message_index(owner_id)
+        if client.messages is not None: asyncio.create_task(client.messages.run())
+        bot.active_userbot_clients[owner_id] = client
+        for keyword in keywords:
+            collections["replies_collection"].docs.append({"_id": f"r{owner_id}{keyword}", "owner_id": owner_id, "keyword": keyword, "reply": f"رد {keyword}"})
+        if args.ai_latency:
+            collections["ai_settings_collection"].docs.append({"owner_id": owner_id, "active": True})
+        if args.autopost:
+            collections["autopost_config_collection"].docs.append({"owner_id": owner_id, "active": True, "message": "إعلان",
+                                                                  "interval": 1, "groups": groups[:args.autopost]})
+        clients.append(client)
+
+    for client in clients:
+        if args.autopost: await bot.manage_user_autopost_task(client, client.owner_id)
+
+    # توليد الأحداث بالمعدل المطلوب
+    db_calls_before = sum(c.calls for c in collections.values())
+    latencies = []
+
+    # زمن كل حدث من لحظة وصوله حتى انتهاء معالجته (يشمل الانتظار في طابور الحساب)
+    process = bot.process_userbot_event
+    async def timed_process(client, event):
+        try: await process(client, event)
+        finally: latencies.append(time.perf_counter() - event.created)
+    bot.process_userbot_event = timed_process
+
+    total_events = int(args.rate * args.duration)
+    callbacks = 0
+    started_at = time.perf_counter()
+    for i in range(total_events):
+        target = started_at + i / args.rate
+        delay = target - time.perf_counter()
+        if delay > 0: await asyncio.sleep(delay)
+        client = random.choice(clients)
+        is_private = random.random() < args.private_ratio
+        text = f"مرحبا {random.choice(keywords)} كيف الحال" if random.random() < args.hit_ratio else "رسالة عادية بدون كلمات"
+        event = FakeNewMessage(client, random.randint(1, 10**6) if is_private else random.choice(client.groups),
+                               random.randint(1, 10**6), text, is_private=is_private,
+                               is_reply=random.random() < args.reply_ratio)
+        await bot.dispatch_userbot_event(client, event)
+        if args.callback_every and i % args.callback_every == 0:
+            callbacks += 1
+            await bot.callback_handler(FakeCallbackQuery(client.owner_id, b"view_stats"))
+
+    # الإنتاجية تُحسب على نافذة الإدخال فقط: التفريغ بعدها يتبع عمق الطوابير (والإرسال المقيد بالمعدل)
+    ingest_s = time.perf_counter() - started_at
+    processed_in_window = len(latencies)
+
+    # انتظار تفريغ الطوابير
+    drain_started = time.perf_counter()
+    drain_deadline = drain_started + args.drain_timeout
+    while any(len(c.inbox) or c.inbox.active or c.sender.queue_depth() for c in clients) and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.01)
+    drain_s = time.perf_counter() - drain_started
+
+    # فحص الفهرس: كل رسالة جروب فيها كلمة يجب أن تعود من البحث المحلي
+    index_hits = 0
+    for client in clients:
+        if client.messages is not None:
+            index_hits += len(await client.messages.search("مرحبا", time.time() - 3600))
+
+    for client in clients:
+        bot.autopost_scheduler.remove_owner(client.owner_id)
+        client.sender.close()
+        client.inbox.close()
+        if client.messages is not None: await client.messages.close()
+    await bot.flush_write_buffers()
+
+    db_calls = sum(c.calls for c in collections.values()) - db_calls_before
+    return {
+        "events": len(latencies),
+        "ingest_s": round(ingest_s, 3),
+        "throughput_eps": round(processed_in_window / ingest_s, 1) if ingest_s else 0,
+        "drain_s": round(drain_s, 3),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0,
+        "sends": sum(len(c.sent) for c in clients),
+        "flood_waits": sum(c.flood_waits for c in clients),
+        "db_calls": db_calls,
+        "db_calls_per_event": round(db_calls / max(len(latencies), 1), 3),
+        "callbacks": callbacks,
+        "events_dropped": sum(sum(c.inbox.dropped) for c in clients),
+        "sends_dropped": sum(c.sender.dropped for c in clients),
+        "messages_indexed": sum(c.messages.indexed for c in clients if c.messages is not None),
+        "index_search_hits": index_hits,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "errors": {f"{s[1]['where']}:{s[1]['error']}": s[2] for s in bot.error_counter.samples()},
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for bot.py handlers and engines")
+    parser.add_argument("--accounts", type=int, default=10)
+    parser.add_argument("--groups", type=int, default=20, help="groups per account")
+    parser.add_argument("--keywords", type=int, default=100, help="auto-reply keywords per account")
+    parser.add_argument("--rate", type=float, default=500, help="incoming messages per second (all accounts)")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of generated traffic")
+    parser.add_argument("--hit-ratio", type=float, default=0.1, help="share of messages containing a keyword")
+    parser.add_argument("--private-ratio", type=float, default=0.1)
+    parser.add_argument("--reply-ratio", type=float, default=0.2)
+    parser.add_argument("--send-latency", type=float, default=0.02)
+    parser.add_argument("--send-rate", type=float, default=bot.ACCOUNT_SEND_RATE)
+    parser.add_argument("--send-burst", type=int, default=bot.ACCOUNT_SEND_BURST)
+    parser.add_argument("--chat-interval", type=float, default=bot.CHAT_SEND_INTERVAL)
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probability of FloodWait per send")
+    parser.add_argument("--flood-seconds", type=int, default=5)
+    parser.add_argument("--ai-latency", type=float, default=0.0, help="enable AI chat with this fake model latency")
+    parser.add_argument("--autopost", type=int, default=0, help="run autopost to N groups per account")
+    parser.add_argument("--callback-every", type=int, default=0, help="inject a control-bot callback every N events")
+    parser.add_argument("--queue-size", type=int, default=bot.EVENT_QUEUE_MAX, help="per-account event queue bound")
+    parser.add_argument("--workers", type=int, default=bot.EVENT_WORKERS, help="per-account event workers")
+    parser.add_argument("--shed-policy", default=bot.EVENT_SHED_POLICY, choices=["drop_oldest_group", "drop_new"])
+    parser.add_argument("--message-index", default=None, metavar="DIR", help="index group messages into SQLite FTS5 files in DIR")
+    parser.add_argument("--drain-timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run_scenario(args))
+    print(f"scenario: {args.accounts} accounts x {args.groups} groups x {args.keywords} keywords @ {args.rate:g} msg/s for {args.duration:g}s")
+    for key, value in report.items():
+        print(f"  {key:<20} {value}")
+    if args.message_index and report["messages_indexed"] and not report["index_search_hits"]:
+        sys.exit("message index check failed: indexed messages are not returned by search")
+    return report
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
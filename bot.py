@@ -1,30 +1,59 @@
 import os
+import io
 import sys
+import json
+import bisect
+import heapq
+import hashlib
+import sqlite3
 import asyncio
 import logging
 import time
+import random
 import re
+import signal
+import queue
+import atexit
+import threading
 import traceback
-from datetime import datetime
+from invoice_render import check_invoice_font
+from collections import OrderedDict, deque
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timedelta, timezone
 
 # استيراد المكتبات
 from bson.objectid import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient
-from telethon import TelegramClient, events, Button, functions, types
+from telethon import TelegramClient, events, Button, functions, types, utils
 from telethon.sessions import StringSession
-from telethon.tl.types import UserStatusOnline, UserStatusRecently
+from telethon.tl.types import (UserStatusOnline, UserStatusRecently, UpdateUserStatus,
+                               UpdateChannelParticipant, UpdateChatParticipant, UpdateChatParticipantAdmin)
 from telethon.tl.functions.messages import ImportChatInviteRequest
 from telethon.tl.functions.channels import JoinChannelRequest, LeaveChannelRequest
-from telethon.errors import FloodWaitError
+from telethon.errors import (FloodWaitError, UserAlreadyParticipantError, InviteHashExpiredError, InviteHashInvalidError,
+                             UsernameInvalidError, UsernameNotOccupiedError, ChannelPrivateError, FileReferenceExpiredError,
+                             UserNotParticipantError, ChannelInvalidError)
+from pymongo import ASCENDING, UpdateOne, DeleteOne
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
 from aiohttp import web
-from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
 # ==============================================================================
 #                               1. إعدادات النظام
 # ==============================================================================
 load_dotenv()
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+# السجلات تمر عبر طابور وخيط منفصل: الكتابة للمخرجات لا توقف حلقة الأحداث
+log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_listener = QueueListener(log_queue, _log_output, respect_handler_level=True)
+# التنسيق الكامل في خيط المخرجات فقط؛ الطابور يحمل نص الرسالة كما هو (وإلا تتكرر المقدمة مرتين)
+_log_enqueue = QueueHandler(log_queue)
+_log_enqueue.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_log_enqueue])
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger("SaudiMerchantBot_MultiAccount_Fixed")
 
 API_ID = int(os.getenv("API_ID") or 0)
@@ -33,42 +62,459 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 MONGO_URI = os.getenv("MONGO_URI")
 SAMBANOVA_API_KEY = os.getenv("SAMBANOVA_API_KEY", "key")
 
+# المشرفون على البوت نفسه (أوامر التشخيص): آيديات مفصولة بفواصل، ورمز لنقاط HTTP الخاصة
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
 if not all([API_ID, API_HASH, BOT_TOKEN, MONGO_URI]):
     sys.exit(1)
 
-try:
-    ai_client = AsyncOpenAI(base_url="https://api.sambanova.ai/v1", api_key=SAMBANOVA_API_KEY)
-    AI_MODEL = "Meta-Llama-3.1-405B-Instruct"
-except: ai_client = None
+# وضع التوزيع على عدة عمليات: 0 = عملية واحدة (الافتراضي)
+# العملية الرئيسية تشغل البوت والخادم، وكل عامل (--worker N) يشغل شريحة من الحسابات
+SHARD_COUNT = int(os.getenv("SHARD_COUNT") or 0)
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR", "/tmp")
+IS_SHARD_WORKER = '--worker' in sys.argv
+SHARD_ID = int(sys.argv[sys.argv.index('--worker') + 1]) if IS_SHARD_WORKER else None
+
+# عميل الذكاء يُنشأ عند أول استخدام فقط (استيراد openai ثقيل ويبطئ التشغيل)
+ai_client = None
+AI_MODEL = "Meta-Llama-3.1-405B-Instruct"
+
+def get_ai_client():
+    global ai_client
+    if ai_client is None:
+        try:
+            from openai import AsyncOpenAI
+            ai_client = AsyncOpenAI(base_url="https://api.sambanova.ai/v1", api_key=SAMBANOVA_API_KEY)
+        except Exception: ai_client = False
+    return ai_client or None
 
 STRICT_RULE = "أنت تاجر سعودي محترف."
 
+AI_MAX_CONCURRENCY = 16      # أقصى طلبات ذكاء متزامنة في العملية
+AI_MAX_PER_OWNER = 2         # أقصى طلبات متزامنة لكل مستخدم (حتى لا يحتكر حساب واحد الطلبات)
+AI_TIMEOUT = 30              # مهلة الطلب الكاملة (ثواني)
+AI_CACHE_TTL = 3600          # صلاحية الرد المحفوظ لنفس السؤال
+AI_CACHE_SIZE = 2000
+AI_HISTORY_MESSAGES = 8      # آخر N رسائل (سؤال/جواب) تُرسل كسياق لكل محادثة
+AI_HISTORY_CHATS = 5000      # أقصى عدد محادثات محفوظ سياقها
+AI_STREAMING = os.getenv("AI_STREAMING", "0") == "1"  # تعديل الرد أثناء وصول الكلمات
+AI_STREAM_EDIT_INTERVAL = 1.5
+AI_MAX_PENDING_PER_OWNER = 8  # أقصى محادثات ذكاء تنتظر أو تعمل لكل حساب، والزائد يُسقط
+
 # ==============================================================================
 #                               2. الذاكرة (معزولة لكل مستخدم)
 # ==============================================================================
 # تخزين الكلاينت لكل مستخدم: {owner_id: TelegramClient}
 active_userbot_clients = {}
 
-# تخزين المهام الخلفية لكل مستخدم: {owner_id: asyncio.Task}
-# هذا يضمن أن كل حساب له "سلك" خاص فيه للنشر
-user_autopost_tasks = {}
-
 # تخزين الحالة المؤقتة للإعداد
 user_current_state = {}
 temporary_autopost_config = {}
 temporary_task_data = {}
 
-# تخزين التكرار (Cooldown)
-reply_cooldown_timestamps = {}
+# تخزين التكرار (Cooldown): مخازن محدودة الحجم تنتهي تلقائياً (انظر CooldownStore)
+# تُعرّف بعد قاعدة البيانات لأنها تُحفظ فيها عند الإيقاف
+
+# مطابق الكلمات المفتاحية المترجم لكل مستخدم: {owner_id: KeywordMatcher}
+# يُبنى مرة واحدة من القاعدة ويُعاد بناؤه فقط عند إضافة/حذف رد
+reply_matchers = {}
+reply_matcher_generations = {}  # {owner_id: عداد الإبطال} حتى لا يثبّت بناء متأخر مطابقاً قديماً
+
+# كاش إعدادات كل مستخدم (النشر/الذكاء/الجروبات المجمدة): {owner_id: OwnerSettings}
+# يُمسح عند أي كتابة من البوت أو عند وصول تغيير من Change Stream، ويُعاد تحميله بعد OWNER_SETTINGS_TTL
+# احتياطاً لتغيير فات Change Stream
+owner_settings_cache = {}
+owner_settings_generations = {}  # {owner_id: عداد الإبطال} مثل reply_matcher_generations
+owner_settings_epoch = 0         # يزيد عند مسح الكل
+OWNER_SETTINGS_TTL = 600
+
+# مشرف العمليات في وضع التوزيع (None = كل الحسابات في هذه العملية)
+shard_supervisor = None
+
+# زمن الجاهزية لكل حساب عند التشغيل (ثواني): {owner_id: float}
+userbot_startup_metrics = {}
+
+# تخزين آخر رسائل للحذف: {(owner_id, group_id): message_id}
+# تُحفظ في autopost_state لتبقى قابلة للحذف بعد إعادة التشغيل
+last_published_message_ids = {}
+
+# ==============================================================================
+#                               2.1 المقاييس (Prometheus /metrics)
+# ==============================================================================
+# سجل مقاييس بسيط بصيغة Prometheus النصية (بدون مكتبات إضافية).
+# المقاييس ذات callback تُحسب لحظة القراءة من الهياكل الموجودة (المُجدول، الطوابير...).
+
+METRICS_REGISTRY = []
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metric:
+    def __init__(self, name, help_text, kind, labelnames=(), callback=None):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.callback = callback  # يعيد [(labels dict, value)] عند القراءة
+        self._values = {}
+        # بعض القياسات تأتي من خيوط أخرى (مستمع Mongo يعمل على خيوط pymongo) والقراءة على حلقة الأحداث
+        self._lock = threading.Lock()
+        METRICS_REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+    def samples(self):
+        if self.callback:
+            return [[self.name, labels, value] for labels, value in self.callback()]
+        with self._lock: items = list(self._values.items())
+        return [[self.name, dict(zip(self.labelnames, key)), value] for key, value in items]
+
+class Counter(Metric):
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        super().__init__(name, help_text, "counter", labelnames, callback)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock: self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        super().__init__(name, help_text, "gauge", labelnames, callback)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock: self._values[key] = value
+
+class Histogram(Metric):
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, help_text, "histogram", labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None: state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: state[0][i] += 1
+            state[1] += value; state[2] += 1
+
+    def _snapshot(self, key=None):
+        with self._lock:
+            if key is not None:
+                state = self._values.get(key)
+                return state and [list(state[0]), state[1], state[2]]
+            return [(k, list(counts), total, count) for k, (counts, total, count) in self._values.items()]
+
+    def samples(self):
+        out = []
+        for key, counts, total, count in self._snapshot():
+            labels = dict(zip(self.labelnames, key))
+            for bound, c in zip(self.buckets, counts):
+                out.append([f"{self.name}_bucket", {**labels, "le": str(bound)}, c])
+            out.append([f"{self.name}_bucket", {**labels, "le": "+Inf"}, count])
+            out.append([f"{self.name}_sum", labels, total])
+            out.append([f"{self.name}_count", labels, count])
+        return out
+
+    def quantile(self, q, **labels):
+        """ تقدير النسبة المئوية من الحاويات (لتقارير القياس) """
+        state = self._snapshot(self._key(labels))
+        if not state or not state[2]: return 0.0
+        target = q * state[2]
+        for bound, c in zip(self.buckets, state[0]):
+            if c >= target: return bound
+        return float('inf')
+
+def collect_metrics():
+    """ كل المقاييس كقائمة عائلات قابلة لـ JSON (لدمجها من العمال في وضع التوزيع) """
+    families = []
+    for metric in METRICS_REGISTRY:
+        try: families.append([metric.name, metric.kind, metric.help_text, metric.samples()])
+        except Exception as e: logger.warning(f"Metric {metric.name} failed: {e}")
+    return families
+
+def merge_metric_families(sources):
+    """ sources: [(labels إضافية, families)] -> families مدمجة بنفس الترتيب """
+    merged = {}
+    for extra_labels, families in sources:
+        for name, kind, help_text, samples in families:
+            family = merged.setdefault(name, [name, kind, help_text, []])
+            family[3].extend([n, {**labels, **extra_labels}, v] for n, labels, v in samples)
+    return list(merged.values())
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_metrics(families):
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample_name, labels, value in samples:
+            label_text = ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items())
+            lines.append(f"{sample_name}{{{label_text}}} {value}" if label_text else f"{sample_name} {value}")
+    return "\n".join(lines) + "\n"
+
+# --- مقاييس المسارات الساخنة ---
+handler_latency = Histogram("bot_handler_seconds", "Userbot handler latency", ["handler"])
+mongo_latency = Histogram("bot_mongo_command_seconds", "Mongo command latency", ["collection", "command"])
+error_counter = Counter("bot_errors_total", "Errors caught in handlers and engines", ["where", "error"])
+loop_lag = Histogram("bot_event_loop_lag_seconds", "Event loop scheduling lag", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+bio_update_latency = Histogram("bot_bio_update_seconds", "Auto-bio update latency per account", ["owner"])
+event_queue_wait = Histogram("bot_event_queue_wait_seconds", "Time an incoming event waits in the account queue", ["priority"])
+
+# --- مقاييس تُقرأ لحظة الطلب من هياكل البوت ---
+def _scheduler_samples(attribute):
+    return [({"owner": owner_id}, getattr(c.sender, attribute)) for owner_id, c in list(active_userbot_clients.items())]
+
+def _queue_depth_samples():
+    samples = [({"queue": "send", "owner": o, "lane": str(lane)}, depth)
+               for o, c in list(active_userbot_clients.items()) for lane, depth in enumerate(c.sender.lane_depths())]
+    samples += [({"queue": "events", "owner": o, "lane": EVENT_PRIORITY_NAMES[p]}, depth)
+                for o, c in list(active_userbot_clients.items()) for p, depth in enumerate(c.inbox.depths())]
+    samples += [({"queue": "write_behind", "owner": "", "lane": b.collection.name}, len(b)) for b in WRITE_BUFFERS]
+    samples += [({"queue": "message_index", "owner": o, "lane": ""}, c.messages.pending)
+                for o, c in list(active_userbot_clients.items()) if c.messages is not None]
+    return samples
+
+def _event_queue_samples(attribute):
+    return [({"owner": o, "priority": EVENT_PRIORITY_NAMES[p]}, n)
+            for o, c in list(active_userbot_clients.items()) for p, n in enumerate(getattr(c.inbox, attribute))]
+
+def _engine_task_samples():
+    counts = {}
+    for task in asyncio.all_tasks():
+        name = task.get_name()
+        engine = name.split(':', 1)[0] if ':' in name else "other"
+        counts[engine] = counts.get(engine, 0) + 1
+    return [({"engine": engine}, count) for engine, count in counts.items()]
+
+def _cooldown_samples():
+    return [({"store": store.name, "stat": stat}, value) for store in COOLDOWN_STORES for stat, value in store.stats().items()]
+
+Counter("bot_account_sent_total", "Messages sent per account", ["owner"], callback=lambda: _scheduler_samples("sent"))
+Counter("bot_account_failed_total", "Failed sends per account", ["owner"], callback=lambda: _scheduler_samples("failed"))
+Counter("bot_account_flood_wait_seconds_total", "FloodWait seconds per account", ["owner"], callback=lambda: _scheduler_samples("flood_wait_seconds"))
+Counter("bot_account_send_dropped_total", "Fire-and-forget sends shed on a full lane", ["owner"], callback=lambda: _scheduler_samples("dropped"))
+Gauge("bot_queue_depth", "Pending items per queue", ["queue", "owner", "lane"], callback=_queue_depth_samples)
+Counter("bot_events_queued_total", "Incoming events accepted per account", ["owner", "priority"], callback=lambda: _event_queue_samples("queued"))
+Counter("bot_events_dropped_total", "Incoming events shed under overload", ["owner", "priority"], callback=lambda: _event_queue_samples("dropped"))
+Gauge("bot_engine_tasks", "Live asyncio tasks per engine", ["engine"], callback=_engine_task_samples)
+Gauge("bot_cooldown", "Cooldown store size and counters", ["store", "stat"], callback=_cooldown_samples)
+Gauge("bot_active_accounts", "Connected userbot accounts", callback=lambda: [({}, len(active_userbot_clients))])
+Gauge("bot_autopost_scheduled", "Groups tracked by the autopost scheduler", callback=lambda: [({}, len(autopost_scheduler))])
+
+def record_error(where, exc):
+    """ بديل except: pass — الخطأ لا يُبلع بصمت بل يُعد بعنوان واضح """
+    error_counter.inc(where=where, error=type(exc).__name__)
+    logger.debug(f"{where}: {type(exc).__name__}: {exc}")
+
+async def observe_handler(name, coro):
+    started = time.perf_counter()
+    try: return await coro
+    finally: handler_latency.observe(time.perf_counter() - started, handler=name)
+
+async def monitor_event_loop_lag(interval=0.5):
+    """ يقيس تأخر الحلقة: كم تأخرت sleep عن موعدها """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(loop.time() - started - interval, 0.0))
+
+class MongoTimingListener(monitoring.CommandListener):
+    """ توقيت كل أمر Mongo حسب المجموعة ونوع الأمر (بدون تعديل أي استعلام) """
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore": target = event.command.get("collection")
+        self._pending[event.request_id] = target if isinstance(target, str) else ""
+
+    def _finish(self, event):
+        collection = self._pending.pop(event.request_id, "")
+        mongo_latency.observe(event.duration_micros / 1e6, collection=collection, command=event.command_name)
+
+    def succeeded(self, event): self._finish(event)
+    def failed(self, event): self._finish(event)
 
-# تخزين آخر رسائل للحذف
-last_published_message_ids = {} 
+# ==============================================================================
+#                               2.2 المُحلل عند الطلب (Profiler)
+# ==============================================================================
+# يعمل فقط عند الطلب (/profile أو /debug/profile) لمدة محددة ثم يزيل نفسه:
+#   - كل خطوة من حلقة الأحداث تُوقّت (wall و CPU) وتُنسب للمهمة/الكوروتين صاحبها
+#   - خيط يأخذ عينات من مكدس الحلقة ليعرف أي سطر في هذا الملف يستهلك الوقت
+#   - الخطوات البطيئة تُسجل مع مكان توقف الكوروتين، و loop debug اختياري
+
+PROFILE_MAX_SECONDS = 120
+PROFILE_SAMPLE_INTERVAL = 0.005   # فاصل العينات (ثواني)
+PROFILE_SLOW_CALLBACK = 0.1       # خطوة أطول من هذا = بطيئة
+PROFILE_TOP = 25
+_SOURCE_FILE = sys._getframe().f_code.co_filename
+profile_lock = asyncio.Lock()
+
+def _callback_label(callback):
+    """ اسم المهمة (إن كانت مسماة) أو اسم الكوروتين/الدالة """
+    task = getattr(callback, '__self__', None)
+    if isinstance(task, asyncio.Task):
+        name = task.get_name()
+        return name if not name.startswith("Task-") else getattr(task.get_coro(), '__qualname__', name)
+    return getattr(callback, '__qualname__', type(callback).__name__)
+
+def _callback_location(callback):
+    task = getattr(callback, '__self__', None)
+    frame = getattr(task.get_coro(), 'cr_frame', None) if isinstance(task, asyncio.Task) else None
+    return f"{frame.f_code.co_name}:{frame.f_lineno}" if frame else ""
+
+class _RecordCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        if len(self.records) < PROFILE_TOP: self.records.append(record.getMessage()[:500])
+
+class LoopProfiler:
+    def __init__(self):
+        self.steps = {}          # {label: [خطوات, wall, cpu, أطول خطوة]}
+        self.slow = []           # [(ثواني, label, موقع)]
+        self.samples = {}        # {سطر: عدد العينات}
+        self.sample_count = 0
+
+    def _install(self):
+        original = asyncio.events.Handle._run
+        profiler = self
+
+        def _run(handle):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try: return original(handle)
+            finally:
+                wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+                label = _callback_label(handle._callback)
+                stat = profiler.steps.get(label)
+                if stat is None: stat = profiler.steps[label] = [0, 0.0, 0.0, 0.0]
+                stat[0] += 1; stat[1] += wall; stat[2] += cpu; stat[3] = max(stat[3], wall)
+                if wall >= PROFILE_SLOW_CALLBACK:
+                    profiler.slow.append((round(wall, 3), label, _callback_location(handle._callback)))
+
+        asyncio.events.Handle._run = _run
+        return original
+
+    def _sample(self, thread_id, stop):
+        while not stop.wait(PROFILE_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None: continue
+            self.sample_count += 1
+            if frame.f_code.co_filename.endswith("selectors.py"):
+                where = "<idle>"
+            else:
+                top, inner = frame, None
+                while frame is not None and inner is None:
+                    if frame.f_code.co_filename == _SOURCE_FILE: inner = frame
+                    frame = frame.f_back
+                where = f"{inner.f_code.co_name}:{inner.f_lineno}" if inner else ""
+                where = f"{where} <- {top.f_code.co_name} ({os.path.basename(top.f_code.co_filename)})"
+            self.samples[where] = self.samples.get(where, 0) + 1
+
+    async def run(self, seconds, debug=False):
+        loop = asyncio.get_running_loop()
+        handlers_before = {k: (v[1], v[2]) for k, v in handler_latency._values.items()}
+        collector = _RecordCollector()
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample, args=(threading.get_ident(), stop), daemon=True)
+        original = self._install()
+        if debug:
+            loop.slow_callback_duration = PROFILE_SLOW_CALLBACK
+            loop.set_debug(True)
+            logging.getLogger("asyncio").addHandler(collector)
+        sampler.start()
+        started = time.perf_counter()
+        try: await asyncio.sleep(seconds)
+        finally:
+            asyncio.events.Handle._run = original
+            stop.set()
+            if debug:
+                loop.set_debug(False)
+                logging.getLogger("asyncio").removeHandler(collector)
+        elapsed = time.perf_counter() - started
+
+        handlers = []
+        for key, state in handler_latency._values.items():
+            total, count = state[1] - handlers_before.get(key, (0.0, 0))[0], state[2] - handlers_before.get(key, (0.0, 0))[1]
+            if count: handlers.append([key[0], count, round(total, 4), round(total / count * 1000, 2)])
+        tasks = sorted(([label, n, round(wall, 4), round(cpu, 4), round(longest, 4)] for label, (n, wall, cpu, longest) in self.steps.items()),
+                       key=lambda row: row[3], reverse=True)
+        return {
+            "seconds": round(elapsed, 2),
+            "loop_busy_cpu": round(sum(row[3] for row in tasks), 4),
+            "tasks": tasks[:PROFILE_TOP],                       # [label, خطوات, wall, cpu, أطول خطوة]
+            "handlers": sorted(handlers, key=lambda row: row[2], reverse=True),  # [handler, عدد, مجموع, متوسط ms]
+            "hotspots": [[where, n, round(100 * n / max(self.sample_count, 1), 1)] for where, n in
+                         sorted(self.samples.items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP]],
+            "slow_callbacks": sorted(self.slow, reverse=True)[:PROFILE_TOP],
+            "debug_warnings": collector.records,
+            "structures": profile_structures(),
+        }
+
+def profile_structures():
+    """ أحجام أكبر الهياكل في الذاكرة (عدد العناصر + الحجم السطحي بالبايت) """
+    structures = {
+        "reply_cooldown_timestamps": reply_cooldown_timestamps,
+        "ai_chat_cooldowns": ai_chat_cooldowns,
+        "user_current_state": user_current_state,
+        "temporary_autopost_config": temporary_autopost_config,
+        "temporary_task_data": temporary_task_data,
+        "autopost_scheduler": autopost_scheduler,
+        "bio_scheduler": bio_scheduler,
+        "last_published_message_ids": last_published_message_ids,
+        "owner_settings_cache": owner_settings_cache,
+        "reply_matchers": reply_matchers,
+        "ai_response_cache": ai_response_cache,
+        "ai_chat_histories": ai_chat_histories,
+        "admin_status_cache": admin_status_cache,
+    }
+    rows = [[name, len(obj), sys.getsizeof(getattr(obj, '_entries', obj))] for name, obj in structures.items()]
+    clients = list(active_userbot_clients.values())
+    rows += [
+        ["send_queues", sum(c.sender.queue_depth() for c in clients), 0],
+        ["dialog_indexes", sum(len(c.dialogs) for c in clients), 0],
+        ["join_queues", sum(len(c.joiner._queue) for c in clients), 0],
+        ["event_queues", sum(len(c.inbox) for c in clients), 0],
+        ["media_caches", sum(len(c.media) for c in clients), sum(c.media.size for c in clients)],
+        ["message_indexes", sum(c.messages.pending for c in clients if c.messages is not None), 0],
+        ["asyncio_tasks", len(asyncio.all_tasks()), 0],
+    ]
+    return sorted(rows, key=lambda row: row[1], reverse=True)
+
+async def run_profile(seconds, debug=False):
+    """ تشغيل المُحلل في هذه العملية (واحد فقط في كل مرة) """
+    if profile_lock.locked(): raise RuntimeError("a profile is already running")
+    async with profile_lock:
+        return await LoopProfiler().run(max(1.0, min(float(seconds), PROFILE_MAX_SECONDS)), debug)
+
+def format_profile_report(name, report):
+    lines = [f"== {name}: {report['seconds']}s, loop CPU {report['loop_busy_cpu']}s"]
+    lines.append("-- tasks (steps, wall s, cpu s, longest s)")
+    lines += [f"{label}: {n}, {wall}, {cpu}, {longest}" for label, n, wall, cpu, longest in report['tasks']]
+    lines.append("-- handlers (count, total s, avg ms)")
+    lines += [f"{label}: {n}, {total}, {avg}" for label, n, total, avg in report['handlers']]
+    lines.append("-- hotspots (samples, %)")
+    lines += [f"{where}: {n}, {pct}%" for where, n, pct in report['hotspots']]
+    lines.append("-- slow callbacks (s, task, suspended at)")
+    lines += [f"{wall}, {label}, {where}" for wall, label, where in report['slow_callbacks']]
+    lines += [f"!! {warning}" for warning in report['debug_warnings']]
+    lines.append("-- structures (entries, shallow bytes)")
+    lines += [f"{name}: {n}, {size}" for name, n, size in report['structures']]
+    return "\n".join(lines)
 
 # ==============================================================================
 #                               3. قاعدة البيانات
 # ==============================================================================
 try:
-    mongo_client = AsyncIOMotorClient(MONGO_URI)
+    mongo_client = AsyncIOMotorClient(MONGO_URI, event_listeners=[MongoTimingListener()])
     database = mongo_client['MyTelegramBotDB']
     
     sessions_collection = database['sessions']
@@ -78,346 +524,2374 @@ try:
     paused_groups_collection = database['paused_groups']
     admins_watch_collection = database['admins_watch']
     subscriptions_collection = database['subscriptions']
+    cooldowns_collection = database['cooldowns']
+    broadcast_jobs_collection = database['broadcast_jobs']
+    search_replied_collection = database['search_replied']
+    entity_cache_collection = database['entity_cache']
+    autopost_state_collection = database['autopost_state']
+    media_blobs_collection = database['media_blobs']
+    bio_settings_collection = database['bio_settings']
     
     print("✅ DB Connected & Ready")
 except: sys.exit(1)
 
+# الفهارس حسب شكل كل استعلام: (المجموعة، المفاتيح، فريد؟)
+COLLECTION_INDEXES = [
+    (replies_collection, [("owner_id", ASCENDING), ("keyword", ASCENDING)], True),
+    (ai_settings_collection, [("owner_id", ASCENDING)], True),
+    (autopost_config_collection, [("owner_id", ASCENDING)], True),
+    (paused_groups_collection, [("owner_id", ASCENDING), ("chat_id", ASCENDING)], True),
+    (admins_watch_collection, [("owner_id", ASCENDING), ("username", ASCENDING)], True),
+    (subscriptions_collection, [("owner_id", ASCENDING), ("chat_id", ASCENDING)], True),
+    (subscriptions_collection, [("owner_id", ASCENDING), ("join_time", ASCENDING)], False),
+    (cooldowns_collection, [("store", ASCENDING), ("owner", ASCENDING)], False),
+    (cooldowns_collection, [("store", ASCENDING), ("expires", ASCENDING)], False),
+    (search_replied_collection, [("owner_id", ASCENDING), ("user_id", ASCENDING)], True),
+    (autopost_state_collection, [("owner_id", ASCENDING), ("chat_id", ASCENDING)], True),
+    (bio_settings_collection, [("owner_id", ASCENDING)], True),
+]
+
+async def ensure_indexes():
+    """ إنشاء الفهارس عند التشغيل (لا يفعل شيئاً إذا كانت موجودة) """
+    for collection, keys, unique in COLLECTION_INDEXES:
+        try: await collection.create_index(keys, unique=unique)
+        except PyMongoError as e:
+            # غالباً تكرار قديم يمنع الفهرس الفريد: ننشئه عادياً بدل أن نفشل
+            logger.warning(f"Index {collection.name}{keys} failed ({e}), creating non-unique")
+            try: await collection.create_index(keys)
+            except PyMongoError as e: record_error("ensure_index", e)
+
+class WriteBehindBuffer:
+    """
+    يجمع عمليات الكتابة غير العاجلة ويرسلها دفعة واحدة (bulk_write) كل فترة أو عند امتلاء الدفعة.
+    العمليات بنفس المفتاح تُدمج (الأخيرة تفوز) فلا تتكرر الكتابة لنفس الوثيقة.
+    الدفعة الفاشلة تعود للطابور (بدون أن تغطي عملية أحدث لنفس المفتاح) وتُعاد بمهلة تتضاعف.
+    """
+
+    RETRY_MAX = 60  # أقصى مهلة بين محاولات دفعة فاشلة (ثواني)
+
+    def __init__(self, collection, flush_interval=2.0, max_batch=500):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._ops = {}
+        self._flusher = None
+        self._full = asyncio.Event()
+        self._backoff = 0.0
+        self.flushed_ops = 0
+        self.failed_flushes = 0
+
+    def __len__(self):
+        return len(self._ops)
+
+    def add(self, op, key=None):
+        self._ops[key if key is not None else id(op)] = op
+        if len(self._ops) >= self.max_batch: self._full.set()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._run())
+
+    async def flush(self):
+        if not self._ops: return
+        items = list(self._ops.items()); self._ops.clear(); self._full.clear()
+        try:
+            await self.collection.bulk_write([op for _, op in items], ordered=False)
+            self.flushed_ops += len(items)
+            self._backoff = 0.0
+        except PyMongoError as e:
+            # العمليات upsert/حذف فإعادة الناجح منها لا تضر؛ setdefault: ما أُضيف أثناء الإرسال أحدث
+            for key, op in items: self._ops.setdefault(key, op)
+            self.failed_flushes += 1
+            self._backoff = min(self._backoff * 2 or self.flush_interval, self.RETRY_MAX)
+            logger.warning(f"Bulk write to {self.collection.name} failed ({len(items)} ops), retry in {self._backoff:g}s: {e}")
+
+    async def _run(self):
+        while self._ops:
+            if self._backoff: await asyncio.sleep(self._backoff)
+            else:
+                try: await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError: pass
+            await self.flush()
+
+subscriptions_writes = WriteBehindBuffer(subscriptions_collection)
+search_replied_writes = WriteBehindBuffer(search_replied_collection)
+autopost_state_writes = WriteBehindBuffer(autopost_state_collection)
+WRITE_BUFFERS = (subscriptions_writes, search_replied_writes, autopost_state_writes)
+
+async def flush_write_buffers():
+    for buffer in WRITE_BUFFERS: await buffer.flush()
+
 # ==============================================================================
 #                               4. الخادم
 # ==============================================================================
-bot_client = TelegramClient('bot_session', API_ID, API_HASH)
+# العامل يستخدم البوت للتعديل والتحميل فقط (بدون استقبال تحديثات) بملف جلسة خاص بشريحته،
+# فإعادة تشغيله تستأنف الجلسة بدل تسجيل دخول جديد للبوت في كل مرة
+if IS_SHARD_WORKER: bot_client = TelegramClient(f'bot_session_shard{SHARD_ID}', API_ID, API_HASH, receive_updates=False)
+else: bot_client = TelegramClient('bot_session', API_ID, API_HASH)
+bot_ready = asyncio.Event()  # يُفعّل بعد تسجيل دخول البوت (تحتاجه المهام المستأنفة)
 
 async def web_request_handler(request):
-    return web.Response(text=f"Bot Running. Active Accounts: {len(active_userbot_clients)}")
+    status = await fleet_status()
+    return web.Response(text=f"Bot Running. Active Accounts: {status['accounts']} | Queued Sends: {status['queued_sends']}")
+
+async def metrics_request_handler(request):
+    families = collect_metrics()
+    if shard_supervisor is not None:
+        families = merge_metric_families([({"shard": "supervisor"}, families)] + await shard_supervisor.collect_metrics())
+    return web.Response(text=render_metrics(families), content_type="text/plain", charset="utf-8")
+
+async def profile_request_handler(request):
+    """ GET /debug/profile?seconds=10&debug=1 مع رمز ADMIN_TOKEN (X-Admin-Token أو ?token=) """
+    token = request.headers.get("X-Admin-Token") or request.query.get("token", "")
+    if not ADMIN_TOKEN or token != ADMIN_TOKEN: return web.Response(status=403, text="forbidden")
+    try: reports = await fleet_profile(request.query.get("seconds", 10), request.query.get("debug") == "1")
+    except RuntimeError as e: return web.Response(status=409, text=str(e))
+    return web.json_response(reports, dumps=lambda data: json.dumps(data, default=str))
 
 async def start_web_server():
     app = web.Application()
     app.router.add_get('/', web_request_handler)
+    app.router.add_get('/metrics', metrics_request_handler)
+    app.router.add_get('/debug/profile', profile_request_handler)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', 8080)
     await site.start()
 
-async def get_ai_response(messages_list):
-    if not ai_client: return None
-    try:
-        response = await ai_client.chat.completions.create(model=AI_MODEL, messages=messages_list, temperature=0.7)
+async def get_ai_response(messages_list, on_delta=None):
+    """ طلب واحد للنموذج. مع on_delta يُستخدم البث ويُستدعى بالنص المتراكم عند كل دفعة """
+    client = get_ai_client()
+    if not client: return None
+    if on_delta is None:
+        response = await client.chat.completions.create(model=AI_MODEL, messages=messages_list, temperature=0.7)
         return response.choices[0].message.content
-    except: return None
+    text = ""
+    stream = await client.chat.completions.create(model=AI_MODEL, messages=messages_list, temperature=0.7, stream=True)
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            text += delta
+            await on_delta(text)
+    return text
+
+# ==============================================================================
+#                               4.0 مخزن التبريد (Cooldown Store)
+# ==============================================================================
+
+class CooldownStore:
+    """
+    مخزن تبريد بحد أقصى للذاكرة وانتهاء زمني.
+    مدة التبريد ثابتة لكل مخزن، لذا ترتيب الإدخال = ترتيب الانتهاء،
+    والمنتهي يُحذف من أول القائمة فقط (بدون مسح كامل).
+    """
+
+    def __init__(self, name, ttl, max_entries):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # {key: وقت الانتهاء}
+        self.hits = 0         # طلبات رُفضت لأنها ما زالت في التبريد
+        self.misses = 0       # طلبات سُمح لها
+        self.expirations = 0  # مفاتيح حُذفت لانتهاء وقتها
+        self.evictions = 0    # مفاتيح حُذفت بسبب الحد الأقصى
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _prune(self, now):
+        entries = self._entries
+        while entries:
+            key, expires_at = next(iter(entries.items()))
+            if expires_at > now: break
+            entries.popitem(last=False); self.expirations += 1
+
+    def try_acquire(self, key, now=None):
+        """ True إذا انتهى التبريد (ويبدأ تبريد جديد)، False إذا ما زال فعالاً """
+        now = now or time.time()
+        self._prune(now)
+        if key in self._entries:
+            self.hits += 1
+            return False
+        self.misses += 1
+        self._entries[key] = now + self.ttl
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False); self.evictions += 1
+        return True
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "expirations": self.expirations, "evictions": self.evictions}
+
+    async def save(self, owner_ids=None):
+        """ حفظ التبريدات الفعالة في القاعدة عند الإيقاف (لحسابات محددة في وضع التوزيع) """
+        self._prune(time.time())
+        query = {"store": self.name}
+        if owner_ids is not None: query["owner"] = {"$in": list(owner_ids)}
+        await cooldowns_collection.delete_many(query)
+        docs = [{"store": self.name, "owner": k[0], "key": list(k), "expires": exp}
+                for k, exp in self._entries.items() if owner_ids is None or k[0] in owner_ids]
+        for i in range(0, len(docs), 1000):
+            await cooldowns_collection.insert_many(docs[i:i + 1000], ordered=False)
+
+    async def load(self, owner_ids=None):
+        """
+        استرجاع التبريدات الفعالة بعد إعادة التشغيل أو عند استلام حسابات أثناء العمل.
+        المخزن قد يحوي تبريدات أحدث، لذا يُعاد ترتيب الكل حسب الانتهاء بعد الدمج
+        حتى يبقى الحذف من أول القائمة صحيحاً.
+        """
+        query = {"store": self.name, "expires": {"$gt": time.time()}}
+        if owner_ids is not None: query["owner"] = {"$in": list(owner_ids)}
+        merged = dict(self._entries)
+        async for doc in cooldowns_collection.find(query):
+            key = tuple(doc['key'])
+            merged[key] = max(merged.get(key, 0), doc['expires'])
+        self._entries = OrderedDict(sorted(merged.items(), key=lambda item: item[1]))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False); self.evictions += 1
+
+# تبريد الرد التلقائي: (owner, chat, sender, keyword) لمدة 10 دقائق
+reply_cooldown_timestamps = CooldownStore("auto_reply", ttl=600, max_entries=200_000)
+# تبريد الذكاء الاصطناعي: (owner, chat) لمدة 5 ثواني
+ai_chat_cooldowns = CooldownStore("ai_chat", ttl=5, max_entries=50_000)
+COOLDOWN_STORES = (reply_cooldown_timestamps, ai_chat_cooldowns)
+
+class TTLCache:
+    """ كاش LRU بحد أقصى للعناصر وصلاحية زمنية لكل عنصر """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # {key: (وقت الانتهاء, القيمة)}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        item = self._entries.get(key)
+        if item is None or item[0] <= time.monotonic():
+            if item is not None: del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value, ttl=None):
+        self._entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._entries.pop(key, None)
+        return item[1] if item else default
+
+async def save_cooldown_stores(owner_ids=None):
+    for store in COOLDOWN_STORES:
+        try: await store.save(owner_ids)
+        except Exception as e: logger.warning(f"Cooldown save failed {store.name}: {e}")
+
+async def load_cooldown_stores(owner_ids=None):
+    for store in COOLDOWN_STORES:
+        try: await store.load(owner_ids)
+        except Exception as e: logger.warning(f"Cooldown load failed {store.name}: {e}")
+
+# ==============================================================================
+#                               4.1 مطابق الكلمات المفتاحية (Aho-Corasick)
+# ==============================================================================
+
+class KeywordMatcher:
+    """ آلة Aho-Corasick: تمريرة واحدة على النص مهما كان عدد الكلمات المفتاحية """
+
+    def __init__(self, replies):
+        # replies: قائمة (keyword, reply) بنفس ترتيب القاعدة
+        self.replies = [(k, r) for k, r in replies if k]
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [None]  # أصغر ترتيب لكلمة تنتهي عند هذه الحالة (مع روابط الفشل)
+        for index, (keyword, _) in enumerate(self.replies):
+            state = 0
+            for ch in keyword:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({}); self._fail.append(0); self._out.append(None)
+                state = nxt
+            if self._out[state] is None: self._out[state] = index
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[nxt] = self._goto[fallback].get(ch, 0)
+                inherited = self._out[self._fail[nxt]]
+                if inherited is not None and (self._out[nxt] is None or inherited < self._out[nxt]):
+                    self._out[nxt] = inherited
+
+    def match(self, text):
+        """ يعيد (keyword, reply) لأول رد (حسب ترتيب القاعدة) تظهر كلمته في النص، أو None """
+        if not self.replies or not text: return None
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0; best = None
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            found = out[state]
+            if found is not None and (best is None or found < best):
+                best = found
+                if best == 0: break
+        return self.replies[best] if best is not None else None
+
+async def get_reply_matcher(owner_id):
+    """ يعيد المطابق من الذاكرة، ويبنيه من القاعدة عند أول استخدام فقط """
+    matcher = reply_matchers.get(owner_id)
+    if matcher is None:
+        generation = reply_matcher_generations.get(owner_id, 0)
+        docs = [(d['keyword'], d['reply']) async for d in replies_collection.find({"owner_id": owner_id}, {"keyword": 1, "reply": 1, "_id": 0})]
+        matcher = KeywordMatcher(docs)
+        # إبطال وصل أثناء القراءة: نستخدم النتيجة لهذه الرسالة فقط ولا نحفظها
+        if reply_matcher_generations.get(owner_id, 0) == generation: reply_matchers[owner_id] = matcher
+    return matcher
+
+def invalidate_reply_matcher(owner_id):
+    """ يُستدعى بعد أي تعديل على ردود المستخدم ليُعاد البناء عند الرسالة التالية """
+    reply_matcher_generations[owner_id] = reply_matcher_generations.get(owner_id, 0) + 1
+    reply_matchers.pop(owner_id, None)
+
+# ==============================================================================
+#                               4.2 كاش الإعدادات (Settings Cache)
+# ==============================================================================
+
+class OwnerSettings:
+    """ نسخة في الذاكرة من إعدادات المستخدم تقرأها المسارات الساخنة بدل القاعدة """
+    __slots__ = ('autopost', 'ai_active', 'paused_groups', 'bio', 'loaded_at')
+
+    def __init__(self, autopost, ai_active, paused_groups, bio=None):
+        self.autopost = autopost            # وثيقة autopost_config أو None
+        self.ai_active = ai_active          # حالة الذكاء الاصطناعي
+        self.paused_groups = paused_groups  # {chat_id: admin_id}
+        self.bio = bio                      # وثيقة bio_settings أو None
+        self.loaded_at = time.monotonic()
+
+async def get_owner_settings(owner_id):
+    """ يعيد الإعدادات من الذاكرة، ويحملها من القاعدة عند أول طلب أو بعد المسح أو انتهاء الصلاحية """
+    settings = owner_settings_cache.get(owner_id)
+    if settings is None or time.monotonic() - settings.loaded_at > OWNER_SETTINGS_TTL:
+        generation = (owner_settings_epoch, owner_settings_generations.get(owner_id, 0))
+        autopost = await autopost_config_collection.find_one({"owner_id": owner_id})
+        ai_doc = await ai_settings_collection.find_one({"owner_id": owner_id}, {"active": 1, "_id": 0})
+        paused = {d['chat_id']: d.get('admin_id') async for d in
+                  paused_groups_collection.find({"owner_id": owner_id}, {"chat_id": 1, "admin_id": 1, "_id": 0})}
+        bio = await bio_settings_collection.find_one({"owner_id": owner_id}, {"active": 1, "template": 1, "_id": 0})
+        settings = OwnerSettings(autopost, bool(ai_doc and ai_doc.get('active')), paused, bio)
+        # إبطال وصل أثناء القراءة: النتيجة قد تسبق الكتابة، فتُستخدم لهذا الطلب فقط ولا تُحفظ
+        if (owner_settings_epoch, owner_settings_generations.get(owner_id, 0)) == generation:
+            owner_settings_cache[owner_id] = settings
+    return settings
+
+def invalidate_owner_settings(owner_id=None):
+    """ مسح كاش مستخدم واحد (أو الكل إذا لم يُحدد) ليُعاد تحميله عند القراءة التالية """
+    global owner_settings_epoch
+    if owner_id is None:
+        owner_settings_epoch += 1
+        owner_settings_cache.clear()
+    else:
+        owner_settings_generations[owner_id] = owner_settings_generations.get(owner_id, 0) + 1
+        owner_settings_cache.pop(owner_id, None)
+
+async def watch_settings_changes():
+    """ يستمع لتغييرات القاعدة (إن كانت Replica Set) ليمسح الكاش عند التعديل من خارج البوت """
+    async def watch_collection(collection):
+        try:
+            async with collection.watch(full_document='updateLookup') as stream:
+                async for change in stream:
+                    doc = change.get('fullDocument') or {}
+                    # الحذف لا يحمل owner_id، لذا نمسح الكل (عمليات نادرة)
+                    invalidate_owner_settings(doc.get('owner_id'))
+        except PyMongoError as e:
+            logger.info(f"Change stream unavailable for {collection.name}: {e}")
+
+    await asyncio.gather(*(watch_collection(c) for c in (autopost_config_collection, ai_settings_collection,
+                                                                    paused_groups_collection, bio_settings_collection)))
+
+# ==============================================================================
+#                               4.3 فهرس حضور المشرفين (الرادار)
+# ==============================================================================
+
+class AdminPresenceIndex:
+    """
+    فهرس حضور المشرفين المراقبين لحساب واحد.
+    تُحل اليوزرات مرة واحدة، ثم تتحدث الحالة من أحداث UpdateUserStatus،
+    مع تحديث احتياطي مجمّع (users.getUsers) كل فترة.
+    """
+    REFRESH_INTERVAL = 300  # ثواني بين التحديثات الاحتياطية
+
+    def __init__(self, client, owner_id):
+        self.client = client
+        self.owner_id = owner_id
+        self._input_users = {}   # {user_id: InputUser}
+        self._online_until = {}  # {user_id: وقت انتهاء الاتصال} للمتصلين فقط
+        self._loaded = False
+
+    def _apply_status(self, user_id, status):
+        if isinstance(status, UserStatusOnline):
+            self._online_until[user_id] = status.expires.timestamp()
+        elif isinstance(status, UserStatusRecently):
+            # "متصل مؤخراً" لا يحمل وقتاً، نعتبره خطراً حتى التحديث القادم
+            self._online_until[user_id] = time.time() + self.REFRESH_INTERVAL
+        else:
+            self._online_until.pop(user_id, None)
+
+    async def reload(self):
+        """ حل اليوزرات المراقبة مرة واحدة (عند التشغيل أو بعد تعديل قائمة الرادار) """
+        self._loaded = True
+        self._input_users.clear(); self._online_until.clear()
+        async for admin_doc in admins_watch_collection.find({"owner_id": self.owner_id}, {"username": 1, "_id": 0}):
+            try:
+                admin_entity = await self.client.get_entity(admin_doc['username'])
+                self._input_users[admin_entity.id] = await self.client.get_input_entity(admin_entity)
+                self._apply_status(admin_entity.id, admin_entity.status)
+            except Exception as e: record_error("radar_reload", e)
+
+    def mark_dirty(self):
+        self._loaded = False
+
+    async def on_status_update(self, update):
+        if update.user_id in self._input_users:
+            self._apply_status(update.user_id, update.status)
+
+    async def refresh(self):
+        """ تحديث احتياطي: طلب واحد لكل 100 مشرف بدل get_entity لكل واحد """
+        if not self._loaded: return await self.reload()
+        ids = list(self._input_users)
+        for i in range(0, len(ids), 100):
+            batch = [self._input_users[x] for x in ids[i:i + 100]]
+            for user in await self.client(functions.users.GetUsersRequest(batch)):
+                self._apply_status(user.id, getattr(user, 'status', None))
+
+    async def any_online(self):
+        """ هل أي مشرف مراقب متصل الآن؟ (من الذاكرة، بدون طلبات شبكة) """
+        if not self._loaded: await self.reload()
+        now = time.time()
+        return any(until > now for until in self._online_until.values())
+
+    async def run_refresh_loop(self):
+        # يتوقف تلقائياً إذا استُبدل هذا الحساب بجلسة جديدة
+        while active_userbot_clients.get(self.owner_id) is self.client:
+            await asyncio.sleep(self.REFRESH_INTERVAL)
+            try:
+                if self._input_users or not self._loaded: await self.refresh()
+            except FloodWaitError as f: self.client.sender.note_flood_wait(f.seconds)
+            except Exception as e: logger.warning(f"Presence refresh failed {self.owner_id}: {e}")
+
+# ==============================================================================
+#                               4.4 جدولة الإرسال (Send Scheduler)
+# ==============================================================================
+
+# ممرات الأولوية: الأصغر يُرسل أولاً
+LANE_INTERACTIVE = 0   # الردود التلقائية والذكاء
+LANE_AUTOPOST = 1      # النشر التلقائي
+LANE_BULK = 2          # البرودكاست ومهام البحث والمغادرة
+
+ACCOUNT_SEND_RATE = 1.0     # رسائل/ثانية لكل حساب
+ACCOUNT_SEND_BURST = 5      # أقصى دفعة فورية لكل حساب
+CHAT_SEND_INTERVAL = 3.0    # أقل فاصل (ثواني) بين رسالتين لنفس المحادثة
+FLOOD_RETRY_LIMIT = 1       # إعادة المحاولة بعد FloodWait
+SEND_LANE_MAX = int(os.getenv("SEND_LANE_MAX") or 200)  # أقصى إرسالات بلا انتظار (post) في ممر واحد، والزائد يُسقط
+
+class TokenBucket:
+    """ دلو رموز بسيط: rate رمز/ثانية بحد أقصى capacity """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now=None):
+        """ الثواني المتبقية حتى يتوفر رمز (0 إذا متوفر الآن) """
+        now = now or time.monotonic()
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class SendScheduler:
+    """
+    مُجدول الإرسال الصادر لحساب واحد: دلو رموز للحساب، فاصل لكل محادثة،
+    وممرات أولوية. أي FloodWait من أي محرك يوقف الحساب كاملاً حتى ينتهي.
+    """
+
+    def __init__(self, owner_id, rate=ACCOUNT_SEND_RATE, burst=ACCOUNT_SEND_BURST, chat_interval=CHAT_SEND_INTERVAL):
+        self.owner_id = owner_id
+        self.chat_interval = chat_interval
+        self._lanes = (deque(), deque(), deque())
+        self._bucket = TokenBucket(rate, burst)
+        self._chat_ready_at = {}  # {chat_id: وقت السماح التالي}
+        self._backoff_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._worker = None
+        self._executing = set()  # مهام الإرسال الجارية (للإلغاء عند الإغلاق)
+        self.sent = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        self.dropped = 0  # إرسالات post أُسقطت لامتلاء الممر
+
+    def queue_depth(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    def lane_depths(self):
+        return [len(lane) for lane in self._lanes]
+
+    def note_flood_wait(self, seconds):
+        """ إيقاف الحساب بالكامل (كل الممرات) حتى تنتهي مهلة FloodWait """
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+        self._backoff_until = max(self._backoff_until, time.monotonic() + seconds)
+        logger.warning(f"FloodWait {seconds}s for {self.owner_id}, account backing off")
+
+    def submit(self, chat_id, factory, lane=LANE_BULK):
+        """
+        جدولة إرسال. factory دالة تعيد coroutine الإرسال الفعلي.
+        يعيد Future بنتيجة الإرسال (أو الخطأ).
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[lane].append([chat_id, factory, future, 0, lane])
+        self._wakeup.set()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run(), name=f"send_scheduler:{self.owner_id}")
+        return future
+
+    async def send(self, chat_id, factory, lane=LANE_BULK):
+        return await self.submit(chat_id, factory, lane)
+
+    def post(self, chat_id, factory, lane=LANE_BULK, where="send"):
+        """
+        جدولة بدون انتظار التسليم (لعمال الأحداث): الفشل يُعد في المقاييس بعنوان where.
+        لا أحد ينتظرها فلا شيء يبطئ إضافتها، لذا الممر الممتلئ يُسقطها ويعيد None.
+        """
+        if len(self._lanes[lane]) >= SEND_LANE_MAX:
+            self.dropped += 1
+            return None
+        future = self.submit(chat_id, factory, lane)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception() is None or record_error(where, f.exception()))
+        return future
+
+    def close(self):
+        if self._worker: self._worker.cancel()
+        for task in self._executing: task.cancel()
+        for lane in self._lanes:
+            for job in lane:
+                if not job[2].done(): job[2].cancel()
+            lane.clear()
+
+    def _pick(self, now):
+        """ أول مهمة جاهزة حسب الأولوية (تتخطى المحادثات التي لم ينتهِ فاصلها) """
+        earliest = None
+        for lane in self._lanes:
+            for index, job in enumerate(lane):
+                if index >= 64: break
+                if job[2].done():
+                    del lane[index]; return job, 0
+                ready_at = self._chat_ready_at.get(job[0], 0) if job[0] is not None else 0
+                if ready_at <= now:
+                    del lane[index]; return job, 0
+                earliest = ready_at if earliest is None else min(earliest, ready_at)
+        return None, (earliest - now if earliest else None)
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            if self._backoff_until > now:
+                await asyncio.sleep(self._backoff_until - now); continue
+            job, wait = self._pick(now)
+            if job is None:
+                # يُمسح دائماً: وإلا يبقى مفعلاً من submit() والمهام تنتظر فاصل محادثتها فتدور الحلقة بلا توقف
+                self._wakeup.clear()
+                try: await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError: pass
+                continue
+            if job[2].done(): continue
+            delay = self._bucket.delay(now)
+            if delay:
+                self._requeue(job); await asyncio.sleep(delay); continue
+            self._bucket.take()
+            if job[0] is not None:
+                self._chat_ready_at[job[0]] = now + self.chat_interval
+                if len(self._chat_ready_at) > 10_000:
+                    self._chat_ready_at = {k: v for k, v in self._chat_ready_at.items() if v > now}
+            task = asyncio.create_task(self._execute(job), name=f"send:{self.owner_id}")
+            self._executing.add(task)
+            task.add_done_callback(self._executing.discard)
+
+    def _requeue(self, job):
+        # تعود لمقدمة ممرها نفسه
+        self._lanes[job[4]].appendleft(job)
+        self._wakeup.set()
+
+    async def _execute(self, job):
+        chat_id, factory, future, retries, lane = job
+        try:
+            result = await factory()
+            self.sent += 1
+            if not future.done(): future.set_result(result)
+        except asyncio.CancelledError:
+            if not future.done(): future.cancel()
+            raise
+        except FloodWaitError as f:
+            self.note_flood_wait(f.seconds)
+            if retries < FLOOD_RETRY_LIMIT:
+                job[3] += 1; self._requeue(job)
+            else:
+                self.failed += 1
+                if not future.done(): future.set_exception(f)
+        except Exception as e:
+            self.failed += 1
+            if not future.done(): future.set_exception(e)
+
+# ==============================================================================
+#                               4.5 ذاكرة الكيانات (Entity Cache)
+# ==============================================================================
+
+ENTITY_CACHE_MAX_ROWS = 50_000     # أقصى عدد كيانات تُحفظ لكل حساب
+ENTITY_CACHE_FLUSH_INTERVAL = 300  # حفظ الكيانات الجديدة كل N ثواني
+
+class CachedStringSession(StringSession):
+    """
+    StringSession لا يحفظ الكيانات (id/access_hash)، فكل تشغيل يعيد حل الجروبات والمشرفين والروابط.
+    هذه النسخة تبدأ بكيانات محفوظة في القاعدة وتعلّم نفسها عند اكتشاف كيانات جديدة.
+    """
+
+    def __init__(self, string=None, rows=()):
+        super().__init__(string)
+        self._entities |= {tuple(row) for row in rows}
+        self.entities_dirty = False
+
+    def process_entities(self, tlo):
+        before = len(self._entities)
+        super().process_entities(tlo)
+        if len(self._entities) != before: self.entities_dirty = True
+
+    def entity_rows(self):
+        return [list(row) for row in list(self._entities)[:ENTITY_CACHE_MAX_ROWS]]
+
+async def load_entity_cache(owner_id):
+    doc = await entity_cache_collection.find_one({"_id": owner_id})
+    return doc.get('rows', []) if doc else []
+
+async def save_entity_cache(client):
+    session = client.session
+    if not isinstance(session, CachedStringSession) or not session.entities_dirty: return
+    session.entities_dirty = False
+    await entity_cache_collection.update_one({"_id": client.owner_id},
+        {"$set": {"rows": session.entity_rows(), "updated": time.time()}}, upsert=True)
+
+async def engine_entity_cache_flusher(client, owner_id):
+    while active_userbot_clients.get(owner_id) is client:
+        await asyncio.sleep(ENTITY_CACHE_FLUSH_INTERVAL)
+        try: await save_entity_cache(client)
+        except Exception as e: logger.warning(f"Entity cache save failed {owner_id}: {e}")
+
+async def save_all_entity_caches():
+    for client in list(active_userbot_clients.values()):
+        try: await save_entity_cache(client)
+        except Exception as e: record_error("entity_cache_save", e)
+
+# ==============================================================================
+#                               4.6 فهرس المحادثات (Dialog Index)
+# ==============================================================================
+
+DIALOG_USER, DIALOG_BOT, DIALOG_GROUP, DIALOG_CHANNEL = "user", "bot", "group", "channel"
+GROUP_PICKER_PAGE_SIZE = 20  # عدد الجروبات في كل صفحة من منتقي النشر
+
+class DialogEntry:
+    __slots__ = ('id', 'kind', 'title', 'members', 'last_activity')
+
+    def __init__(self, chat_id, kind, title, members=None, last_activity=0.0):
+        self.id = chat_id                   # الآيدي الموسوم (-100... للجروبات الخارقة والقنوات)
+        self.kind = kind                    # user / bot / group / channel
+        self.title = title or ""
+        self.members = members              # عدد الأعضاء إن كان معروفاً
+        self.last_activity = last_activity  # وقت آخر رسالة
+
+def dialog_kind(entity):
+    if isinstance(entity, types.User): return DIALOG_BOT if entity.bot else DIALOG_USER
+    if isinstance(entity, types.Channel) and not entity.megagroup: return DIALOG_CHANNEL
+    return DIALOG_GROUP
+
+class DialogIndex:
+    """
+    فهرس محادثات حساب واحد في الذاكرة: يُملأ مرة واحدة (iter_dialogs) عند التشغيل،
+    ثم يتحدث من أحداث الرسائل والانضمام/المغادرة. الإحصائيات وأهداف البرودكاست والبحث
+    ومنتقي الجروبات تقرأ منه بدون أي طلب للسيرفر.
+    """
+
+    def __init__(self, client, owner_id):
+        self.client = client
+        self.owner_id = owner_id
+        self._entries = {}  # {chat_id: DialogEntry}
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add_entity(self, entity, last_activity=None):
+        chat_id = utils.get_peer_id(entity)
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            entry = self._entries[chat_id] = DialogEntry(chat_id, dialog_kind(entity), utils.get_display_name(entity))
+        else: entry.title = utils.get_display_name(entity) or entry.title
+        members = getattr(entity, 'participants_count', None)
+        if members is not None: entry.members = members
+        if last_activity: entry.last_activity = max(entry.last_activity, last_activity)
+        return entry
+
+    def discard(self, chat_id):
+        self._entries.pop(chat_id, None)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._entries
+
+    async def load(self):
+        """ الملء الأولي: مرور واحد على كل المحادثات """
+        try:
+            async for dialog in self.client.iter_dialogs():
+                date = getattr(dialog, 'date', None)
+                self.add_entity(dialog.entity, date.timestamp() if date else None)
+        except Exception as e: record_error("dialog_index_load", e)
+        finally: self.ready.set()
+
+    def on_message(self, event):
+        """ يُستدعى من الموزع لكل رسالة: تحديث آخر نشاط (محادثة جديدة تُضاف من كيانها المخزن) """
+        entry = self._entries.get(event.chat_id)
+        if entry is None:
+            chat = getattr(event, 'chat', None)
+            if chat is None: return
+            entry = self.add_entity(chat)
+        entry.last_activity = time.time()
+
+    async def on_chat_action(self, event):
+        """ انضمام/مغادرة الحساب، تغيير العنوان، وعدد الأعضاء """
+        try:
+            entry = self._entries.get(event.chat_id)
+            about_me = self.client.my_id in (event.user_ids or [])
+            if (event.user_left or event.user_kicked) and about_me:
+                self.discard(event.chat_id); return
+            if entry is None or ((event.user_joined or event.user_added or event.created) and about_me):
+                chat = await event.get_chat()
+                if chat is not None: self.add_entity(chat, time.time())
+                return
+            if event.new_title: entry.title = event.new_title
+            if entry.members is not None:
+                if event.user_joined or event.user_added: entry.members += len(event.user_ids or [])
+                elif event.user_left or event.user_kicked: entry.members = max(0, entry.members - len(event.user_ids or []))
+        except Exception as e: record_error("dialog_index_action", e)
+
+    async def entries(self, kind=None):
+        await self.ready.wait()
+        return [e for e in self._entries.values() if kind is None or e.kind == kind]
+
+    async def ids(self, kind):
+        return [e.id for e in await self.entries(kind)]
+
+    async def counts(self):
+        result = {DIALOG_USER: 0, DIALOG_BOT: 0, DIALOG_GROUP: 0, DIALOG_CHANNEL: 0}
+        for entry in await self.entries(): result[entry.kind] += 1
+        return result
+
+    async def search_groups(self, query=None, offset=0, limit=GROUP_PICKER_PAGE_SIZE):
+        """ صفحة من الجروبات (الأنشط أولاً) مع فلترة اختيارية بالعنوان: (العدد الكلي، الصفحة) """
+        groups = await self.entries(DIALOG_GROUP)
+        if query:
+            query = query.lower()
+            groups = [e for e in groups if query in e.title.lower()]
+        groups.sort(key=lambda e: e.last_activity, reverse=True)
+        return len(groups), groups[offset:offset + limit]
+
+# ==============================================================================
+#                               4.7 ذاكرة الوسائط (Media Cache)
+# ==============================================================================
+# الوسائط تُعرّف ببصمة محتواها (sha256): نفس الملف يُحمّل ويُرفع مرة واحدة لكل حساب،
+# وبعد أول إرسال يُعاد استخدام مرجع الوسائط الناتج بدون رفع جديد.
+
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES") or 64 * 1024 * 1024)  # لكل حساب
+MEDIA_BLOB_MAX_BYTES = 15 * 1024 * 1024  # أقصى حجم لوسائط النشر المحفوظة في القاعدة (حد الوثيقة 16MB)
+
+class MediaEntry:
+    __slots__ = ('digest', 'data', 'file_name', 'attributes', 'uploaded', 'sent_media', 'lock', 'sources')
+
+    def __init__(self, digest, data, file_name, attributes=None):
+        self.digest = digest
+        self.data = data              # محتوى الملف (bytes)
+        self.file_name = file_name
+        self.attributes = attributes  # خصائص المستند الأصلية (إن وجدت)
+        self.uploaded = None          # InputFile بعد الرفع
+        self.sent_media = None        # مرجع الوسائط من أول إرسال ناجح
+        self.lock = asyncio.Lock()
+        self.sources = []             # مفاتيح تيليجرام المؤدية لهذا الملف (تُحذف من الكاش معه)
+
+def media_source_key(message):
+    """ مفتاح الملف في تيليجرام (لتجنب التحميل إذا كان نفس الملف معروفاً) """
+    if message.photo: return f"photo:{message.photo.id}"
+    if message.document: return f"document:{message.document.id}"
+    return None
+
+class MediaCache:
+    """ كاش LRU محدود بالحجم لوسائط حساب واحد: {sha256: MediaEntry} """
+
+    def __init__(self, client, max_bytes=MEDIA_CACHE_MAX_BYTES):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._sources = {}  # {مفتاح ملف تيليجرام: sha256}
+        self.uploads = 0
+        self.reused = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, data, file_name, attributes=None):
+        digest = hashlib.sha256(data).hexdigest()
+        entry = self._entries.get(digest)
+        if entry is None:
+            entry = MediaEntry(digest, data, file_name, attributes)
+            if len(data) <= self.max_bytes:
+                self._entries[digest] = entry
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.size -= len(evicted.data)
+                    for source in evicted.sources: self._sources.pop(source, None)
+        else: self._entries.move_to_end(digest)
+        return entry
+
+    async def from_message(self, message):
+        """ وسائط رسالة (من البوت عادة): بدون تحميل إذا سبق رؤية نفس الملف """
+        source = media_source_key(message)
+        entry = self._entries.get(self._sources.get(source)) if source else None
+        if entry is not None:
+            self._entries.move_to_end(entry.digest)
+            return entry
+        data = await message.download_media(bytes)
+        attributes = message.document.attributes if message.document else None
+        entry = self.put(data, message.file.name or f"media{message.file.ext or ''}", attributes)
+        # فقط للملفات المحفوظة فعلاً (الأكبر من الحد لا تدخل الكاش)
+        if source and entry.digest in self._entries:
+            self._sources[source] = entry.digest
+            entry.sources.append(source)
+        return entry
+
+    async def get(self, digest):
+        """ وسائط محفوظة في media_blobs (النشر التلقائي) """
+        entry = self._entries.get(digest)
+        if entry is not None:
+            self._entries.move_to_end(digest)
+            return entry
+        doc = await media_blobs_collection.find_one({"_id": digest})
+        if not doc: raise KeyError(f"media {digest} not found")
+        return self.put(bytes(doc['data']), doc.get('file_name') or "media")
+
+    async def send_file(self, chat_id, entry, caption="", **kwargs):
+        """ إرسال الوسائط: رفع مرة واحدة فقط، ثم إعادة استخدام مرجع أول رسالة """
+        if entry.sent_media is None:
+            async with entry.lock:
+                if entry.sent_media is None:
+                    if entry.uploaded is None:
+                        entry.uploaded = await self.client.upload_file(entry.data, file_name=entry.file_name)
+                        self.uploads += 1
+                    sent = await self.client.send_file(chat_id, entry.uploaded, caption=caption, attributes=entry.attributes, **kwargs)
+                    entry.sent_media = sent.media
+                    return sent
+        try:
+            sent = await self.client.send_file(chat_id, entry.sent_media, caption=caption, **kwargs)
+            self.reused += 1
+            return sent
+        except FileReferenceExpiredError:
+            # مرجع الملف انتهى: نرفع من الذاكرة من جديد
+            entry.sent_media = entry.uploaded = None
+            return await self.send_file(chat_id, entry, caption, **kwargs)
+
+async def store_media_blob(message):
+    """ (لوحة التحكم) حفظ وسائط النشر في القاعدة ببصمتها مرة واحدة؛ None إذا كانت أكبر من الحد """
+    if message.file and message.file.size and message.file.size > MEDIA_BLOB_MAX_BYTES: return None
+    data = await message.download_media(bytes)
+    if len(data) > MEDIA_BLOB_MAX_BYTES: return None
+    digest = hashlib.sha256(data).hexdigest()
+    await media_blobs_collection.update_one({"_id": digest},
+        {"$setOnInsert": {"data": data, "file_name": message.file.name or f"media{message.file.ext or ''}",
+                          "size": len(data), "created": time.time()}}, upsert=True)
+    return digest
+
+# ==============================================================================
+#                               4.8 فهرس الرسائل (Message Index)
+# ==============================================================================
+# اختياري (MESSAGE_INDEX_DIR): رسائل الجروبات النصية من NewMessage تُكتب دفعات في SQLite FTS5
+# (ملف لكل حساب) وتُحذف بعد MESSAGE_INDEX_RETENTION_HOURS. مهام البحث وإحصائيات الكلمات
+# تُجاب محلياً، وتيليجرام يُسأل فقط عن الفترات التي لم يغطها الفهرس (قبل تفعيله أو أثناء انقطاع الحساب).
+
+MESSAGE_INDEX_DIR = os.getenv("MESSAGE_INDEX_DIR")  # فارغ = الفهرس معطل
+MESSAGE_INDEX_RETENTION = float(os.getenv("MESSAGE_INDEX_RETENTION_HOURS") or 72) * 3600
+MESSAGE_INDEX_FLUSH_INTERVAL = 2.0   # أقصى تأخير قبل أن تصبح الرسالة قابلة للبحث
+MESSAGE_INDEX_MAX_BATCH = 500
+MESSAGE_INDEX_PRUNE_INTERVAL = 3600
+MESSAGE_INDEX_GAP_TOLERANCE = 120    # انقطاع أقصر من هذا لا يُعتبر فجوة في التغطية
+MESSAGE_INDEX_SCHEMA = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, msg_id INTEGER NOT NULL,
+                                     sender_id INTEGER, ts REAL NOT NULL, text TEXT NOT NULL, UNIQUE (chat_id, msg_id));
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, content='messages', content_rowid='id',
+                                                           tokenize='unicode61 remove_diacritics 2');
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+CREATE TABLE IF NOT EXISTS coverage (id INTEGER PRIMARY KEY, start REAL NOT NULL, end REAL NOT NULL);
+"""
+
+class IndexedMessage:
+    """ نتيجة من الفهرس بالحقول التي تستخدمها مهام البحث من رسالة تيليجرام """
+    __slots__ = ('chat_id', 'id', 'sender_id', 'ts')
+
+    def __init__(self, chat_id, msg_id, sender_id, ts):
+        self.chat_id = chat_id
+        self.id = msg_id
+        self.sender_id = sender_id
+        self.ts = ts
+
+# التشكيل والتطويل يُحذفان من النص والاستعلام معاً (unicode61 يعتبرهما فواصل فيقطع الكلمة)
+ARABIC_MARKS = re.compile('[\u0640\u064B-\u065F\u0670]')
+
+def fts_query(keyword):
+    """ الكلمة كعبارة واحدة مع مطابقة البادئة (قريب من بحث تيليجرام) """
+    return '"' + ARABIC_MARKS.sub('', keyword).replace('"', '""') + '"*'
+
+class MessageIndex:
+    """
+    فهرس نصي محلي لحساب واحد. الكتابة من الموزع مجرد إضافة لقائمة، والتفريغ والاستعلامات
+    تعمل في خيط (to_thread) على اتصال واحد محمي بقفل.
+    """
+
+    def __init__(self, owner_id, path):
+        self.owner_id = owner_id
+        self.path = path
+        self.indexed = 0
+        self._db = None
+        self._lock = threading.Lock()
+        self._coverage_id = None  # صف التغطية الخاص بهذا التشغيل (نهايته تتقدم مع كل تفريغ)
+        self._pending = []
+        self._full = asyncio.Event()
+        self._task = None
+
+    @property
+    def pending(self):
+        """ صفوف تنتظر التفريغ (بدون __len__: الفهرس الفارغ يجب ألا يُعتبر معطلاً) """
+        return len(self._pending)
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.executescript(MESSAGE_INDEX_SCHEMA)
+        now = time.time()
+        with self._db:
+            last = self._db.execute("SELECT id, end FROM coverage ORDER BY end DESC LIMIT 1").fetchone()
+            # إعادة تشغيل سريعة تكمل نفس فترة التغطية بدل فتح فجوة
+            if last and now - last[1] <= MESSAGE_INDEX_GAP_TOLERANCE: self._coverage_id = last[0]
+            else: self._coverage_id = self._db.execute("INSERT INTO coverage (start, end) VALUES (?, ?)", (now, now)).lastrowid
+
+    def add(self, message):
+        """ (من الموزع) رسالة جروب نصية → دفعة الكتابة التالية """
+        text = message.raw_text
+        if not text: return
+        self._pending.append((message.chat_id, message.id, message.sender_id, message.date.timestamp(), ARABIC_MARKS.sub('', text)))
+        if len(self._pending) >= MESSAGE_INDEX_MAX_BATCH: self._full.set()
+
+    def _write(self, rows, now):
+        with self._lock, self._db:
+            if rows: self._db.executemany(
+                "INSERT OR IGNORE INTO messages (chat_id, msg_id, sender_id, ts, text) VALUES (?, ?, ?, ?, ?)", rows)
+            self._db.execute("UPDATE coverage SET end = ? WHERE id = ?", (now, self._coverage_id))
+
+    async def flush(self):
+        rows = self._pending; self._pending = []; self._full.clear()
+        await asyncio.to_thread(self._write, rows, time.time())
+        self.indexed += len(rows)
+
+    def _prune(self, cutoff):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM messages WHERE ts < ?", (cutoff,))
+            self._db.execute("DELETE FROM coverage WHERE end < ? AND id != ?", (cutoff, self._coverage_id))
+
+    async def run(self):
+        """ التفريغ الدوري (ونبضة التغطية حتى بدون رسائل) والحذف حسب مدة الاحتفاظ """
+        self._task = asyncio.current_task()
+        next_prune = 0
+        while True:
+            try: await asyncio.wait_for(self._full.wait(), timeout=MESSAGE_INDEX_FLUSH_INTERVAL)
+            except asyncio.TimeoutError: pass
+            try:
+                await self.flush()
+                if time.time() >= next_prune:
+                    await asyncio.to_thread(self._prune, time.time() - MESSAGE_INDEX_RETENTION)
+                    next_prune = time.time() + MESSAGE_INDEX_PRUNE_INTERVAL
+            except sqlite3.Error as e: record_error("message_index", e)
+
+    async def close(self):
+        if self._task: self._task.cancel()
+        try: await self.flush()
+        except sqlite3.Error as e: record_error("message_index", e)
+        await asyncio.to_thread(self._db.close)
+
+    def _query(self, sql, params):
+        with self._lock: return self._db.execute(sql, params).fetchall()
+
+    async def search(self, keyword, since, limit=None):
+        """ رسائل تحتوي الكلمة بعد since، الأحدث أولاً """
+        await self.flush()
+        rows = await asyncio.to_thread(self._query,
+            "SELECT m.chat_id, m.msg_id, m.sender_id, m.ts FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+            "WHERE messages_fts MATCH ? AND m.ts > ? ORDER BY m.ts DESC LIMIT ?", (fts_query(keyword), since, limit or -1))
+        return [IndexedMessage(*row) for row in rows]
+
+    async def keyword_stats(self, keyword, since, top=10):
+        """ عدد مرات ذكر الكلمة بعد since، مع أكثر الجروبات والمرسلين ذكراً لها """
+        await self.flush()
+        match = "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid WHERE messages_fts MATCH ? AND m.ts > ?"
+        params = (fts_query(keyword), since)
+        def run():
+            total = self._query(f"SELECT COUNT(*) {match}", params)[0][0]
+            chats = self._query(f"SELECT m.chat_id, COUNT(*) AS n {match} GROUP BY m.chat_id ORDER BY n DESC LIMIT {int(top)}", params)
+            senders = self._query(f"SELECT m.sender_id, COUNT(*) AS n {match} GROUP BY m.sender_id ORDER BY n DESC LIMIT {int(top)}", params)
+            return total, chats, senders
+        return await asyncio.to_thread(run)
+
+    async def gaps(self, since, until=None):
+        """ الفترات داخل [since, until] التي لم يكن الفهرس يستقبل فيها (أو حُذفت بانتهاء مدة الاحتفاظ) """
+        until = until or time.time()
+        rows = await asyncio.to_thread(self._query,
+            "SELECT id, start, end FROM coverage WHERE end >= ? ORDER BY start", (since,))
+        cutoff = until - MESSAGE_INDEX_RETENTION
+        gaps, cursor = [], since
+        for row_id, start, end in rows:
+            if row_id == self._coverage_id: end = until  # التشغيل الحالي مغطى حتى الآن
+            start = max(start, cutoff)
+            if start - cursor > MESSAGE_INDEX_GAP_TOLERANCE: gaps.append((cursor, start))
+            cursor = max(cursor, end)
+        if until - cursor > MESSAGE_INDEX_GAP_TOLERANCE: gaps.append((cursor, until))
+        return gaps
+
+async def open_message_index(owner_id):
+    """ فهرس الحساب إن كان مفعلاً (MESSAGE_INDEX_DIR)، وإلا None """
+    if not MESSAGE_INDEX_DIR: return None
+    index = MessageIndex(owner_id, os.path.join(MESSAGE_INDEX_DIR, f"{owner_id}.db"))
+    try:
+        os.makedirs(MESSAGE_INDEX_DIR, exist_ok=True)
+        await asyncio.to_thread(index._open)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Message index for {owner_id} unavailable: {e}")
+        return None
+    return index
 
 # ==============================================================================
 #                               5. إدارة اليوزربوت (نظام العزل)
 # ==============================================================================
 
+STARTUP_CONCURRENCY = 10  # أقصى عدد حسابات تتصل في نفس اللحظة عند التشغيل
+STARTUP_JITTER = 2.0      # تأخير عشوائي (ثواني) قبل اتصال كل حساب
+
 async def start_userbot_session(owner_id, session_string):
     """ تشغيل حساب المستخدم في عملية منفصلة """
+    started_at = time.monotonic()
+    userbot = None
     try:
         # 1. تنظيف أي جلسة سابقة لهذا المستخدم تحديداً
-        if owner_id in active_userbot_clients:
-            await active_userbot_clients[owner_id].disconnect()
-            del active_userbot_clients[owner_id]
+        await stop_userbot_session(owner_id)
         
-        # 2. إنشاء عميل جديد
-        userbot = TelegramClient(StringSession(session_string), API_ID, API_HASH)
+        # 2. إنشاء عميل جديد (مع الكيانات المحفوظة من التشغيل السابق)
+        session = CachedStringSession(session_string, await load_entity_cache(owner_id))
+        userbot = TelegramClient(session, API_ID, API_HASH)
+        userbot.owner_id = owner_id # بصمة الحساب
+        userbot.tasks = []          # المهام الخلفية لهذا الحساب (تُلغى عند الإيقاف)
         await userbot.connect()
         
         if not await userbot.is_user_authorized():
+            await userbot.disconnect()
             return False
         
-        userbot.owner_id = owner_id # بصمة الحساب
-        userbot.cooldowns = {} 
-
-        # 3. تسجيل المعالجات (Handlers)
-        # نمرر 'userbot' نفسه للدالة لضمان أن كل حدث يعالج بواسطة الحساب الصحيح
-        userbot.add_event_handler(lambda e: handle_auto_reply(userbot, e), events.NewMessage(incoming=True))
-        userbot.add_event_handler(lambda e: handle_ai_chat(userbot, e), events.NewMessage(incoming=True))
-        userbot.add_event_handler(lambda e: handle_safe_forced_join(userbot, e), events.NewMessage(incoming=True))
-        userbot.add_event_handler(lambda e: handle_admin_freeze_trigger(userbot, e), events.NewMessage(incoming=True))
-        userbot.add_event_handler(lambda e: handle_owner_resume_trigger(userbot, e), events.NewMessage(outgoing=True))
-        
-        # 4. حفظ العميل في القائمة
-        active_userbot_clients[owner_id] = userbot
-        
-        # 5. تشغيل "السلك الخاص" (مهمة النشر) لهذا المستخدم
+        userbot.my_id = (await userbot.get_me()).id # آيدي الحساب (يُجلب مرة واحدة فقط)
+
+        # 3. كل مكونات العميل قبل أي حدث: المعالجات تفترض وجودها جميعاً
+        userbot.sender = SendScheduler(owner_id) # كل الإرسال الصادر لهذا الحساب يمر من هنا
+        userbot.inbox = EventQueue(owner_id)
+        userbot.media = MediaCache(userbot)
+        userbot.messages = await open_message_index(owner_id)  # None إذا كان الفهرس معطلاً
+        userbot.dialogs = DialogIndex(userbot, owner_id)        # يُملأ مرة واحدة ثم يتحدث من الأحداث
+        userbot.presence = AdminPresenceIndex(userbot, owner_id) # الرادار من أحداث الحالة بدل get_entity قبل كل نشر
+        userbot.leaver = LeaveScheduler(userbot, owner_id)
+        userbot.joiner = JoinQueue(userbot, owner_id)
+
+        # 4. التسجيل في المُجدولات المشتركة (النشر والبايو)
         await manage_user_autopost_task(userbot, owner_id)
+        bio_scheduler.add_owner(userbot, owner_id)
+
+        # 5. تسجيل الموزع (Dispatcher) والمعالجات بعد اكتمال العميل
+        # معالج واحد لكل حساب: يصنف الحدث ويضعه في طابور الحساب، والعمال يوجهونه للمعالجات المناسبة
+        userbot.add_event_handler(lambda e: dispatch_userbot_event(userbot, e), events.NewMessage())
+        userbot.add_event_handler(userbot.dialogs.on_chat_action, events.ChatAction())
+        userbot.add_event_handler(on_participant_update,
+            events.Raw(types=[UpdateChannelParticipant, UpdateChatParticipant, UpdateChatParticipantAdmin]))
+        userbot.add_event_handler(userbot.presence.on_status_update, events.Raw(types=UpdateUserStatus))
         
-        # 6. تشغيل مهمة المغادرة التلقائية
-        asyncio.create_task(engine_auto_leave_channels(userbot, owner_id))
+        # 6. نشر العميل في القائمة (آخر خطوة: لا يظهر عميل نصف جاهز)
+        active_userbot_clients[owner_id] = userbot
+
+        # 7. المهام الخلفية (حلقاتها تعمل ما دام هذا العميل هو المنشور)
+        for coro, name in ((userbot.leaver.run(), "auto_leave"),                          # المغادرة التلقائية
+                           (userbot.presence.run_refresh_loop(), "presence"),             # التحديث الاحتياطي للرادار
+                           (resume_broadcast_job(userbot, owner_id), "broadcast"),        # برودكاست توقف قبل إعادة التشغيل
+                           (engine_entity_cache_flusher(userbot, owner_id), "entity_cache"),
+                           (userbot.dialogs.load(), "dialogs")):                          # الملء الأولي لفهرس المحادثات
+            userbot.tasks.append(asyncio.create_task(coro, name=f"{name}:{owner_id}"))
+        if userbot.messages is not None:
+            userbot.tasks.append(asyncio.create_task(userbot.messages.run(), name=f"message_index:{owner_id}"))
+
+        userbot_startup_metrics[owner_id] = round(time.monotonic() - started_at, 2)
+        logger.info(f"Account {owner_id} ready in {userbot_startup_metrics[owner_id]}s")
             
         return True
     except Exception as e:
         print(f"Error starting {owner_id}: {e}")
+        # فشل في المنتصف: لا نترك عميلاً نصف مُنشأ متصلاً أو مسجلاً في المُجدولات
+        if userbot is not None:
+            if active_userbot_clients.get(owner_id) is userbot: del active_userbot_clients[owner_id]
+            try: await close_userbot_client(userbot)
+            except Exception as e: record_error("session_cleanup", e)
         return False
 
+async def close_userbot_client(client):
+    """ إيقاف كل مكونات عميل (كامل أو نصف مُنشأ) وحفظ الكيانات وقطع الاتصال """
+    owner_id = client.owner_id
+    autopost_scheduler.remove_owner(owner_id)
+    bio_scheduler.remove_owner(owner_id)
+    for task in getattr(client, 'tasks', ()): task.cancel()
+    # البرودكاست يُوقف مع الحساب (يحفظ تقدمه ويُستأنف مع الجلسة التالية)
+    broadcast = broadcast_tasks.pop(owner_id, None)
+    if broadcast: broadcast.cancel()
+    for task in ai_chat_tasks.pop(owner_id, ()): task.cancel()
+    for name in ('sender', 'inbox', 'joiner'):
+        component = getattr(client, name, None)
+        if component is not None: component.close()
+    if getattr(client, 'messages', None) is not None: await client.messages.close()
+    try: await save_entity_cache(client)
+    except Exception as e: record_error("entity_cache_save", e)
+    await client.disconnect()
+
+async def stop_userbot_session(owner_id):
+    """ إيقاف حساب: إخراجه من القائمة ثم إيقاف مهامه ومكوناته وقطع الاتصال """
+    client = active_userbot_clients.pop(owner_id, None)
+    if not client: return
+    await close_userbot_client(client)
+
+async def start_userbot_fleet(documents):
+    """ تشغيل مجموعة حسابات بحد أقصى للتزامن وتأخير عشوائي (بدل اتصالها كلها بنفس اللحظة) """
+    semaphore = asyncio.Semaphore(STARTUP_CONCURRENCY)
+
+    async def start_one(document):
+        async with semaphore:
+            await asyncio.sleep(random.uniform(0, STARTUP_JITTER))
+            return await start_userbot_session(document['_id'], document['session_string'])
+
+    fleet_started = time.monotonic()
+    results = await asyncio.gather(*(start_one(d) for d in documents))
+    logger.info(f"Fleet ready: {sum(1 for r in results if r)}/{len(documents)} accounts in {time.monotonic() - fleet_started:.1f}s")
+    return results
+
 async def load_all_sessions_from_db():
-    async for document in sessions_collection.find({}):
-        # تشغيل كل حساب في الخلفية
-        asyncio.create_task(start_userbot_session(document['_id'], document['session_string']))
+    """ تشغيل كل الحسابات في الخلفية """
+    documents = [d async for d in sessions_collection.find({})]
+    asyncio.create_task(start_userbot_fleet(documents))
 
 # 🔥 مدير المهام المعزول (The Isolated Task Manager) 🔥
 async def manage_user_autopost_task(client, owner_id):
-    """ يضمن وجود مهمة نشر واحدة فقط لكل حساب """
-    
-    # 1. قتل المهمة القديمة الخاصة بهذا المستخدم فقط
-    if owner_id in user_autopost_tasks:
-        old_task = user_autopost_tasks[owner_id]
-        if not old_task.done():
-            old_task.cancel()
-            try: await old_task
-            except asyncio.CancelledError: pass
-        del user_autopost_tasks[owner_id]
-
-    # 2. التحقق من قاعدة البيانات لهذا المستخدم
-    config = await autopost_config_collection.find_one({"owner_id": owner_id})
-    
-    # 3. إذا كان النشر مفعلاً، أنشئ "سلك" جديد
+    """ يسجل جروبات هذا الحساب في مُجدول النشر المركزي (أو يزيلها إذا تعطل النشر) """
+    config = (await get_owner_settings(owner_id)).autopost
     if config and config.get('active', False):
-        # نمرر الـ client والـ owner_id لضمان العزل
-        new_task = asyncio.create_task(engine_autopost_loop(client, owner_id))
-        user_autopost_tasks[owner_id] = new_task
-        print(f"✅ Started AutoPost Task for User: {owner_id}")
+        await autopost_scheduler.add_owner(client, owner_id, config)
+        print(f"✅ Scheduled AutoPost for User: {owner_id}")
+    else:
+        autopost_scheduler.remove_owner(owner_id)
 
 # ==============================================================================
 #                               6. المعالجات (Logic)
 # ==============================================================================
 
+FORCED_JOIN_KEYWORDS = ["لايمكنك", "عليك الاشتراك", "must join", "غير مشترك", "join channel", "القناة"]
+
+class UserbotEventContext:
+    """ الحقائق المشتركة للحدث: تُحسب مرة واحدة وتُمرر لكل المعالجات """
+    __slots__ = ('client', 'event', 'my_id', '_reply_message')
+
+    def __init__(self, client, event):
+        self.client = client
+        self.event = event
+        self.my_id = client.my_id
+        self._reply_message = None  # مهمة الجلب (مشتركة بين المعالجات المتزامنة)
+
+    async def get_reply_message(self):
+        """ جلب الرسالة المردود عليها مرة واحدة فقط مهما طلبتها المعالجات (ولو في نفس اللحظة) """
+        if not self.event.is_reply: return None
+        if self._reply_message is None:
+            self._reply_message = asyncio.ensure_future(self.event.get_reply_message())
+        return await asyncio.shield(self._reply_message)
+
+    async def is_reply_to_me(self):
+        reply_message = await self.get_reply_message()
+        return reply_message is not None and reply_message.sender_id == self.my_id
+
+# طابور الأحداث الواردة لكل حساب: الأولوية الأصغر تُعالج أولاً
+EVENT_PRIORITY_OWNER = 0     # رسائل الحساب نفسه (استئناف النشر)
+EVENT_PRIORITY_PRIVATE = 1   # الخاص (ردود وذكاء)
+EVENT_PRIORITY_GROUP = 2     # دردشة الجروبات
+EVENT_PRIORITY_NAMES = ("owner", "private", "group")
+EVENT_QUEUE_MAX = int(os.getenv("EVENT_QUEUE_MAX") or 500)    # أقصى أحداث تنتظر لكل حساب
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS") or 4)          # أقصى معالجات متزامنة لكل حساب
+# عند الامتلاء: drop_oldest_group = حذف أقدم رسالة جروب (وإلا رفض الجديد)، drop_new = رفض الحدث الجديد
+EVENT_SHED_POLICY = os.getenv("EVENT_SHED_POLICY", "drop_oldest_group")
+
+class EventQueue:
+    """
+    طابور محدود لأحداث حساب واحد مع عدد ثابت من العمال.
+    بدل مهمة لكل رسالة (آلاف المهام وقت الهجوم)، الأحداث تنتظر هنا بحد أقصى،
+    والزائد يُسقط حسب EVENT_SHED_POLICY ويُعد في المقاييس.
+    """
+
+    def __init__(self, owner_id, max_size=EVENT_QUEUE_MAX, workers=EVENT_WORKERS, policy=EVENT_SHED_POLICY):
+        self.owner_id = owner_id
+        self.max_size = max_size
+        self.workers = workers
+        self.policy = policy
+        self._queues = tuple(deque() for _ in EVENT_PRIORITY_NAMES)  # [(وقت الدخول, client, event)]
+        self._tasks = set()
+        self.active = 0
+        self.queued = [0] * len(EVENT_PRIORITY_NAMES)
+        self.dropped = [0] * len(EVENT_PRIORITY_NAMES)
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues)
+
+    def depths(self):
+        return [len(q) for q in self._queues]
+
+    def put(self, client, event, priority):
+        if len(self) >= self.max_size:
+            groups = self._queues[EVENT_PRIORITY_GROUP]
+            if self.policy == "drop_oldest_group" and groups:
+                groups.popleft()
+                self.dropped[EVENT_PRIORITY_GROUP] += 1
+            else:
+                self.dropped[priority] += 1
+                return False
+        self._queues[priority].append((time.monotonic(), client, event))
+        self.queued[priority] += 1
+        if len(self._tasks) < self.workers:
+            task = asyncio.create_task(self._work(), name=f"events:{self.owner_id}")
+            self._tasks.add(task); task.add_done_callback(self._tasks.discard)
+        return True
+
+    def _pop(self):
+        for priority, queue in enumerate(self._queues):
+            if queue: return priority, queue.popleft()
+        return None, None
+
+    async def _work(self):
+        # العامل ينتهي عند فراغ الطابور ويُنشأ من جديد عند وصول أحداث
+        while True:
+            priority, item = self._pop()
+            if item is None:
+                # الخروج من المجموعة الآن لا في done_callback: put() بينهما سيرى العامل موجوداً ولا ينشئ غيره
+                self._tasks.discard(asyncio.current_task())
+                return
+            queued_at, client, event = item
+            event_queue_wait.observe(time.monotonic() - queued_at, priority=EVENT_PRIORITY_NAMES[priority])
+            self.active += 1
+            try: await process_userbot_event(client, event)
+            except Exception as e: record_error("event_worker", e)
+            finally: self.active -= 1
+
+    def close(self):
+        for queue in self._queues: queue.clear()
+        for task in list(self._tasks): task.cancel()
+
+async def dispatch_userbot_event(client, event):
+    """ معالج Telethon: تصنيف سريع ثم إدخال الحدث في طابور الحساب (بدون أي انتظار) """
+    client.dialogs.on_message(event)
+    if client.messages is not None and event.is_group: client.messages.add(event)
+    if event.out:
+        # الجروبات المجمدة نادرة: الرد في جروب غير مجمد لا يكلف أي I/O
+        if not (event.is_group and event.is_reply and is_chat_paused(client.owner_id, event.chat_id)): return
+        priority = EVENT_PRIORITY_OWNER
+    elif event.is_private: priority = EVENT_PRIORITY_PRIVATE
+    elif event.is_group or event.is_reply or event.mentioned: priority = EVENT_PRIORITY_GROUP
+    else: return
+    client.inbox.put(client, event, priority)
+
+async def process_userbot_event(client, event):
+    """ يصنف الرسالة (خاص/جروب/رد/منشن/صادرة) ويشغل المعالجات المعنية فقط """
+    ctx = UserbotEventContext(client, event)
+    jobs = []
+    if event.out:
+        if event.is_group and event.is_reply:
+            jobs.append(observe_handler("resume", handle_owner_resume_trigger(client, event, ctx)))
+    else:
+        if event.is_private or event.is_group:
+            jobs.append(observe_handler("auto_reply", handle_auto_reply(client, event)))
+        if event.is_private:
+            jobs.append(observe_handler("ai_chat", handle_ai_chat(client, event)))
+        if event.is_reply or event.mentioned:
+            jobs.append(observe_handler("forced_join", handle_safe_forced_join(client, event, ctx)))
+        if event.is_group and event.is_reply:
+            jobs.append(observe_handler("freeze", handle_admin_freeze_trigger(client, event, ctx)))
+    if jobs: await asyncio.gather(*jobs)
+
 async def handle_auto_reply(client, event):
     if not (event.is_private or event.is_group): return
     try:
         user_text = event.raw_text or ""
-        # البحث عن ردود هذا المستخدم فقط
-        cursor = replies_collection.find({"owner_id": client.owner_id})
-        async for reply_doc in cursor:
-            if reply_doc['keyword'] in user_text:
-                # مفتاح التبريد فريد لكل محادثة
-                cooldown_key = (client.owner_id, event.chat_id, event.sender_id, reply_doc['keyword'])
-                last_time = reply_cooldown_timestamps.get(cooldown_key, 0)
-                if time.time() - last_time < 600: return
-                reply_cooldown_timestamps[cooldown_key] = time.time()
-                await event.reply(reply_doc['reply'])
-                return
-    except: pass
+        # مطابقة ردود هذا المستخدم فقط من الذاكرة (بدون قاعدة البيانات)
+        matcher = await get_reply_matcher(client.owner_id)
+        matched = matcher.match(user_text)
+        if matched:
+            keyword, reply_text = matched
+            # مفتاح التبريد فريد لكل محادثة
+            cooldown_key = (client.owner_id, event.chat_id, event.sender_id, keyword)
+            if not reply_cooldown_timestamps.try_acquire(cooldown_key): return
+            # العامل لا ينتظر فاصل المحادثة أو FloodWait: التسليم على مُجدول الإرسال
+            client.sender.post(event.chat_id, lambda: event.reply(reply_text), LANE_INTERACTIVE, "auto_reply")
+    except Exception as e: record_error("auto_reply", e)
+
+# طبقة الذكاء: حد تزامن عام + حد لكل مستخدم، كاش للأسئلة المتكررة، ودمج الأسئلة المتطابقة الجارية
+ai_global_semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+ai_owner_semaphores = {}                                     # {owner_id: Semaphore}
+ai_response_cache = TTLCache(AI_CACHE_SIZE, AI_CACHE_TTL)    # {سؤال موحد: رد}
+ai_inflight_requests = {}                                    # {سؤال موحد: Future}
+ai_chat_histories = TTLCache(AI_HISTORY_CHATS, 3600)         # {(owner, chat): deque}
+ai_chat_tasks = {}                                           # {owner_id: set(Task)} محادثات جارية
+
+_ARABIC_DIACRITICS = re.compile(r'[\u064B-\u0652\u0640]')
+_PROMPT_PUNCTUATION = re.compile(r'[^\w\s]')
+
+def normalize_prompt(text):
+    """ توحيد السؤال للكاش: حذف التشكيل والرموز وتوحيد الحروف والمسافات """
+    text = _ARABIC_DIACRITICS.sub('', (text or '').lower())
+    text = text.replace('أ', 'ا').replace('إ', 'ا').replace('آ', 'ا').replace('ى', 'ي').replace('ة', 'ه')
+    return ' '.join(_PROMPT_PUNCTUATION.sub(' ', text).split())
+
+async def ai_complete(owner_id, messages, cache_key=None, on_delta=None):
+    """ طلب ذكاء بحدود التزامن والمهلة، مع الكاش ودمج الطلبات المتطابقة عند وجود cache_key """
+    if cache_key:
+        cached = ai_response_cache.get(cache_key)
+        if cached: return cached
+        if cache_key in ai_inflight_requests:
+            return await asyncio.shield(ai_inflight_requests[cache_key])
+        ai_inflight_requests[cache_key] = asyncio.get_running_loop().create_future()
+    result = None
+    try:
+        owner_semaphore = ai_owner_semaphores.setdefault(owner_id, asyncio.Semaphore(AI_MAX_PER_OWNER))
+        async with owner_semaphore, ai_global_semaphore:
+            result = await asyncio.wait_for(get_ai_response(messages, on_delta), AI_TIMEOUT)
+        if cache_key and result: ai_response_cache.set(cache_key, result)
+    except Exception as e:
+        logger.warning(f"AI request failed {owner_id}: {type(e).__name__}")
+    finally:
+        if cache_key:
+            future = ai_inflight_requests.pop(cache_key)
+            if not future.done(): future.set_result(result)
+    return result
 
 async def handle_ai_chat(client, event):
+    """ فحص الإعداد والتبريد فقط؛ المحادثة نفسها (ثواني من انتظار النموذج) في مهمة مستقلة عن عامل الحدث """
     if not event.is_private: return
     try:
-        settings = await ai_settings_collection.find_one({"owner_id": client.owner_id})
-        if settings and settings.get('active'):
-            if time.time() - client.cooldowns.get(event.chat_id, 0) > 5:
-                async with client.action(event.chat_id, 'typing'): await asyncio.sleep(2)
-                msgs = [{"role": "system", "content": STRICT_RULE}, {"role": "user", "content": event.raw_text}]
-                ai_reply = await get_ai_response(msgs)
-                if ai_reply: await event.reply(ai_reply)
-                client.cooldowns[event.chat_id] = time.time()
-    except: pass
-
-async def handle_safe_forced_join(client, event):
+        settings = await get_owner_settings(client.owner_id)
+        if not settings.ai_active: return
+        # كل مهمة تحمل الحدث وتنتظر حدود التزامن، لذا عددها محدود مثل طابور الأحداث
+        tasks = ai_chat_tasks.setdefault(client.owner_id, set())
+        if len(tasks) >= AI_MAX_PENDING_PER_OWNER:
+            client.inbox.dropped[EVENT_PRIORITY_PRIVATE] += 1
+            return
+        if ai_chat_cooldowns.try_acquire((client.owner_id, event.chat_id)):
+            task = asyncio.create_task(run_ai_chat(client, event), name=f"ai_chat:{client.owner_id}")
+            tasks.add(task); task.add_done_callback(tasks.discard)
+    except Exception as e: record_error("ai_chat", e)
+
+async def run_ai_chat(client, event):
     try:
-        if not (event.is_reply or event.mentioned): return
-        reply_message = await event.get_reply_message()
-        my_info = await client.get_me()
-        if reply_message and reply_message.sender_id != my_info.id: return 
+        history_key = (client.owner_id, event.chat_id)
+        history = ai_chat_histories.get(history_key)
+        if history is None:
+            history = deque(maxlen=AI_HISTORY_MESSAGES)
+            ai_chat_histories.set(history_key, history)
+        msgs = [{"role": "system", "content": STRICT_RULE}, *history, {"role": "user", "content": event.raw_text}]
+        # الكاش للأسئلة الافتتاحية فقط (بدون سياق سابق يغير معنى الجواب)
+        cache_key = normalize_prompt(event.raw_text) if not history else None
+
+        first_send = None; reply_message = None; shown = ""; last_edit = 0.0
+        async def on_delta(text):
+            nonlocal first_send, reply_message, shown, last_edit
+            now = time.monotonic()
+            if first_send is None and text.strip():
+                # shield: انتهاء المهلة أثناء الإرسال لا يضيّع الرسالة الجزئية
+                shown = text; last_edit = now
+                first_send = client.sender.submit(event.chat_id, lambda: event.reply(text), LANE_INTERACTIVE)
+                reply_message = await asyncio.shield(first_send)
+            elif reply_message is not None and now - last_edit >= AI_STREAM_EDIT_INTERVAL:
+                last_edit = now; shown = text
+                await client.sender.send(None, lambda: reply_message.edit(text), LANE_INTERACTIVE)
+
+        async with client.action(event.chat_id, 'typing'):
+            ai_reply = await ai_complete(client.owner_id, msgs, cache_key, on_delta if AI_STREAMING else None)
+        if reply_message is None and first_send is not None:
+            reply_message = await first_send
+        if not ai_reply:
+            # مهلة أو خطأ أثناء البث: لا نترك جواباً مقطوعاً في المحادثة
+            if reply_message is not None:
+                client.sender.post(None, lambda: reply_message.delete(), LANE_INTERACTIVE, "ai_chat")
+            return
+        if reply_message is None:
+            await client.sender.send(event.chat_id, lambda: event.reply(ai_reply), LANE_INTERACTIVE)
+        elif shown != ai_reply:
+            await client.sender.send(None, lambda: reply_message.edit(ai_reply), LANE_INTERACTIVE)
+        history.append({"role": "user", "content": event.raw_text})
+        history.append({"role": "assistant", "content": ai_reply})
+        # تجديد الصلاحية مع كل دور حتى لا تنتهي محادثة نشطة في منتصفها
+        ai_chat_histories.set(history_key, history)
+    except Exception as e: record_error("ai_chat", e)
+
+JOIN_RATE = 1 / 20            # انضمام واحد كل 20 ثانية لكل حساب
+JOIN_BURST = 3                # أقصى انضمامات متتالية فورية
+JOIN_QUEUE_MAX = 100          # أقصى روابط تنتظر الانضمام لكل حساب
+JOIN_NEGATIVE_TTL = 6 * 3600  # مدة تجاهل الروابط المنتهية/غير الصالحة
+JOIN_RETRY_TTL = 600          # مدة تجاهل الروابط بعد خطأ غير معروف
+JOIN_PERMANENT_ERRORS = (InviteHashExpiredError, InviteHashInvalidError, UsernameInvalidError,
+                         UsernameNotOccupiedError, ChannelPrivateError, ValueError)
+
+def parse_join_target(link):
+    """ توحيد الرابط: ('invite', hash) أو ('username', اسم) أو None """
+    clean = link.replace("https://", "").replace("http://", "").replace("t.me/", "").lstrip("@").split("?")[0].strip("/ ")
+    if clean.startswith("+"): return ("invite", clean[1:])
+    if clean.startswith("joinchat/"): return ("invite", clean.split("/", 1)[1])
+    username = clean.split("/")[0].lower()
+    return ("username", username) if len(username) >= 4 else None
+
+class JoinQueue:
+    """
+    طابور الانضمام الإجباري لحساب واحد:
+    - الروابط المكررة (قيد الانتظار أو التنفيذ) تُدمج.
+    - الرابط ← الكيان يُحفظ في كاش وفي subscriptions (target)، والقنوات المشترك فيها لا يُعاد الانضمام لها
+      حتى بعد إعادة التشغيل (الاشتراكات المحفوظة + فهرس المحادثات + كيانات الجلسة).
+    - الروابط المنتهية أو غير الصالحة تُتجاهل لفترة (كاش سلبي).
+    - الانضمامات محدودة المعدل، و FloodWait يؤجل الطابور كاملاً.
+    """
 
+    def __init__(self, client, owner_id):
+        self.client = client
+        self.owner_id = owner_id
+        self.resolved = TTLCache(5000, 86400)           # {target: chat_id}
+        self.negative = TTLCache(5000, JOIN_NEGATIVE_TTL)  # {target: اسم الخطأ}
+        self.bucket = TokenBucket(JOIN_RATE, JOIN_BURST)
+        self._queue = deque()
+        self._pending = set()
+        self._subscribed = None  # {chat_id} يُحمّل مرة واحدة من subscriptions
+        self._targets = {}       # {"kind:value": chat_id} الروابط المحفوظة مع اشتراكاتها
+        self._worker = None
+        self.joined = 0
+        self.skipped = 0
+
+    async def _load_subscribed(self):
+        if self._subscribed is None:
+            subscribed = set()
+            async for d in subscriptions_collection.find({"owner_id": self.owner_id}, {"chat_id": 1, "target": 1, "_id": 0}):
+                subscribed.add(d['chat_id'])
+                if d.get('target'): self._targets[d['target']] = d['chat_id']
+            self._subscribed = subscribed
+        return self._subscribed
+
+    def _is_member(self, target):
+        """ هل الحساب في هذه القناة؟ بدون أي طلب شبكة ولا يعتمد على كاش هذه العملية فقط """
+        chat_id = self.resolved.get(target)
+        if chat_id is None: chat_id = self._targets.get(f"{target[0]}:{target[1]}")
+        if chat_id is not None and self._subscribed is not None and chat_id in self._subscribed: return True
+        kind, value = target
+        if kind != "username" or not self.client.dialogs.ready.is_set(): return False
+        # اسم المستخدم ← الآيدي من كيانات الجلسة (محفوظة في entity_cache)، ثم فهرس المحادثات
+        session = getattr(self.client, 'session', None)
+        row = session.get_entity_rows_by_username(value) if session is not None else None
+        return row is not None and row[0] in self.client.dialogs
+
+    def close(self):
+        if self._worker: self._worker.cancel()
+        self._queue.clear(); self._pending.clear()
+
+    def forget(self, chat_id):
+        """ بعد المغادرة: يصبح الرابط قابلاً للانضمام من جديد """
+        if self._subscribed is not None: self._subscribed.discard(chat_id)
+
+    def submit(self, link):
+        target = parse_join_target(link)
+        if target is None or target in self._pending or self.negative.get(target) is not None \
+                or len(self._queue) >= JOIN_QUEUE_MAX:
+            self.skipped += 1; return
+        if self._is_member(target):
+            self.skipped += 1; return
+        self._pending.add(target)
+        self._queue.append(target)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run(), name=f"join:{self.owner_id}")
+
+    async def _join(self, target):
+        kind, value = target
+        try:
+            if kind == "invite": result = await self.client(ImportChatInviteRequest(value))
+            else: result = await self.client(JoinChannelRequest(value))
+            chats = getattr(result, 'chats', None)
+            entity = chats[0] if chats else await self.client.get_entity(value)
+        except UserAlreadyParticipantError:
+            # مشترك مسبقاً عبر دعوة: لا نعرف الكيان بدون طلب إضافي، نتجاهل الرابط لفترة
+            self.negative.set(target, "already_participant", ttl=JOIN_RETRY_TTL); return
+        return entity
+
+    def _remember(self, target, entity, subscribed):
+        """ تسجيل الانضمام: الكاش، فهرس المحادثات، الاشتراكات مع الرابط (للمغادرة بعد 24 ساعة ولتخطيه بعد إعادة التشغيل) """
+        join_time = time.time()
+        target_key = f"{target[0]}:{target[1]}"
+        self.resolved.set(target, entity.id)
+        self._targets[target_key] = entity.id
+        subscribed.add(entity.id)
+        self.joined += 1
+        self.client.dialogs.add_entity(entity, join_time)
+        subscriptions_writes.add(UpdateOne({"owner_id": self.owner_id, "chat_id": entity.id},
+            {"$set": {"join_time": join_time, "target": target_key}}, upsert=True), key=(self.owner_id, entity.id))
+        self.client.leaver.schedule(entity.id, join_time)
+
+    async def _run(self):
+        subscribed = await self._load_subscribed()
+        while self._queue:
+            target = self._queue[0]
+            if self._is_member(target):
+                self._queue.popleft(); self._pending.discard(target); self.skipped += 1; continue
+            wait = self.bucket.delay()
+            if wait: await asyncio.sleep(wait); continue
+            self._queue.popleft()
+            self.bucket.take()
+            try:
+                entity = await self._join(target)
+                if entity is not None: self._remember(target, entity, subscribed)
+            except FloodWaitError as f:
+                # نعيد الرابط لأول الطابور وننتظر المدة المطلوبة
+                self.client.sender.note_flood_wait(f.seconds)
+                self._queue.appendleft(target)
+                await asyncio.sleep(f.seconds)
+                continue
+            except JOIN_PERMANENT_ERRORS as e:
+                self.negative.set(target, type(e).__name__); record_error("forced_join_link", e)
+            except Exception as e:
+                self.negative.set(target, type(e).__name__, ttl=JOIN_RETRY_TTL); record_error("forced_join_link", e)
+            self._pending.discard(target)
+
+async def handle_safe_forced_join(client, event, ctx):
+    try:
+        if not (event.is_reply or event.mentioned): return
         text_content = event.raw_text.lower()
-        forced_keywords = ["لايمكنك", "عليك الاشتراك", "must join", "غير مشترك", "join channel", "القناة"]
+        # فحص الكلمات أولاً (بدون أي طلب شبكة) ثم التأكد أن الرد موجه لنا
+        if not any(keyword in text_content for keyword in FORCED_JOIN_KEYWORDS): return
+        reply_message = await ctx.get_reply_message()
+        if reply_message and reply_message.sender_id != ctx.my_id: return 
+
+        targets_to_join = re.findall(r'(https?://t\.me/[^\s]+|@[a-zA-Z0-9_]{4,})', event.raw_text)
+        if event.message.buttons:
+            for row in event.message.buttons:
+                for btn in row:
+                    if hasattr(btn, 'url') and btn.url and "t.me" in btn.url:
+                        targets_to_join.append(btn.url)
         
-        if any(keyword in text_content for keyword in forced_keywords):
-            targets_to_join = re.findall(r'(https?://t\.me/[^\s]+|@[a-zA-Z0-9_]{4,})', event.raw_text)
-            if event.message.buttons:
-                for row in event.message.buttons:
-                    for btn in row:
-                        if hasattr(btn, 'url') and btn.url and "t.me" in btn.url:
-                            targets_to_join.append(btn.url)
-            
-            for target_link in targets_to_join:
-                try:
-                    clean_link = target_link.replace("https://t.me/", "").replace("@", "").strip()
-                    if "+" in clean_link: await client(ImportChatInviteRequest(clean_link.split("+")[-1]))
-                    else: await client(JoinChannelRequest(clean_link))
-                    
-                    try: 
-                        entity = await client.get_entity(clean_link)
-                        chat_id_to_save = entity.id
-                    except: chat_id_to_save = clean_link
-                        
-                    await subscriptions_collection.update_one({"owner_id": client.owner_id, "chat_id": chat_id_to_save}, 
-                        {"$set": {"join_time": time.time()}}, upsert=True)
-                except: pass
-    except: pass
-
-async def handle_admin_freeze_trigger(client, event):
+        # الانضمام يتم في الخلفية عبر طابور الحساب (دمج المكرر، كاش، وحدود معدل)
+        for target_link in targets_to_join: client.joiner.submit(target_link)
+    except Exception as e: record_error("forced_join", e)
+
+# كاش صلاحيات الإشراف: {(chat_id, user_id): هل هو مشرف؟}
+# مشترك بين الحسابات (الصلاحية حقيقة عن الجروب لا عن الحساب) ويُحدث من تحديثات المشاركين
+ADMIN_CACHE_TTL = 1800
+admin_status_cache = TTLCache(50_000, ADMIN_CACHE_TTL)
+
+async def on_participant_update(update):
+    """ تغيير مشرف/مشارك: تحديث الكاش مباشرة بدل انتظار انتهاء الصلاحية """
+    if isinstance(update, UpdateChatParticipantAdmin):
+        admin_status_cache.set((utils.get_peer_id(types.PeerChat(update.chat_id)), update.user_id), bool(update.is_admin))
+    elif isinstance(update, UpdateChannelParticipant):
+        admin_status_cache.pop((utils.get_peer_id(types.PeerChannel(update.channel_id)), update.user_id))
+    elif isinstance(update, UpdateChatParticipant):
+        admin_status_cache.pop((utils.get_peer_id(types.PeerChat(update.chat_id)), update.user_id))
+
+async def is_chat_admin(client, event):
+    key = (event.chat_id, event.sender_id)
+    is_admin = admin_status_cache.get(key)
+    if is_admin is None:
+        perms = await client.get_permissions(event.chat_id, await event.get_input_sender())
+        is_admin = bool(perms.is_admin or perms.is_creator)
+        admin_status_cache.set(key, is_admin)
+    return is_admin
+
+def is_chat_paused(owner_id, chat_id):
+    """ فحص فوري من الذاكرة (بدون I/O): True أيضاً إذا لم تُحمّل الإعدادات بعد ليتحقق المعالج """
+    settings = owner_settings_cache.get(owner_id)
+    return settings is None or chat_id in settings.paused_groups
+
+async def handle_admin_freeze_trigger(client, event, ctx):
     if not (event.is_group and event.is_reply): return
     try:
-        my_info = await client.get_me()
-        if (await event.get_reply_message()).sender_id != my_info.id: return
-        sender = await event.get_sender()
-        perms = await client.get_permissions(event.chat_id, sender)
-        if perms.is_admin or perms.is_creator:
+        # مرسل معروف أنه ليس مشرفاً: لا حاجة لجلب الرسالة المردود عليها
+        if admin_status_cache.get((event.chat_id, event.sender_id)) is False: return
+        if not await ctx.is_reply_to_me(): return
+        if await is_chat_admin(client, event):
             # تجميد هذا الجروب لهذا المستخدم فقط
             await paused_groups_collection.update_one({"owner_id": client.owner_id, "chat_id": event.chat_id},
-                {"$set": {"admin_id": sender.id}}, upsert=True)
-            await client.send_message("me", f"⛔ توقف النشر في {event.chat.title} بسبب رد المشرف.")
-    except: pass
+                {"$set": {"admin_id": event.sender_id}}, upsert=True)
+            (await get_owner_settings(client.owner_id)).paused_groups[event.chat_id] = event.sender_id
+            client.sender.post(None, lambda: client.send_message("me", f"⛔ توقف النشر في {event.chat.title} بسبب رد المشرف."),
+                               LANE_INTERACTIVE, "freeze")
+    except Exception as e: record_error("freeze", e)
 
-async def handle_owner_resume_trigger(client, event):
+async def handle_owner_resume_trigger(client, event, ctx):
     if not (event.is_group and event.is_reply): return
     try:
-        paused_data = await paused_groups_collection.find_one({"owner_id": client.owner_id, "chat_id": event.chat_id})
-        if not paused_data: return
-        replied_to_msg = await event.get_reply_message()
-        if replied_to_msg.sender_id == paused_data['admin_id']:
-            await paused_groups_collection.delete_one({"_id": paused_data['_id']})
-            await client.send_message("me", f"✅ عاد النشر في {event.chat.title}")
-    except: pass
+        paused_groups = (await get_owner_settings(client.owner_id)).paused_groups
+        if event.chat_id not in paused_groups: return
+        replied_to_msg = await ctx.get_reply_message()
+        if replied_to_msg and replied_to_msg.sender_id == paused_groups[event.chat_id]:
+            await paused_groups_collection.delete_one({"owner_id": client.owner_id, "chat_id": event.chat_id})
+            paused_groups.pop(event.chat_id, None)
+            client.sender.post(None, lambda: client.send_message("me", f"✅ عاد النشر في {event.chat.title}"),
+                               LANE_INTERACTIVE, "resume")
+    except Exception as e: record_error("resume", e)
 
 # ==============================================================================
 #                               7. المحركات الخلفية (Engines)
 # ==============================================================================
 
-async def engine_autopost_loop(client, owner_id):
+AUTOPOST_DANGER_DELAY = 300   # إعادة المحاولة لجروب واحد بعد ظهور مشرف مراقب
+AUTOPOST_MAX_JITTER = 60      # أقصى تأخير عشوائي يضاف لكل موعد (ثواني)
+
+class AutopostScheduler:
     """
-    هذا المحرك يعمل بشكل مستقل تماماً لكل مستخدم.
-    يستخدم 'client' الخاص بالمستخدم و 'owner_id' الخاص به لجلب البيانات.
+    مُجدول نشر مركزي لكل الحسابات: لكل (حساب، جروب) موعد استحقاق خاص في كومة واحدة.
+    - الفترة تُحسب من الموعد المجدول لا من نهاية الدورة، فلا تنجرف مع عدد الجروبات.
+    - المنشورات المستحقة تُطلق معاً (الحدود الفعلية في مُجدول الإرسال لكل حساب).
+    - الخطر (مشرف متصل) يؤجل الجروب المعني فقط.
+    - آخر رسالة وموعد الاستحقاق يُحفظان في autopost_state فلا تكرار ولا فقدان للحذف بعد إعادة التشغيل.
     """
-    logging.info(f"STARTING ENGINE FOR: {owner_id}")
-    while True:
+
+    def __init__(self):
+        self._heap = []        # [(وقت الإطلاق, owner_id, group_id)]
+        self._due = {}         # {(owner_id, group_id): (الموعد الأساسي, وقت الإطلاق)} الإدخال الأحدث فقط هو الصحيح
+        self._clients = {}     # {owner_id: client}
+        self._inflight = set() # مفاتيح قيد النشر الآن
+        self._wake = asyncio.Event()
+        self._task = None
+        self.posted = 0
+
+    def __len__(self):
+        return len(self._due)
+
+    @staticmethod
+    def _jitter(period):
+        return random.uniform(0, min(AUTOPOST_MAX_JITTER, period * 0.1))
+
+    def _schedule(self, key, base, fire_at=None):
+        """ base: الموعد بدون عشوائية (تُحسب منه الدورة التالية)، fire_at: الإطلاق الفعلي (base + jitter) """
+        fire_at = base if fire_at is None else fire_at
+        self._due[key] = (base, fire_at)
+        heapq.heappush(self._heap, (fire_at, *key))
+        if self._heap[0][0] == fire_at: self._wake.set()
+
+    def _persist(self, key, due, message_id=None):
+        update = {"next_due": due}
+        if message_id is not None: update["last_message_id"] = message_id
+        autopost_state_writes.add(UpdateOne({"owner_id": key[0], "chat_id": key[1]}, {"$set": update}, upsert=True), key=key)
+
+    async def add_owner(self, client, owner_id, config):
+        """ تسجيل (أو تحديث) جروبات حساب: المواعيد المحفوظة تُحترم، والجديدة تبدأ بتأخير عشوائي """
+        self._clients[owner_id] = client
+        groups = {int(g) for g in config.get('groups', [])}
+        for key in [k for k in self._due if k[0] == owner_id and k[1] not in groups]: del self._due[key]
+
+        saved = {d['chat_id']: d async for d in autopost_state_collection.find(
+            {"owner_id": owner_id}, {"chat_id": 1, "next_due": 1, "last_message_id": 1, "_id": 0})}
+        now = time.time()
+        period = config.get('interval', 10) * 60
+        for group_id in groups:
+            key = (owner_id, group_id)
+            state = saved.get(group_id, {})
+            if state.get('last_message_id'): last_published_message_ids.setdefault(key, state['last_message_id'])
+            if key in self._due: continue
+            # موعد محفوظ في المستقبل = نُشر قبل الإيقاف، لا نعيد النشر قبل وقته
+            due = state.get('next_due') or 0
+            base = due if due > now else now
+            self._schedule(key, base, base + self._jitter(period))
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run(), name="autopost:scheduler")
+
+    def remove_owner(self, owner_id):
+        self._clients.pop(owner_id, None)
+        for key in [k for k in self._due if k[0] == owner_id]: del self._due[key]
+
+    async def _post(self, key, entry):
+        owner_id, group_id = key
+        base = entry[0]
+        next_due = time.time() + AUTOPOST_DANGER_DELAY  # عند الخطأ نعيد المحاولة لاحقاً
+        jitter = self._jitter(AUTOPOST_DANGER_DELAY)
+        message_id = None
         try:
-            # التحقق من أن المهمة لم تُلغَ
-            try: asyncio.current_task().cancelled()
-            except: pass
+            client = self._clients.get(owner_id)
+            settings = await get_owner_settings(owner_id)
+            config = settings.autopost
+            if not client or not config or not config.get('active', False):
+                self._due.pop(key, None); return
+            period = config.get('interval', 10) * 60
+            # الموعد التالي من الموعد الأساسي لا من وقت الإطلاق، فالعشوائية لا تتراكم بين الدورات
+            # (وإذا تأخرنا أكثر من فترة كاملة نبدأ من الآن)
+            next_due = max(base + period, time.time())
+            jitter = self._jitter(period)
+
+            # 1. هل الجروب مجمد لهذا المستخدم؟
+            if group_id in settings.paused_groups: return
+
+            # 2. فحص الرادار (من فهرس الحضور في الذاكرة): الخطر يؤجل هذا الجروب فقط
+            if await client.presence.any_online():
+                last_msg = last_published_message_ids.get(key)
+                if last_msg:
+                    try: await client.delete_messages(group_id, [last_msg])
+                    except Exception as e: record_error("autopost_delete", e)
+                next_due = time.time() + AUTOPOST_DANGER_DELAY
+                jitter = self._jitter(AUTOPOST_DANGER_DELAY)
+                return
 
-            # جلب إعدادات هذا المستخدم من القاعدة
-            config = await autopost_config_collection.find_one({"owner_id": owner_id})
-            
-            # إذا تعطل النشر، نوقف الحلقة
-            if not config or not config.get('active', False): 
-                break
-            
-            # الدوران على الجروبات
-            for group_id in config.get('groups', []):
-                
-                # 1. هل الجروب مجمد لهذا المستخدم؟
-                if await paused_groups_collection.find_one({"owner_id": owner_id, "chat_id": group_id}): 
-                    continue
-                
-                # 2. فحص الرادار لهذا المستخدم
-                is_danger = False
-                async for admin_doc in admins_watch_collection.find({"owner_id": owner_id}):
-                    try:
-                        admin_entity = await client.get_entity(admin_doc['username'])
-                        if isinstance(admin_entity.status, (UserStatusOnline, UserStatusRecently)):
-                            is_danger = True; break
-                    except: pass
-                
-                if is_danger:
-                    # حذف آخر رسالة لهذا المستخدم في هذا الجروب
-                    last_msg = last_published_message_ids.get(f"{owner_id}_{group_id}")
-                    if last_msg: 
-                        try: await client.delete_messages(group_id, [last_msg])
-                        except: pass
-                    await asyncio.sleep(300); continue
-
-                # 3. النشر
+            # 3. النشر (الفواصل و FloodWait يتولاها مُجدول الإرسال للحساب)
+            if config.get('media_id'):
+                media = await client.media.get(config['media_id'])
+                sent_message = await client.sender.send(group_id,
+                    lambda: client.media.send_file(group_id, media, config['message']), LANE_AUTOPOST)
+            else:
+                sent_message = await client.sender.send(group_id,
+                    lambda: client.send_message(group_id, config['message']), LANE_AUTOPOST)
+            message_id = last_published_message_ids[key] = sent_message.id
+            self.posted += 1
+        except Exception as e: record_error("autopost_send", e)
+        finally:
+            self._inflight.discard(key)
+            # نعيد الجدولة فقط إذا لم يُزل الجروب أو يُعاد تسجيله أثناء النشر
+            if self._due.get(key) == entry:
+                self._schedule(key, next_due, next_due + jitter)
+                self._persist(key, next_due, message_id)
+
+    async def run(self):
+        while self._due or self._heap:
+            self._wake.clear()
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, owner_id, group_id = heapq.heappop(self._heap)
+                key = (owner_id, group_id)
+                entry = self._due.get(key)
+                if entry is None or entry[1] != fire_at or key in self._inflight: continue
+                self._inflight.add(key)
+                asyncio.create_task(self._post(key, entry), name=f"autopost:{owner_id}")
+            # تنظيف الإدخالات الملغاة إذا تراكمت
+            if len(self._heap) > 2 * len(self._due) + 64:
+                self._heap = [(fire_at, *k) for k, (_, fire_at) in self._due.items()]; heapq.heapify(self._heap)
+            timeout = self._heap[0][0] - time.time() if self._heap else 3600
+            try: await asyncio.wait_for(self._wake.wait(), timeout=max(0.05, timeout))
+            except asyncio.TimeoutError: pass
+
+autopost_scheduler = AutopostScheduler()
+
+BIO_TIMEZONE = timezone(timedelta(hours=float(os.getenv("BIO_UTC_OFFSET") or 3)))  # توقيت %TIME% (السعودية افتراضياً)
+BIO_SPREAD_SECONDS = 50                                   # توزيع التحديثات على أول N ثانية من الدقيقة
+BIO_MAX_LENGTH = 70                                       # حد تيليجرام للبايو (بدون Premium)
+DEFAULT_BIO_TEMPLATE = "Time: %TIME% | Status: Online"
+
+def render_bio(template, now):
+    return template.replace("%TIME%", now.strftime("%H:%M")).replace("%DATE%", now.strftime("%Y-%m-%d"))[:BIO_MAX_LENGTH]
+
+class BioScheduler:
+    """
+    مُحدث البايو التلقائي لكل الحسابات: دقة واحدة كل دقيقة (على رأس الدقيقة).
+    كل قالب يُحسب مرة واحدة في الدقة، والحساب الذي لم يتغير بايوه لا يُرسل له أي طلب،
+    والطلبات تتوزع على الدقيقة بدل أن تخرج كلها في نفس الثانية.
+    """
+
+    def __init__(self):
+        self._clients = {}    # {owner_id: client}
+        self._last_bio = {}   # {owner_id: آخر بايو أُرسل بنجاح}
+        self._inflight = {}   # {owner_id: أحدث بايو مطلوب لتحديث جارٍ} طلب واحد فقط لكل حساب
+        self.latency = {}     # {owner_id: زمن آخر تحديث (ثواني)}
+        self.updates = 0
+        self.skipped = 0
+        self._task = None
+
+    def __len__(self):
+        return len(self._clients)
+
+    def add_owner(self, client, owner_id):
+        self._clients[owner_id] = client
+        self._last_bio.pop(owner_id, None)
+        self._inflight.pop(owner_id, None)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run(), name="bio:scheduler")
+
+    def remove_owner(self, owner_id):
+        self._clients.pop(owner_id, None)
+        self._last_bio.pop(owner_id, None)
+        self._inflight.pop(owner_id, None)
+        self.latency.pop(owner_id, None)
+
+    async def _update(self, owner_id, client, delay):
+        """ يرسل أحدث بايو مطلوب؛ إن تغيّر أثناء الإرسال (تأخر بسبب FloodWait) يرسل الأحدث بعده """
+        try:
+            await asyncio.sleep(delay)
+            while self._clients.get(owner_id) is client:
+                bio = self._inflight.get(owner_id)
+                if bio is None or bio == self._last_bio.get(owner_id): break
+                started = time.perf_counter()
                 try:
-                    sent_message = await client.send_message(int(group_id), config['message'])
-                    # تخزين الآيدي بمعرف فريد (Owner + Group)
-                    last_published_message_ids[f"{owner_id}_{group_id}"] = sent_message.id
-                    await asyncio.sleep(5)
-                except FloodWaitError as f: await asyncio.sleep(f.seconds)
-                except: pass
-            
-            # الانتظار الخاص بهذا المستخدم
-            await asyncio.sleep(config.get('interval', 10) * 60)
-            
-        except asyncio.CancelledError:
-            print(f"Task Cancelled for {owner_id}")
-            break
-        except Exception as e:
-            print(f"Loop Error {owner_id}: {e}")
-            await asyncio.sleep(60)
+                    await client.sender.send(None, lambda: client(functions.account.UpdateProfileRequest(about=bio)), LANE_AUTOPOST)
+                    self._last_bio[owner_id] = bio
+                    self.updates += 1
+                except Exception as e: record_error("auto_bio", e); break
+                finally:
+                    self.latency[owner_id] = round(time.perf_counter() - started, 3)
+                    bio_update_latency.observe(self.latency[owner_id], owner=owner_id)
+        finally:
+            if self._clients.get(owner_id) is client: self._inflight.pop(owner_id, None)
+
+    async def tick(self, now):
+        rendered = {}  # {قالب: نص} يُحسب مرة واحدة لكل قالب في هذه الدقة
+        due = []
+        for owner_id, client in list(self._clients.items()):
+            bio_settings = (await get_owner_settings(owner_id)).bio
+            if not bio_settings or not bio_settings.get('active'): continue
+            template = bio_settings.get('template') or DEFAULT_BIO_TEMPLATE
+            bio = rendered.get(template)
+            if bio is None: bio = rendered[template] = render_bio(template, now)
+            if bio in (self._last_bio.get(owner_id), self._inflight.get(owner_id)): self.skipped += 1; continue
+            running = owner_id in self._inflight
+            self._inflight[owner_id] = bio
+            if not running: due.append((owner_id, client))  # الجاري يلتقط البايو الجديد بعد انتهائه
+        step = BIO_SPREAD_SECONDS / max(len(due), 1)
+        for index, (owner_id, client) in enumerate(due):
+            asyncio.create_task(self._update(owner_id, client, index * step), name=f"bio:{owner_id}")
+
+    async def run(self):
+        while self._clients:
+            # النوم حتى رأس الدقيقة التالية
+            await asyncio.sleep(60 - time.time() % 60)
+            try: await self.tick(datetime.now(BIO_TIMEZONE))
+            except Exception as e: record_error("auto_bio_tick", e)
+
+bio_scheduler = BioScheduler()
+
+AUTO_LEAVE_AFTER = 86400      # مغادرة القنوات الإجبارية بعد 24 ساعة من الانضمام
+AUTO_LEAVE_HORIZON = 6 * 3600  # نحمّل من القاعدة فقط ما يستحق خلال هذه الفترة
+AUTO_LEAVE_RETRY = 600         # إعادة محاولة مغادرة فاشلة بعد 10 دقائق، وتتضاعف مع كل فشل حتى الحد
+AUTO_LEAVE_RETRY_MAX = 6 * 3600
+# خارج القناة أصلاً (غادرنا يدوياً أو حُذفت): المغادرة تُعتبر تمت
+AUTO_LEAVE_GONE_ERRORS = (UserNotParticipantError, ChannelPrivateError, ChannelInvalidError, ValueError)
+
+class LeaveScheduler:
+    """
+    مُجدول المغادرة لحساب واحد: كومة (min-heap) مرتبة بموعد المغادرة.
+    ينام حتى أقرب موعد بدل فحص كل الاشتراكات كل ساعة، ويحمّل من القاعدة
+    بنطاق مفهرس (join_time) ما يستحق خلال الأفق فقط.
+    """
 
-async def engine_auto_leave_channels(client, owner_id):
-    while True:
+    def __init__(self, client, owner_id):
+        self.client = client
+        self.owner_id = owner_id
+        self._heap = []        # [(موعد المغادرة, chat_id)]
+        self._deadlines = {}   # {chat_id: موعد المغادرة} الإدخال الأحدث فقط هو الصحيح
+        self._loaded_until = 0 # آخر join_time تم تحميله من القاعدة
+        self._wake = asyncio.Event()
+        self._retries = {}     # {chat_id: عدد المحاولات الفاشلة}
+        self.left = 0
+
+    def schedule(self, chat_id, join_time):
+        """ إضافة قناة (انضمام جديد أو إعادة انضمام) وإيقاظ المُجدول إذا صار موعدها الأقرب """
+        self._schedule_at(chat_id, join_time + AUTO_LEAVE_AFTER)
+
+    def _schedule_at(self, chat_id, leave_at):
+        self._deadlines[chat_id] = leave_at
+        heapq.heappush(self._heap, (leave_at, chat_id))
+        if self._heap[0][1] == chat_id: self._wake.set()
+
+    def trigger(self):
+        """ التنظيف اليدوي: إعادة مطابقة القاعدة فوراً ومغادرة ما حان وقته """
+        self._loaded_until = 0
+        self._wake.set()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    async def _load(self, now):
+        """ تحميل الاشتراكات التي يحين موعدها قبل now + الأفق (استعلام نطاق على فهرس owner_id + join_time) """
+        limit = now - AUTO_LEAVE_AFTER + AUTO_LEAVE_HORIZON
+        query = {"owner_id": self.owner_id, "join_time": {"$lt": limit}}
+        if self._loaded_until: query["join_time"]["$gte"] = self._loaded_until
+        async for sub in subscriptions_collection.find(query, {"chat_id": 1, "join_time": 1, "_id": 0}):
+            if sub['chat_id'] not in self._deadlines or self._deadlines[sub['chat_id']] > sub['join_time'] + AUTO_LEAVE_AFTER:
+                self.schedule(sub['chat_id'], sub['join_time'])
+        self._loaded_until = limit
+
+    async def _leave(self, chat_id):
+        target_id = chat_id
+        try: target_id = int(target_id)
+        except (TypeError, ValueError): pass
         try:
-            current_timestamp = time.time()
-            # البحث عن اشتراكات هذا المستخدم فقط
-            async for sub in subscriptions_collection.find({"owner_id": owner_id}):
-                if current_timestamp - sub['join_time'] > 86400: # 24 ساعة
-                    try:
-                        target_id = sub['chat_id']
-                        try: target_id = int(target_id)
-                        except: pass
-                        await client(LeaveChannelRequest(target_id))
-                        await subscriptions_collection.delete_one({"_id": sub['_id']})
-                    except: pass
-        except: pass
-        await asyncio.sleep(3600)
-
-async def engine_broadcast_sender(client, status_message, message_event):
-    count_sent = 0
+            await self.client.sender.send(None, lambda: self.client(LeaveChannelRequest(target_id)), LANE_BULK)
+            self.left += 1
+        except AUTO_LEAVE_GONE_ERRORS as e: record_error("auto_leave_gone", e)
+        except Exception as e:
+            # فشل مؤقت: الاشتراك يبقى في القاعدة ونعيد المحاولة لاحقاً بمهلة متزايدة
+            record_error("auto_leave", e)
+            attempts = self._retries[chat_id] = self._retries.get(chat_id, 0) + 1
+            self._schedule_at(chat_id, time.time() + min(AUTO_LEAVE_RETRY * 2 ** (attempts - 1), AUTO_LEAVE_RETRY_MAX))
+            return
+        self._retries.pop(chat_id, None)
+        self.client.joiner.forget(chat_id)
+        if isinstance(target_id, int): self.client.dialogs.discard(utils.get_peer_id(types.PeerChannel(target_id)))
+        subscriptions_writes.add(DeleteOne({"owner_id": self.owner_id, "chat_id": chat_id}), key=(self.owner_id, chat_id))
+
+    async def run(self):
+        # يتوقف تلقائياً إذا استُبدل هذا الحساب بجلسة جديدة
+        while active_userbot_clients.get(self.owner_id) is self.client:
+            self._wake.clear()
+            now = time.time()
+            try:
+                if now - AUTO_LEAVE_AFTER + AUTO_LEAVE_HORIZON / 2 > self._loaded_until: await self._load(now)
+            except Exception as e: record_error("auto_leave_load", e)
+
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                leave_at, chat_id = heapq.heappop(self._heap)
+                if self._deadlines.get(chat_id) == leave_at:
+                    del self._deadlines[chat_id]
+                    due.append(chat_id)
+            # المغادرات تمر من مُجدول الإرسال (حدود المعدل و FloodWait) فلا بأس بإطلاقها معاً
+            if due: await asyncio.gather(*(self._leave(chat_id) for chat_id in due))
+
+            next_due = self._heap[0][0] if self._heap else now + AUTO_LEAVE_HORIZON / 2
+            try: await asyncio.wait_for(self._wake.wait(), timeout=max(1, min(next_due, now + AUTO_LEAVE_HORIZON / 2) - time.time()))
+            except asyncio.TimeoutError: pass
+
+BROADCAST_CONCURRENCY = 8          # عدد الإرسالات المتزامنة (الحدود الفعلية في مُجدول الإرسال)
+BROADCAST_CHECKPOINT_EVERY = 25    # حفظ التقدم في القاعدة كل N محادثة
+BROADCAST_STATUS_INTERVAL = 5      # تحديث رسالة الحالة كل N ثواني
+
+async def engine_broadcast_sender(client, status_message, message_event, job=None):
+    """
+    برودكاست للخاص: رفع واحد للوسائط ثم إعادة استخدام مرجعها، إرسال متزامن محدود
+    أثناء المرور على المحادثات، وحفظ التقدم في القاعدة للاستئناف بعد أي توقف.
+    """
+    owner_id = client.owner_id
+    job = job or {}
+    done = set(job.get('done', []))
+    counters = {'sent': job.get('sent', 0), 'failed': job.get('failed', 0)}
+    pending_checkpoint = []
+    started_at = time.time(); sent_this_run = 0
+    finished = False
+
+    async def checkpoint():
+        if not pending_checkpoint: return
+        batch = pending_checkpoint[:]; pending_checkpoint.clear()
+        await broadcast_jobs_collection.update_one({"_id": owner_id},
+            {"$addToSet": {"done": {"$each": batch}}, "$set": {"sent": counters['sent'], "failed": counters['failed']}})
+
+    async def report_status():
+        while True:
+            await asyncio.sleep(BROADCAST_STATUS_INTERVAL)
+            rate = sent_this_run / max(time.time() - started_at, 1) * 60
+            try: await status_message.edit(f"🚀 **جاري النشر...**\n✅ `{counters['sent']}` | ❌ `{counters['failed']}` | ⚡ `{rate:.0f}`/دقيقة")
+            except Exception as e: record_error("broadcast_status", e)
+
+    reporter = None
+    error = None
     try:
-        # تحميل الوسائط إذا وجدت (لضمان وصولها من البوت لليوزربوت)
-        media_file = None
-        if message_event.media:
-            await status_message.edit("⏳ **جاري معالجة الوسائط...**")
-            media_file = await message_event.download_media()
-        
         text_content = message_event.text or ""
+        media = None
+        if message_event.media:
+            await status_message.edit("⏳ **تجهيز الوسائط...**")
+            media = await client.media.from_message(message_event)
+
+        async def send_one(dialog_id):
+            if media is None:
+                return await client.sender.send(dialog_id, lambda: client.send_message(dialog_id, text_content), LANE_BULK)
+            return await client.sender.send(dialog_id, lambda: client.media.send_file(dialog_id, media, text_content), LANE_BULK)
 
         await status_message.edit("🚀 **بدأ النشر...**")
-        
-        async for dialog in client.iter_dialogs():
-            if dialog.is_user and not dialog.entity.bot:
+        reporter = asyncio.create_task(report_status())
+        queue = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 2)
+
+        async def producer():
+            try:
+                for dialog_id in await client.dialogs.ids(DIALOG_USER):
+                    if dialog_id not in done: await queue.put(dialog_id)
+            finally:
+                for _ in range(BROADCAST_CONCURRENCY): await queue.put(None)
+
+        async def worker():
+            nonlocal sent_this_run
+            while (dialog_id := await queue.get()) is not None:
                 try:
-                    if media_file:
-                        await client.send_message(dialog.id, text_content, file=media_file)
-                    else:
-                        await client.send_message(dialog.id, text_content)
-                    count_sent += 1
-                    await asyncio.sleep(1)
-                except: pass
-        
-        if media_file and os.path.exists(media_file):
-            os.remove(media_file)
+                    await send_one(dialog_id)
+                    counters['sent'] += 1; sent_this_run += 1
+                except Exception: counters['failed'] += 1
+                done.add(dialog_id); pending_checkpoint.append(dialog_id)
+                if len(pending_checkpoint) >= BROADCAST_CHECKPOINT_EVERY: await checkpoint()
+
+        await asyncio.gather(producer(), *(worker() for _ in range(BROADCAST_CONCURRENCY)))
+        finished = True
+    except asyncio.CancelledError:
+        # الإيقاف: نحفظ التقدم ونترك المهمة في القاعدة لتُستأنف
+        await checkpoint(); raise
+    except Exception as e:
+        error = e
+        logger.warning(f"Broadcast failed {owner_id}: {e}")
+        record_error("broadcast", e)
+    finally:
+        if reporter: reporter.cancel()
+
+    if finished:
+        await broadcast_jobs_collection.delete_one({"_id": owner_id})
+        await status_message.edit(f"✅ **تم.**\nالمستلمين: `{counters['sent']}` | فشل: `{counters['failed']}`")
+    else:
+        # فشل (لا إيقاف): يبقى في القاعدة كسجل لكن الاستئناف عند التشغيل يتخطاه
+        await checkpoint()
+        await broadcast_jobs_collection.update_one({"_id": owner_id},
+            {"$set": {"status": "failed", "error": f"{type(error).__name__}: {error}"}})
+        await status_message.edit(f"❌ **توقف البرودكاست:** {type(error).__name__}\n"
+                                  f"المستلمين: `{counters['sent']}` | فشل: `{counters['failed']}`")
+
+broadcast_tasks = {}  # {owner_id: Task} برودكاست واحد فقط يعمل لكل حساب (المهمة تملك وثيقة الحساب في broadcast_jobs)
+
+broadcast_starting = set()  # حسابات حُجز لها البرودكاست قبل أول await (حتى لا يمر طلبان متتاليان من الفحص)
+
+def is_broadcast_running(owner_id):
+    if owner_id in broadcast_starting: return True
+    task = broadcast_tasks.get(owner_id)
+    return task is not None and not task.done()
+
+def run_broadcast_task(client, status_message, message_event, job):
+    owner_id = client.owner_id
+    task = asyncio.create_task(engine_broadcast_sender(client, status_message, message_event, job), name=f"broadcast:{owner_id}")
+    broadcast_tasks[owner_id] = task
+    task.add_done_callback(lambda t: broadcast_tasks.pop(owner_id, None) if broadcast_tasks.get(owner_id) is t else None)
+
+async def start_broadcast_job(client, status_message, message_event):
+    """ تسجيل مهمة البرودكاست في القاعدة ثم تشغيلها؛ False إذا كان للحساب برودكاست جارٍ """
+    owner_id = client.owner_id
+    if is_broadcast_running(owner_id): return False
+    broadcast_starting.add(owner_id)
+    try:
+        job = {"_id": owner_id, "source_chat": message_event.chat_id, "source_msg_id": message_event.id,
+               "status_chat": status_message.chat_id, "status_msg_id": status_message.id,
+               "done": [], "sent": 0, "failed": 0, "status": "running", "started": time.time()}
+        await broadcast_jobs_collection.replace_one({"_id": owner_id}, job, upsert=True)
+        run_broadcast_task(client, status_message, message_event, job)
+    finally: broadcast_starting.discard(owner_id)
+    return True
+
+async def resume_broadcast_job(client, owner_id):
+    """ استئناف برودكاست محفوظ في القاعدة من حيث توقف """
+    try:
+        job = await broadcast_jobs_collection.find_one({"_id": owner_id})
+        if not job or job.get('status') == "failed" or is_broadcast_running(owner_id): return
+        await bot_ready.wait()
+        message_event = await bot_client.get_messages(job['source_chat'], ids=job['source_msg_id'])
+        status_message = await bot_client.get_messages(job['status_chat'], ids=job['status_msg_id'])
+        if not message_event or not status_message:
+            await broadcast_jobs_collection.delete_one({"_id": owner_id}); return
+        if is_broadcast_running(owner_id): return
+        logger.info(f"Resuming broadcast for {owner_id} ({len(job.get('done', []))} done)")
+        run_broadcast_task(client, status_message, message_event, job)
+    except Exception as e:
+        logger.warning(f"Broadcast resume failed {owner_id}: {e}")
+
+SEARCH_CONCURRENCY = 4        # عدد الجروبات التي تُفحص بالتوازي
+SEARCH_PER_CHAT_LIMIT = 50    # أقصى نتائج لكل جروب (نتوقف قبلها عند الخروج من النافذة الزمنية)
+SEARCH_GLOBAL_LIMIT = 1000    # أقصى نتائج من البحث العام
+
+async def load_replied_users(owner_id):
+    """ كل من تم الرد عليه سابقاً في مهام هذا المستخدم (استعلام واحد لكل مهمة) """
+    return {d['user_id'] async for d in search_replied_collection.find({"owner_id": owner_id}, {"user_id": 1, "_id": 0})}
+
+def remember_replied_user(owner_id, user_id):
+    search_replied_writes.add(UpdateOne({"owner_id": owner_id, "user_id": user_id},
+        {"$set": {"ts": time.time()}}, upsert=True), key=(owner_id, user_id))
+
+async def search_hits_global(client, keyword, limit_time, until=None):
+    """ بحث عام من السيرفر (messages.searchGlobal): النتائج مرتبة بالأحدث، فنتوقف عند أول رسالة قديمة """
+    async for msg in client.iter_messages(None, search=keyword, limit=SEARCH_GLOBAL_LIMIT, offset_date=until):
+        if msg.date.timestamp() <= limit_time: break
+        if msg.is_group: yield msg
+
+async def search_hits_per_group(client, keyword, limit_time, until=None):
+    """ بديل البحث العام: فحص الجروبات بالتوازي مع التوقف في كل جروب عند الخروج من النافذة """
+    hits = asyncio.Queue()
+    semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+
+    async def scan(chat_id):
+        async with semaphore:
+            try:
+                async for msg in client.iter_messages(chat_id, search=keyword, limit=SEARCH_PER_CHAT_LIMIT, offset_date=until):
+                    if msg.date.timestamp() <= limit_time: break
+                    await hits.put(msg)
+            except FloodWaitError as f: client.sender.note_flood_wait(f.seconds)
+            except Exception as e: record_error("search_scan", e)
+
+    async def scan_all():
+        scans = [asyncio.create_task(scan(chat_id), name=f"search:{client.owner_id}") for chat_id in await client.dialogs.ids(DIALOG_GROUP)]
+        await asyncio.gather(*scans)
+        await hits.put(None)
+
+    scanner = asyncio.create_task(scan_all())
+    try:
+        while (msg := await hits.get()) is not None:
+            yield msg
+    finally:
+        scanner.cancel()
 
-    except: pass
-    await status_message.edit(f"✅ **تم.**\nالمستلمين: `{count_sent}`")
+async def search_hits_telegram(client, keyword, limit_time, until=None):
+    """ البحث العام، ومع فشله (غير متاح أو FloodWait) الفحص المتوازي للجروبات """
+    try:
+        async for msg in search_hits_global(client, keyword, limit_time, until): yield msg
+    except Exception as e:
+        if isinstance(e, FloodWaitError): client.sender.note_flood_wait(e.seconds)
+        async for msg in search_hits_per_group(client, keyword, limit_time, until): yield msg
+
+async def search_hits_indexed(client, keyword, limit_time):
+    """ الفهرس المحلي أولاً، ثم تيليجرام فقط لفجوات التغطية (ونتائجها تُضاف للفهرس) """
+    for msg in await client.messages.search(keyword, limit_time): yield msg
+    for start, end in reversed(await client.messages.gaps(limit_time)):
+        until = datetime.fromtimestamp(end, timezone.utc)
+        async for msg in search_hits_telegram(client, keyword, start, until):
+            if msg.date.timestamp() >= end: continue
+            client.messages.add(msg)
+            yield msg
 
 async def engine_search_task(client, status_msg, hours, keyword, reply_msg_object, delay):
-    count = 0; limit_time = time.time() - (hours * 3600); replied_users = set()
+    owner_id = client.owner_id
+    count = 0; limit_time = time.time() - (hours * 3600)
     try:
-        my_info = await client.get_me()
+        # من تم الرد عليهم في أي مهمة سابقة يُتخطون بدون أي طلب
+        replied_users = await load_replied_users(owner_id)
         
-        # تحميل ميديا الرد
-        reply_file = None
+        # ميديا الرد (من كاش الوسائط: بدون ملفات على القرص)
+        reply_media = None
         if reply_msg_object.media:
-            await status_msg.edit("⏳ **تحميل الميديا...**")
-            reply_file = await reply_msg_object.download_media()
+            await status_msg.edit("⏳ **تجهيز الميديا...**")
+            reply_media = await client.media.from_message(reply_msg_object)
         reply_text = reply_msg_object.text or ""
 
         await status_msg.edit(f"🚀 **بدأ البحث...**")
 
-        async for dialog in client.iter_dialogs():
-            if dialog.is_group:
-                try:
-                    async for msg in client.iter_messages(dialog.id, search=keyword, limit=20):
-                        if msg.date.timestamp() > limit_time and msg.sender_id != my_info.id:
-                            if msg.sender_id in replied_users: continue
-                            try:
-                                if reply_file:
-                                    await client.send_message(dialog.id, reply_text, file=reply_file, reply_to=msg.id)
-                                else:
-                                    await client.send_message(dialog.id, reply_text, reply_to=msg.id)
-                                replied_users.add(msg.sender_id)
-                                count += 1
-                                await asyncio.sleep(delay)
-                            except: pass
-                except: pass
-        
-        if reply_file: os.remove(reply_file)
-    except: pass
+        async def reply_to(msg):
+            nonlocal count
+            if msg.sender_id in replied_users or msg.sender_id == client.my_id: return
+            replied_users.add(msg.sender_id)
+            try:
+                if reply_media is None:
+                    await client.sender.send(msg.chat_id,
+                        lambda: client.send_message(msg.chat_id, reply_text, reply_to=msg.id), LANE_BULK)
+                else:
+                    await client.sender.send(msg.chat_id,
+                        lambda: client.media.send_file(msg.chat_id, reply_media, reply_text, reply_to=msg.id), LANE_BULK)
+                remember_replied_user(owner_id, msg.sender_id)
+                count += 1
+                # الفاصل الذي اختاره المستخدم لهذه المهمة (فوق حدود المُجدول)
+                await asyncio.sleep(delay)
+            except Exception as e: record_error("search_reply", e)
+
+        hits = search_hits_indexed(client, keyword, limit_time) if client.messages is not None else search_hits_telegram(client, keyword, limit_time)
+        async for msg in hits: await reply_to(msg)
+    except Exception as e: record_error("search", e)
     await status_msg.respond(f"✅ تم الرد على {count}")
 
+# ==============================================================================
+#                               7.1 أوامر الحسابات (Account Commands)
+# ==============================================================================
+# كل ما تطلبه لوحة التحكم من حساب المستخدم يمر عبر account_call:
+# في وضع العملية الواحدة يُنفذ مباشرة، وفي وضع التوزيع يُرسل للعامل المالك للحساب.
+# لذلك المعاملات كلها قابلة للتحويل لـ JSON (آيديات الرسائل بدل كائناتها).
+
+async def account_start_session(owner_id, session_string):
+    return await start_userbot_session(owner_id, session_string)
+
+async def account_manage_autopost(owner_id):
+    invalidate_owner_settings(owner_id)
+    await manage_user_autopost_task(active_userbot_clients[owner_id], owner_id)
+
+async def account_invalidate_settings(owner_id):
+    invalidate_owner_settings(owner_id)
+
+async def account_invalidate_replies(owner_id):
+    invalidate_reply_matcher(owner_id)
+
+async def account_radar_changed(owner_id):
+    active_userbot_clients[owner_id].presence.mark_dirty()
+
+async def account_clean_channels(owner_id):
+    # لا نشغل حلقة جديدة: فقط نوقظ المُجدول الموجود
+    active_userbot_clients[owner_id].leaver.trigger()
+
+async def account_stats(owner_id):
+    dialogs = active_userbot_clients[owner_id].dialogs
+    return {"dialogs": len(dialogs), **await dialogs.counts()}
+
+async def account_list_groups(owner_id, query=None, offset=0, limit=GROUP_PICKER_PAGE_SIZE):
+    total, page = await active_userbot_clients[owner_id].dialogs.search_groups(query, offset, limit)
+    return {"total": total, "groups": [[e.id, e.title, e.members] for e in page]}
+
+async def account_broadcast(owner_id, status_chat, status_msg_id, source_chat, source_msg_id):
+    status_message = await bot_client.get_messages(status_chat, ids=status_msg_id)
+    message_event = await bot_client.get_messages(source_chat, ids=source_msg_id)
+    return await start_broadcast_job(active_userbot_clients[owner_id], status_message, message_event)
+
+async def account_search(owner_id, status_chat, status_msg_id, hours, keyword, reply_chat, reply_msg_id, delay):
+    status_message = await bot_client.get_messages(status_chat, ids=status_msg_id)
+    reply_message = await bot_client.get_messages(reply_chat, ids=reply_msg_id)
+    asyncio.create_task(engine_search_task(active_userbot_clients[owner_id], status_message, hours, keyword, reply_message, delay),
+                        name=f"search:{owner_id}")
+
+async def account_status(owner_id=None):
+    return {"accounts": len(active_userbot_clients),
+            "queued_sends": sum(c.sender.queue_depth() for c in active_userbot_clients.values())}
+
+async def account_mentions(owner_id, keyword, hours):
+    """ إحصائية كلمة من فهرس الرسائل المحلي (None إذا كان معطلاً): المجموع وأكثر الجروبات والمرسلين """
+    client = active_userbot_clients[owner_id]
+    if client.messages is None: return None
+    since = time.time() - hours * 3600
+    total, chats, senders = await client.messages.keyword_stats(keyword, since)
+    titles = {e.id: e.title for e in await client.dialogs.entries(DIALOG_GROUP)}
+    return {"total": total, "chats": [[chat_id, titles.get(chat_id, str(chat_id)), n] for chat_id, n in chats],
+            "senders": [list(row) for row in senders], "partial": bool(await client.messages.gaps(since))}
+
+ACCOUNT_COMMANDS = {
+    "start_session": account_start_session,
+    "manage_autopost": account_manage_autopost,
+    "invalidate_settings": account_invalidate_settings,
+    "invalidate_replies": account_invalidate_replies,
+    "radar_changed": account_radar_changed,
+    "clean_channels": account_clean_channels,
+    "stats": account_stats,
+    "list_groups": account_list_groups,
+    "broadcast": account_broadcast,
+    "search": account_search,
+    "mentions": account_mentions,
+}
+
+async def account_call(owner_id, command, **kwargs):
+    """ تنفيذ أمر على حساب المستخدم (محلياً أو عبر IPC للعامل المالك للحساب) """
+    if shard_supervisor is None:
+        return await ACCOUNT_COMMANDS[command](owner_id, **kwargs)
+    return await shard_supervisor.call(owner_id, command, kwargs)
+
+def is_account_active(owner_id):
+    if shard_supervisor is None: return owner_id in active_userbot_clients
+    return owner_id in shard_supervisor.active_owners
+
+async def fleet_status():
+    if shard_supervisor is None: return await account_status()
+    return await shard_supervisor.status()
+
+async def fleet_profile(seconds, debug=False):
+    """ المُحلل في هذه العملية (وفي كل العمال بالتوازي في وضع التوزيع): {اسم العملية: تقرير} """
+    seconds = max(1.0, min(float(seconds), PROFILE_MAX_SECONDS))
+    if shard_supervisor is None: return {"main": await run_profile(seconds, debug)}
+    main_report, shard_reports = await asyncio.gather(run_profile(seconds, debug), shard_supervisor.profile(seconds, debug))
+    return {"supervisor": main_report, **shard_reports}
+
+# ==============================================================================
+#                               7.2 الفواتير (PDF)
+# ==============================================================================
+# رسم فواتير data.json (invoices_archive) في عملية فرعية (invoice_render.py) لها مجمع عمالها،
+# حتى لا يتوقف البوت ولا تعيد عمال spawn تشغيل bot.py (انظر وصف ذلك الملف).
+
+DATA_FILE = os.getenv("DATA_FILE", "data.json")
+INVOICE_FONT = os.getenv("INVOICE_FONT", "font.ttf")
+INVOICE_LOGO = os.getenv("INVOICE_LOGO", "saved_store_logo.jpg")
+INVOICE_WORKERS = int(os.getenv("INVOICE_WORKERS") or 2)
+INVOICE_BATCH_SIZE = 50   # فواتير لكل مهمة في العامل
+INVOICE_RENDERER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "invoice_render.py")
+invoice_font_error = None  # يُفحص الخط مرة عند التشغيل؛ الخطأ يُعرض لـ /invoices بدل فشل كل طلب
+
+def check_invoice_setup():
+    global invoice_font_error
+    try: check_invoice_font(INVOICE_FONT)
+    except (OSError, ValueError) as e:
+        invoice_font_error = str(e)
+        logger.error(f"Invoices disabled: {e} (set INVOICE_FONT to a TrueType font with Arabic glyphs)")
+
+def invoice_timestamp(invoice):
+    """ وقت الفاتورة إن وُجد (الأرشيف الحالي بدون تواريخ) """
+    value = invoice.get('date') or invoice.get('created')
+    if value is None: return None
+    if isinstance(value, (int, float)): return float(value)
+    try: return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError: return None
+
+def load_invoices(store=None, since=None, until=None):
+    """ فواتير المتجر/الفترة: (المختارة، عدد غير المؤرخة، هل للمتجر شعار) """
+    with open(DATA_FILE, encoding='utf-8') as f: data = json.load(f)
+    default_store = data.get('store_name') or "store"
+    selected, undated = [], 0
+    for invoice_id, invoice in (data.get('invoices_archive') or {}).items():
+        store_name = invoice.get('store_name') or default_store
+        if store and store_name.lower() != store.lower(): continue
+        stamp = invoice_timestamp(invoice)
+        if stamp is None: undated += 1
+        elif (since and stamp < since) or (until and stamp >= until): continue
+        selected.append((invoice_id, invoice, store_name))
+    return selected, undated, bool(data.get('has_logo'))
+
+async def export_invoices_zip(store=None, since=None, until=None):
+    """ رسم الفواتير دفعات في العمال وكتابتها في zip حسب اكتمالها: (الملف، العدد، غير المؤرخة) """
+    selected, undated, with_logo = await asyncio.to_thread(load_invoices, store, since, until)
+    if not selected: return io.BytesIO(), 0, undated
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, INVOICE_RENDERER, INVOICE_FONT, INVOICE_LOGO or "", str(INVOICE_WORKERS), str(INVOICE_BATCH_SIZE),
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    output, errors = await process.communicate(json.dumps({"items": selected, "with_logo": with_logo}).encode())
+    if process.returncode:
+        lines = errors.decode(errors='replace').strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else f"renderer exited with {process.returncode}")
+    return io.BytesIO(output), len(selected), undated
+
 # ==============================================================================
 #                               8. واجهة المستخدم
 # ==============================================================================
@@ -427,8 +2901,8 @@ async def start_handler(event):
     chat_id = event.chat_id
     
     # فحص إذا كان المستخدم مسجلاً
-    if chat_id in active_userbot_clients:
-        config = await autopost_config_collection.find_one({"owner_id": chat_id})
+    if is_account_active(chat_id):
+        config = (await get_owner_settings(chat_id)).autopost
         status_post = "🟢" if config and config.get('active') else "🔴"
         
         buttons = [
@@ -436,7 +2910,8 @@ async def start_handler(event):
             [Button.inline("📨 برودكاست (صور/نص)", b"broadcast_menu")],
             [Button.inline("📋 الردود", b"list_replies"), Button.inline("👮 الرادار", b"menu_radar")],
             [Button.inline("🚀 مهام بحث", b"menu_tasks"), Button.inline("🤖 ذكاء", b"toggle_ai")],
-            [Button.inline("📊 إحصائيات", b"view_stats"), Button.inline("🗑️ تنظيف القنوات", b"clean_channels")]
+            [Button.inline("📊 إحصائيات", b"view_stats"), Button.inline("🗑️ تنظيف القنوات", b"clean_channels")],
+            [Button.inline("🕒 البايو التلقائي", b"menu_bio")]
         ]
         await event.respond("✅ **لوحة التحكم الكاملة**", buttons=buttons)
     else:
@@ -448,14 +2923,65 @@ async def cancel_handler(event):
     user_current_state[chat_id] = None
     await event.respond("✅ **تم الإلغاء.**")
 
+@bot_client.on(events.NewMessage(pattern=r'/profile'))
+async def profile_handler(event):
+    """ /profile [ثواني] [debug] — للمشرفين فقط: تقرير المُحلل كملف نصي """
+    if event.sender_id not in ADMIN_IDS: return
+    args = event.raw_text.split()[1:]
+    seconds = int(args[0]) if args and args[0].isdigit() else 10
+    await event.respond(f"⏱️ **جاري التحليل لمدة {seconds} ثانية...**")
+    try: reports = await fleet_profile(seconds, "debug" in args)
+    except RuntimeError as e: return await event.respond(f"❌ {e}")
+    text = "\n\n".join(format_profile_report(name, report) if "error" not in report else f"== {name}: {report['error']}"
+                       for name, report in reports.items())
+    report_file = io.BytesIO(text.encode()); report_file.name = "profile.txt"
+    await bot_client.send_file(event.chat_id, report_file, caption="📈 **تقرير الأداء**")
+
+@bot_client.on(events.NewMessage(pattern=r'/mentions'))
+async def mentions_handler(event):
+    """ /mentions [ساعات] الكلمة — من ذكر الكلمة في جروبات الحساب (من فهرس الرسائل المحلي) """
+    if not is_account_active(event.chat_id): return
+    args = event.raw_text.split()[1:]
+    hours = int(args.pop(0)) if args and args[0].isdigit() else 24
+    keyword = " ".join(args)
+    if not keyword: return await event.respond("⚠️ الاستخدام: `/mentions 24 الكلمة`")
+    stats = await account_call(event.chat_id, "mentions", keyword=keyword, hours=hours)
+    if stats is None: return await event.respond("❌ فهرس الرسائل غير مفعل (MESSAGE_INDEX_DIR)")
+    lines = [f"🔎 **{keyword}** خلال {hours} ساعة: {stats['total']} رسالة"]
+    lines += [f"👥 {title}: {n}" for _, title, n in stats['chats']]
+    lines += [f"👤 [{sender_id}](tg://user?id={sender_id}): {n}" for sender_id, n in stats['senders'] if sender_id]
+    if stats['partial']: lines.append("⚠️ الفهرس لا يغطي كامل الفترة (فُعّل حديثاً أو كان الحساب متوقفاً)")
+    await event.respond("\n".join(lines))
+
+@bot_client.on(events.NewMessage(pattern=r'/invoices'))
+async def invoices_handler(event):
+    """ /invoices [اسم المتجر] [من YYYY-MM-DD] [إلى YYYY-MM-DD] — للمشرفين فقط: ملف zip بكل الفواتير """
+    if event.sender_id not in ADMIN_IDS: return
+    if invoice_font_error: return await event.respond(f"❌ **الفواتير معطلة:** {invoice_font_error}")
+    args = event.raw_text.split()[1:]
+    dates = [datetime.strptime(a, "%Y-%m-%d").timestamp() for a in args if re.fullmatch(r'\d{4}-\d{2}-\d{2}', a)]
+    store = " ".join(a for a in args if not re.fullmatch(r'\d{4}-\d{2}-\d{2}', a)) or None
+    since = dates[0] if dates else None
+    until = dates[1] + 86400 if len(dates) > 1 else None  # تاريخ النهاية يشمل اليوم كاملاً
+    status = await event.respond("🧾 **جاري تجهيز الفواتير...**")
+    try: archive, count, undated = await export_invoices_zip(store, since, until)
+    except Exception as e:
+        record_error("invoices", e)
+        return await status.edit(f"❌ **فشل التصدير:** {type(e).__name__}: {e}")
+    if not count: return await status.edit("❌ لا توجد فواتير مطابقة")
+    archive.name = f"invoices_{(store or 'all').replace(' ', '_')}.zip"
+    note = f"\n⚠️ {undated} فاتورة بدون تاريخ (مشمولة دائماً)" if undated and dates else ""
+    await bot_client.send_file(event.chat_id, archive, caption=f"🧾 **{count} فاتورة**{note}")
+    await status.delete()
+
 @bot_client.on(events.CallbackQuery)
 async def callback_handler(event):
     chat_id = event.chat_id
     data = event.data
-    client = active_userbot_clients.get(chat_id)
+    account_active = is_account_active(chat_id)
 
     # تنبيه إذا لم يسجل
-    if not client and data != b"login":
+    if not account_active and data != b"login":
         await event.answer("⚠️ سجل دخولك أولاً!", alert=True)
         return
 
@@ -467,7 +2993,7 @@ async def callback_handler(event):
 
     elif data == b"clean_channels":
         await event.respond("🧹 **جاري العمل...**")
-        asyncio.create_task(engine_auto_leave_channels(client, chat_id))
+        await account_call(chat_id, "clean_channels")
 
     elif data == b"menu_autopost":
         conf = await autopost_config_collection.find_one({"owner_id": chat_id})
@@ -483,12 +3009,13 @@ async def callback_handler(event):
 
     elif data == b"view_current_post":
         conf = await autopost_config_collection.find_one({"owner_id": chat_id})
-        await event.respond(f"📝 **الرسالة:**\n\n{conf['message']}" if conf else "❌ لا توجد رسالة")
+        await event.respond(f"📝 **الرسالة:**{' 🖼️' if conf.get('media_id') else ''}\n\n{conf['message']}" if conf else "❌ لا توجد رسالة")
 
     elif data == b"delete_autopost_settings":
         await autopost_config_collection.delete_one({"owner_id": chat_id})
+        invalidate_owner_settings(chat_id)
         # إيقاف المهمة الخاصة بهذا المستخدم
-        await manage_user_autopost_task(client, chat_id)
+        await account_call(chat_id, "manage_autopost")
         await event.respond("🗑️ **تم الحذف والإيقاف.**")
 
     elif data == b"setup_post":
@@ -503,9 +3030,10 @@ async def callback_handler(event):
         
         new_status = not conf.get('active', False)
         await autopost_config_collection.update_one({"owner_id": chat_id}, {"$set": {"active": new_status}}, upsert=True)
+        invalidate_owner_settings(chat_id)
         
         # إعادة تشغيل المهمة لهذا المستخدم
-        await manage_user_autopost_task(client, chat_id)
+        await account_call(chat_id, "manage_autopost")
         
         await event.respond(f"✅ الحالة الآن: {'🟢 يعمل' if new_status else '🔴 متوقف'}")
 
@@ -526,7 +3054,8 @@ async def callback_handler(event):
         await event.respond("📝 **أرسل الكلمة المفتاحية:**")
 
     elif data.decode().startswith("del_rep_"):
-        await replies_collection.delete_one({"_id": ObjectId(data.decode().split("_")[2])})
+        await replies_collection.delete_one({"_id": ObjectId(data.decode().split("_")[2]), "owner_id": chat_id})
+        await account_call(chat_id, "invalidate_replies")
         await event.respond("✅ تم الحذف.")
 
     elif data == b"menu_radar":
@@ -543,13 +3072,36 @@ async def callback_handler(event):
         curr = await ai_settings_collection.find_one({"owner_id": chat_id})
         new_w = not curr.get('active') if curr else True
         await ai_settings_collection.update_one({"owner_id": chat_id}, {"$set": {"active": new_w}}, upsert=True)
+        invalidate_owner_settings(chat_id)
+        await account_call(chat_id, "invalidate_settings")
         await event.respond(f"🤖 الذكاء: {'🟢' if new_w else '🔴'}")
     
+    elif data == b"menu_bio":
+        conf = await bio_settings_collection.find_one({"owner_id": chat_id}) or {}
+        status_bio = "🟢" if conf.get('active') else "🔴"
+        await event.respond(f"🕒 **البايو التلقائي:** {status_bio}\n📝 `{conf.get('template') or DEFAULT_BIO_TEMPLATE}`\n"
+                            f"(%TIME% = الوقت، %DATE% = التاريخ)",
+                            buttons=[[Button.inline("تشغيل/إيقاف", b"toggle_bio"), Button.inline("✏️ القالب", b"set_bio_template")],
+                                     [Button.inline("🔙", b"back_home")]])
+
+    elif data == b"toggle_bio":
+        curr = await bio_settings_collection.find_one({"owner_id": chat_id})
+        new_w = not curr.get('active') if curr else True
+        await bio_settings_collection.update_one({"owner_id": chat_id}, {"$set": {"active": new_w}}, upsert=True)
+        invalidate_owner_settings(chat_id)
+        await account_call(chat_id, "invalidate_settings")
+        await event.respond(f"🕒 البايو التلقائي: {'🟢' if new_w else '🔴'}")
+
+    elif data == b"set_bio_template":
+        user_current_state[chat_id] = "WAITING_BIO_TEMPLATE"
+        await event.respond("✏️ **أرسل القالب** (مثال: `Time: %TIME% | Online`):")
+
     elif data == b"back_home": await start_handler(event)
     elif data == b"view_stats":
-        if client:
-            d = await client.get_dialogs()
-            await event.respond(f"📊 **عدد المحادثات:** {len(d)}")
+        if account_active:
+            stats = await account_call(chat_id, "stats")
+            await event.respond(f"📊 **عدد المحادثات:** {stats['dialogs']}\n"
+                                f"👤 خاص: {stats['user']} | 👥 جروبات: {stats['group']} | 📢 قنوات: {stats['channel']} | 🤖 بوتات: {stats['bot']}")
 
 @bot_client.on(events.NewMessage)
 async def input_message_handler(event):
@@ -560,7 +3112,8 @@ async def input_message_handler(event):
 
     # تسجيل الدخول
     if state == "WAITING_SESSION":
-        if await start_userbot_session(chat_id, user_text):
+        if await account_call(chat_id, "start_session", session_string=user_text):
+            if shard_supervisor: shard_supervisor.active_owners.add(chat_id)
             await sessions_collection.update_one({"_id": chat_id}, {"$set": {"session_string": user_text}}, upsert=True)
             await event.respond("✅ **تم الدخول!**")
             await start_handler(event)
@@ -570,12 +3123,18 @@ async def input_message_handler(event):
     # برودكاست (الآن يدعم الصور)
     elif state == "WAITING_BROADCAST_MSG":
         status_msg = await event.respond("⏳ **جاري النشر...**")
-        asyncio.create_task(engine_broadcast_sender(active_userbot_clients[chat_id], status_msg, event.message))
+        started = await account_call(chat_id, "broadcast", status_chat=status_msg.chat_id, status_msg_id=status_msg.id,
+                                     source_chat=event.chat_id, source_msg_id=event.message.id)
+        if not started: await status_msg.edit("⚠️ **يوجد برودكاست جارٍ لهذا الحساب، انتظر انتهاءه.**")
         user_current_state[chat_id] = None
 
     # إعدادات النشر
     elif state == "WAITING_POST_MSG":
         temporary_autopost_config[chat_id] = {'msg': user_text}
+        if event.message.media:
+            media_id = await store_media_blob(event.message)
+            if not media_id: return await event.respond("❌ **الملف كبير جداً (الحد 15MB).**")
+            temporary_autopost_config[chat_id]['media'] = media_id
         user_current_state[chat_id] = "WAITING_POST_TIME"
         await event.respond("✅ **تم الحفظ.**\nأرسل الآن: **الدقائق؟**")
     
@@ -583,30 +3142,41 @@ async def input_message_handler(event):
         try:
             temporary_autopost_config[chat_id]['time'] = int(user_text)
             user_current_state[chat_id] = "WAITING_POST_GROUPS"
-            btns = []
-            cli = active_userbot_clients[chat_id]
-            async for d in cli.iter_dialogs(limit=30): 
-                if d.is_group: btns.append([Button.inline(d.name[:20], f"grp_{d.id}")])
-            btns.append([Button.inline("✅ حفظ وبدء", "save_autopost_final")])
             temporary_autopost_config[chat_id]['groups'] = []
-            await event.respond("📂 **اختر الجروبات:**", buttons=btns)
-        except: 
+            temporary_autopost_config[chat_id]['query'] = None
+            await send_group_picker(event, chat_id)
+        except ValueError:
             await event.respond("❌ رقم صحيح.")
 
+    elif state == "WAITING_POST_GROUPS":
+        # أي نص في هذه المرحلة = بحث بعنوان الجروب
+        temporary_autopost_config[chat_id]['query'] = user_text
+        await send_group_picker(event, chat_id)
+
+    elif state == "WAITING_BIO_TEMPLATE":
+        await bio_settings_collection.update_one({"owner_id": chat_id}, {"$set": {"template": user_text[:200]}}, upsert=True)
+        invalidate_owner_settings(chat_id)
+        await account_call(chat_id, "invalidate_settings")
+        await event.respond("✅ **تم حفظ القالب**")
+        user_current_state[chat_id] = None
+
     elif state == "WAITING_REPLY_KEY":
         temporary_task_data[chat_id] = {'k': user_text}
         user_current_state[chat_id] = "WAITING_REPLY_VAL"
         await event.respond("📝 **الرد:**")
     elif state == "WAITING_REPLY_VAL":
         await replies_collection.update_one({"owner_id": chat_id, "keyword": temporary_task_data[chat_id]['k']}, {"$set": {"reply": user_text}}, upsert=True)
+        await account_call(chat_id, "invalidate_replies")
         await event.respond("✅ **تم الحفظ**")
         user_current_state[chat_id]=None
 
     elif state == "WAITING_RADAR_ADD":
         await admins_watch_collection.update_one({"owner_id": chat_id, "username": user_text.replace("@","")}, {"$set": {"ts":time.time()}}, upsert=True)
+        if is_account_active(chat_id): await account_call(chat_id, "radar_changed")
         await event.respond("✅"); user_current_state[chat_id]=None
     elif state == "WAITING_RADAR_DEL":
         await admins_watch_collection.delete_one({"owner_id": chat_id, "username": user_text.replace("@","")})
+        if is_account_active(chat_id): await account_call(chat_id, "radar_changed")
         await event.respond("🗑️"); user_current_state[chat_id]=None
 
     # المهام (مع دعم الصور)
@@ -615,9 +3185,36 @@ async def input_message_handler(event):
     elif state == "WAITING_TASK_REP": temporary_task_data[chat_id]['r']=event.message; user_current_state[chat_id]="WAITING_TASK_DELAY"; await event.respond("الثواني:")
     elif state == "WAITING_TASK_DELAY":
         msg = await event.respond("🚀")
-        asyncio.create_task(engine_search_task(active_userbot_clients[chat_id], msg, temporary_task_data[chat_id]['h'], temporary_task_data[chat_id]['k'], temporary_task_data[chat_id]['r'], int(user_text)))
+        task = temporary_task_data[chat_id]
+        await account_call(chat_id, "search", status_chat=msg.chat_id, status_msg_id=msg.id, hours=task['h'], keyword=task['k'],
+                           reply_chat=task['r'].chat_id, reply_msg_id=task['r'].id, delay=int(user_text))
         user_current_state[chat_id]=None
 
+async def send_group_picker(event, chat_id, page=0, edit=False):
+    """ منتقي الجروبات: صفحات من فهرس المحادثات مع بحث بالعنوان """
+    config = temporary_autopost_config[chat_id]
+    listing = await account_call(chat_id, "list_groups", query=config.get('query'),
+                                 offset=page * GROUP_PICKER_PAGE_SIZE, limit=GROUP_PICKER_PAGE_SIZE)
+    selected = set(config.get('groups', []))
+    btns = [[Button.inline(f"{'✅ ' if group_id in selected else ''}{(title or str(group_id))[:20]}", f"grp_{group_id}")]
+            for group_id, title, members in listing['groups']]
+    pages = max(1, -(-listing['total'] // GROUP_PICKER_PAGE_SIZE))
+    nav = []
+    if page > 0: nav.append(Button.inline("⬅️", f"gpage_{page - 1}"))
+    if page + 1 < pages: nav.append(Button.inline("➡️", f"gpage_{page + 1}"))
+    if nav: btns.append(nav)
+    btns.append([Button.inline("✅ حفظ وبدء", "save_autopost_final")])
+    text = (f"📂 **اختر الجروبات:** ({listing['total']} جروب، صفحة {page + 1}/{pages})\n"
+            f"🔎 أرسل جزءاً من اسم الجروب للبحث." + (f"\nالبحث الحالي: {config['query']}" if config.get('query') else ""))
+    if edit: await event.edit(text, buttons=btns)
+    else: await event.respond(text, buttons=btns)
+
+@bot_client.on(events.CallbackQuery(pattern=r'gpage_'))
+async def group_page(event):
+    chat_id = event.chat_id
+    if chat_id not in temporary_autopost_config: return await event.answer()
+    await send_group_picker(event, chat_id, page=int(event.data.decode().split('_')[1]), edit=True)
+
 @bot_client.on(events.CallbackQuery(pattern=r'grp_'))
 async def group_select(event):
     chat_id = event.chat_id
@@ -633,18 +3230,243 @@ async def save_autopost_final(event):
     d = temporary_autopost_config.get(chat_id)
     if not d or not d.get('groups'): return await event.respond("❌ اختر جروب")
     
-    await autopost_config_collection.update_one({"owner_id": chat_id}, {"$set": {"message": d['msg'], "interval": d['time'], "groups": d['groups'], "active": True}}, upsert=True)
-    await manage_user_autopost_task(active_userbot_clients[chat_id], chat_id)
+    await autopost_config_collection.update_one({"owner_id": chat_id}, {"$set": {"message": d['msg'], "media_id": d.get('media'), "interval": d['time'], "groups": d['groups'], "active": True}}, upsert=True)
+    invalidate_owner_settings(chat_id)
+    await account_call(chat_id, "manage_autopost")
     await event.respond("✅ **تم الحفظ وبدء النشر!**")
     user_current_state[chat_id] = None
 
+# ==============================================================================
+#                               9. التوزيع على عدة عمليات (Sharding)
+# ==============================================================================
+
+SHARD_VIRTUAL_NODES = 64       # نقاط لكل عامل على حلقة التوزيع
+SHARD_IPC_LIMIT = 2 ** 24      # أقصى حجم لرسالة IPC واحدة
+SHARD_RPC_TIMEOUT = 60         # مهلة الأوامر العادية (ثواني)
+SHARD_SYNC_TIMEOUT = 1800      # مهلة المزامنة (تشغيل كل حسابات العامل)
+SHARD_RESTART_DELAY = 5        # انتظار قبل إعادة تشغيل عامل توقف
+
+def shard_socket_path(shard_id):
+    return os.path.join(SHARD_SOCKET_DIR, f"bot-shard-{shard_id}.sock")
+
+def _ring_hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+class HashRing:
+    """ حلقة توزيع ثابتة: عند موت عامل تنتقل حساباته فقط، والباقي يبقى مكانه """
+
+    def __init__(self, members, vnodes=SHARD_VIRTUAL_NODES):
+        points = sorted((_ring_hash(f"shard-{m}-{v}"), m) for m in members for v in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._members = [m for _, m in points]
+
+    def owner_of(self, owner_id):
+        if not self._hashes: return None
+        index = bisect.bisect(self._hashes, _ring_hash(owner_id)) % len(self._hashes)
+        return self._members[index]
+
+async def shard_request(shard_id, payload, timeout=SHARD_RPC_TIMEOUT):
+    """ طلب JSON واحد (سطر) لعامل والانتظار للرد """
+    reader, writer = await asyncio.open_unix_connection(shard_socket_path(shard_id), limit=SHARD_IPC_LIMIT)
+    try:
+        writer.write(json.dumps(payload).encode() + b"\n")
+        await writer.drain()
+        response = json.loads(await asyncio.wait_for(reader.readline(), timeout))
+    finally:
+        writer.close()
+    if not response.get('ok'): raise RuntimeError(f"shard {shard_id}: {response.get('error')}")
+    return response.get('result')
+
+class ShardSupervisor:
+    """
+    يشغل SHARD_COUNT عامل (نفس الملف مع --worker N) ويراقبهم.
+    كل عامل يملك شريحة من الحسابات حسب HashRing، وعند موت عامل
+    يُعاد توزيع حساباته على الباقين ثم يُعاد تشغيله ويستعيد شريحته.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.members = set()       # العمال الأحياء والجاهزون
+        self.active_owners = set() # الحسابات العاملة حالياً في كل العمال
+        self._owners_by_shard = {}
+        self._processes = {}
+        self._tasks = []
+        self._sync_lock = asyncio.Lock()
+        self._stopping = False
+
+    def ring(self):
+        return HashRing(sorted(self.members))
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._run_worker(i)) for i in range(self.count)]
+
+    async def stop(self):
+        self._stopping = True
+        for task in self._tasks: task.cancel()
+        for proc in self._processes.values():
+            if proc.returncode is None: proc.terminate()
+        await asyncio.gather(*(p.wait() for p in self._processes.values()), return_exceptions=True)
+
+    async def _wait_ready(self, shard_id, proc):
+        for _ in range(120):
+            if proc.returncode is not None: return False
+            try:
+                await shard_request(shard_id, {"op": "ping"}, timeout=5); return True
+            except (OSError, asyncio.TimeoutError, RuntimeError): await asyncio.sleep(1)
+        return False
+
+    async def _run_worker(self, shard_id):
+        while not self._stopping:
+            proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), '--worker', str(shard_id))
+            self._processes[shard_id] = proc
+            if await self._wait_ready(shard_id, proc):
+                self.members.add(shard_id)
+                await self.rebalance(joining=shard_id)
+                logger.info(f"Shard {shard_id} ready (pid {proc.pid})")
+            await proc.wait()
+            if self._stopping: break
+            logger.warning(f"Shard {shard_id} exited ({proc.returncode}), rebalancing")
+            self.members.discard(shard_id)
+            self.active_owners -= self._owners_by_shard.pop(shard_id, set())
+            await self.rebalance()
+            await asyncio.sleep(SHARD_RESTART_DELAY)
+
+    async def rebalance(self, joining=None):
+        """ إبلاغ العمال بالأعضاء الحاليين: كل عامل يوقف ما لم يعد له ثم يشغل شريحته الجديدة """
+        async with self._sync_lock:
+            members = sorted(self.members)
+            # العامل المنضم آخراً: حتى يترك الآخرون حساباته قبل أن يشغلها (لا اتصالين لنفس الحساب)
+            order = [m for m in members if m != joining] + ([joining] if joining is not None else [])
+            for shard_id in order:
+                try:
+                    owners = await shard_request(shard_id, {"op": "sync", "members": members}, timeout=SHARD_SYNC_TIMEOUT)
+                    self._owners_by_shard[shard_id] = set(owners)
+                except Exception as e:
+                    logger.warning(f"Shard {shard_id} sync failed: {e}")
+            self.active_owners = set().union(*self._owners_by_shard.values()) if self._owners_by_shard else set()
+
+    async def call(self, owner_id, command, kwargs):
+        shard_id = self.ring().owner_of(owner_id)
+        if shard_id is None: raise RuntimeError("no shard workers available")
+        return await shard_request(shard_id, {"op": "account", "owner_id": owner_id, "command": command, "kwargs": kwargs})
+
+    async def collect_metrics(self):
+        sources = []
+        for shard_id in sorted(self.members):
+            try: sources.append(({"shard": str(shard_id)}, await shard_request(shard_id, {"op": "metrics"}, timeout=10)))
+            except Exception as e: record_error("shard_metrics", e)
+        return sources
+
+    async def profile(self, seconds, debug=False):
+        """ تشغيل المُحلل في كل العمال بنفس الوقت """
+        async def one(shard_id):
+            try: return await shard_request(shard_id, {"op": "profile", "seconds": seconds, "debug": debug}, timeout=seconds + 30)
+            except Exception as e: return {"error": f"{type(e).__name__}: {e}"}
+        shard_ids = sorted(self.members)
+        results = await asyncio.gather(*(one(shard_id) for shard_id in shard_ids))
+        return {f"shard {shard_id}": result for shard_id, result in zip(shard_ids, results)}
+
+    async def status(self):
+        totals = {"accounts": 0, "queued_sends": 0}
+        for shard_id in sorted(self.members):
+            try:
+                result = await shard_request(shard_id, {"op": "status"}, timeout=5)
+                for key in totals: totals[key] += result.get(key, 0)
+            except Exception as e: record_error("shard_status", e)
+        return totals
+
+async def shard_sync(members):
+    """ (في العامل) مزامنة الحسابات مع شريحة هذا العامل على الحلقة """
+    ring = HashRing(members)
+    wanted = [d async for d in sessions_collection.find({}) if ring.owner_of(d['_id']) == SHARD_ID]
+    wanted_ids = {d['_id'] for d in wanted}
+    released = [o for o in active_userbot_clients if o not in wanted_ids]
+    if released: await save_cooldown_stores(released)
+    for owner_id in released: await stop_userbot_session(owner_id)
+    to_start = [d for d in wanted if d['_id'] not in active_userbot_clients]
+    if to_start:
+        await load_cooldown_stores([d['_id'] for d in to_start])
+        await start_userbot_fleet(to_start)
+    return list(active_userbot_clients)
+
+async def handle_shard_request(reader, writer):
+    """ (في العامل) خادم IPC: سطر JSON لكل طلب """
+    try:
+        request = json.loads(await reader.readline())
+        op = request.get('op')
+        if op == "ping": result = SHARD_ID
+        elif op == "status": result = await account_status()
+        elif op == "metrics": result = collect_metrics()
+        elif op == "profile": result = await run_profile(request['seconds'], request.get('debug', False))
+        elif op == "sync": result = await shard_sync(request['members'])
+        elif op == "account":
+            result = await ACCOUNT_COMMANDS[request['command']](request['owner_id'], **request.get('kwargs', {}))
+        else: raise ValueError(f"unknown op {op}")
+        response = {"ok": True, "result": result}
+    except Exception as e:
+        response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+    try:
+        writer.write(json.dumps(response, default=str).encode() + b"\n")
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def shard_worker_main(shard_id):
+    """ عامل: يشغل شريحة من الحسابات فقط (بدون لوحة التحكم والخادم) وينتظر أوامر المشرف """
+    await bot_client.start(bot_token=BOT_TOKEN)
+    bot_ready.set()
+    asyncio.create_task(watch_settings_changes())
+    asyncio.create_task(monitor_event_loop_lag(), name=f"loop_lag:shard{shard_id}")
+    path = shard_socket_path(shard_id)
+    if os.path.exists(path): os.remove(path)
+    server = await asyncio.start_unix_server(handle_shard_request, path=path, limit=SHARD_IPC_LIMIT)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError: pass
+    try:
+        await stop_event.wait()
+    finally:
+        server.close()
+        await save_cooldown_stores(list(active_userbot_clients))
+        for owner_id in list(active_userbot_clients): await stop_userbot_session(owner_id)
+        await flush_write_buffers()
+
 async def main():
+    global shard_supervisor
     await start_web_server()
-    await load_all_sessions_from_db()
+    await ensure_indexes()
+    check_invoice_setup()
+    asyncio.create_task(monitor_event_loop_lag(), name="loop_lag:main")
+    asyncio.create_task(watch_settings_changes())
+    if SHARD_COUNT > 0:
+        # وضع التوزيع: الحسابات تعمل في عمليات منفصلة، وهذه العملية للوحة التحكم والخادم فقط
+        shard_supervisor = ShardSupervisor(SHARD_COUNT)
+        await shard_supervisor.start()
+    else:
+        await load_cooldown_stores()
+        await load_all_sessions_from_db()
     print("✅ Bot Started Final Ultimate")
     await bot_client.start(bot_token=BOT_TOKEN)
-    await bot_client.run_until_disconnected()
+    bot_ready.set()
+
+    # الإيقاف الآمن: فصل البوت ثم حفظ التبريدات قبل الخروج
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, lambda: asyncio.ensure_future(bot_client.disconnect()))
+        except NotImplementedError: pass
+    try:
+        await bot_client.run_until_disconnected()
+    finally:
+        if shard_supervisor: await shard_supervisor.stop()
+        else:
+            await save_cooldown_stores()
+            await save_all_entity_caches()
+            await flush_write_buffers()
 
 if __name__ == '__main__':
-    try: loop = asyncio.get_event_loop(); loop.run_until_complete(main())
-    except: pass
+    try: loop = asyncio.get_event_loop(); loop.run_until_complete(shard_worker_main(SHARD_ID) if IS_SHARD_WORKER else main())
+    except KeyboardInterrupt: pass
+    except Exception: logger.exception("Fatal error, exiting")
@@ -0,0 +1,100 @@
+"""
+رسم فواتير PDF لـ bot.py في عملية مستقلة.
+
+bot.py يشغل هذا الملف كعملية فرعية (python invoice_render.py ...) ويرسل له الفواتير،
+وهو ينشئ ProcessPool للرسم ويعيد ملف zip. spawn يعيد تشغيل ملف __main__ في كل عامل،
+فلو أُنشئ المجمع داخل bot.py لأعاد كل عامل تشغيل البوت كاملاً (السجلات وMotor وTelethon)؛
+هنا __main__ هو هذا الملف الصغير ولا يعمل شيء منه عند الاستيراد.
+كل عامل يسجل الخط والشعار مرة واحدة عند بدئه، والنصوص العربية تُشكّل مرة واحدة (lru_cache).
+
+الاستخدام: python invoice_render.py الخط الشعار العمال حجم_الدفعة < JSON > zip
+"""
+import io
+import os
+import re
+import sys
+import json
+import zipfile
+import tempfile
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+_invoice_assets = {}  # (داخل العامل) مسارات الخط والشعار بعد التحقق منها
+
+def init_invoice_worker(font_path, logo_path):
+    """ مُهيئ العامل: يعمل مرة واحدة لكل عملية """
+    import fpdf.fpdf
+    # PyFPDF يحلل ملف TTF ويحفظ النتيجة: نوجه الحفظ لمجلد مؤقت بدل مجلد المشروع
+    fpdf.fpdf.FPDF_CACHE_MODE = 2
+    fpdf.fpdf.FPDF_CACHE_DIR = tempfile.gettempdir()
+    _invoice_assets['font'] = os.path.abspath(font_path)
+    _invoice_assets['logo'] = os.path.abspath(logo_path) if logo_path and os.path.exists(logo_path) else None
+
+@functools.lru_cache(maxsize=4096)
+def shape_arabic(text):
+    """ تشكيل الحروف العربية وترتيبها من اليمين لليسار (النصوص المتكررة تُحسب مرة واحدة) """
+    import arabic_reshaper
+    from bidi.algorithm import get_display
+    return get_display(arabic_reshaper.reshape(str(text)))
+
+def invoice_total(count, price):
+    """ "3" × "4$" -> "12$" (أو None إذا لم يكن السعر رقماً) """
+    match = re.match(r'\s*([\d.]+)\s*(.*)$', str(price or ""))
+    try: total = float(count) * float(match.group(1))
+    except (TypeError, ValueError, AttributeError): return None
+    return f"{total:g}{match.group(2).strip()}"
+
+def render_invoice_pdf(invoice_id, invoice, store_name, with_logo):
+    from fpdf import FPDF
+    pdf = FPDF(format='A5')
+    pdf.add_page()
+    pdf.add_font("Arabic", "", _invoice_assets['font'], uni=True)
+    if with_logo and _invoice_assets.get('logo'):
+        pdf.image(_invoice_assets['logo'], x=(pdf.w - 30) / 2, y=8, w=30)
+        pdf.set_y(42)
+    pdf.set_font("Arabic", size=18)
+    pdf.cell(0, 12, shape_arabic(f"فاتورة {store_name}"), ln=1, align='C')
+    pdf.set_font("Arabic", size=11)
+    rows = [("رقم الفاتورة", invoice_id), ("العميل", invoice.get('client_name', '')),
+            ("المنتج", invoice.get('product', '')), ("الكمية", invoice.get('count', '')), ("السعر", invoice.get('price', ''))]
+    total = invoice_total(invoice.get('count'), invoice.get('price'))
+    if total: rows.append(("الإجمالي", total))
+    if invoice.get('warranty'): rows.append(("الضمان", f"{invoice['warranty']} يوم"))
+    for label, value in rows:
+        pdf.cell(0, 9, shape_arabic(f"{label}: {value}"), border=1, ln=1, align='R')
+    data = pdf.output(dest='S')
+    return data.encode('latin-1') if isinstance(data, str) else bytes(data)
+
+def render_invoice_batch(items, with_logo):
+    """ (داخل العامل) items: [(invoice_id, invoice, store_name)] -> [(اسم الملف, PDF)] """
+    return [(f"{store_name}/invoice_{invoice_id}.pdf", render_invoice_pdf(invoice_id, invoice, store_name, with_logo))
+            for invoice_id, invoice, store_name in items]
+
+def check_invoice_font(path):
+    """ التأكد أن ملف الخط TrueType فعلاً (تحميل خاطئ قد يحفظ صفحة HTML باسم .ttf) """
+    with open(path, 'rb') as f: magic = f.read(4)
+    if magic not in (b'\x00\x01\x00\x00', b'true', b'OTTO'):
+        raise ValueError(f"{path} is not a TrueType font")
+
+def render_invoices_zip(items, with_logo, font_path, logo_path, workers, batch_size):
+    """ رسم الفواتير دفعات في العمال وكتابتها في zip حسب اكتمالها """
+    check_invoice_font(font_path)
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    buffer = io.BytesIO()
+    # spawn: لا fork من عملية متعددة الخيوط (أقفال محجوزة قد تجمد العامل)
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_invoice_worker, initargs=(font_path, logo_path)) as pool, \
+         zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for future in as_completed([pool.submit(render_invoice_batch, batch, with_logo) for batch in batches]):
+            for name, data in future.result(): archive.writestr(name, data)
+    return buffer.getvalue()
+
+def main():
+    font_path, logo_path, workers, batch_size = sys.argv[1:5]
+    job = json.load(sys.stdin)
+    data = render_invoices_zip(job['items'], job['with_logo'], font_path, logo_path or None, int(workers), int(batch_size))
+    sys.stdout.buffer.write(data)
+
+if __name__ == "__main__":
+    main()